@@ -0,0 +1,90 @@
+"""
+Admission control and rate limiting for the chat server.
+
+Admission caps how many connections may be in their handshake at once and
+how many may be joined to a channel. A connection over the handshake cap is
+closed as soon as it is accepted, before it costs a thread or a read; one
+over the member cap gets its handshake answered with "server is full" and a
+"retryAfter" hint.
+
+TokenBucket limits how fast a member, or all the members of a channel
+together, may send. A message that finds its bucket empty is not broadcast:
+the sender gets {"action": "throttled", "ref", "retryAfter"} back and the
+server stops reading from it for that long, so a flooding client fills its
+own socket buffers instead of the server's.
+"""
+import threading
+import time
+
+# Seconds a client refused at the member cap is told to wait
+RETRY_AFTER = 5.0
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and bursts of up to `burst`"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "lock")
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, count=1):
+        """Takes count tokens; returns 0 on success, or the seconds until they would be available"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= count:
+                self.tokens -= count
+                return 0.0
+            return (count - self.tokens) / self.rate
+
+
+class Admission:
+    """
+    Counts handshakes in progress and joined members against their caps.
+
+    None means unlimited. A connection that begin_handshake() let in ends its
+    handshake with finish_handshake(); a member that join() let in ends with
+    leave().
+    """
+
+    def __init__(self, max_connections=None, max_handshakes=None):
+        self.max_connections = max_connections
+        self.max_handshakes = max_handshakes
+        self.handshakes = 0
+        self.members = 0
+        self.lock = threading.Lock()
+
+    def begin_handshake(self):
+        """Returns False if too many handshakes are already in progress"""
+        with self.lock:
+            if self.max_handshakes is not None and self.handshakes >= self.max_handshakes:
+                return False
+            self.handshakes += 1
+            return True
+
+    def finish_handshake(self):
+        with self.lock:
+            self.handshakes -= 1
+
+    def join(self):
+        """Reserves room for a member; returns False if the server is full"""
+        with self.lock:
+            if self.max_connections is not None and self.members >= self.max_connections:
+                return False
+            self.members += 1
+            return True
+
+    def adopt(self):
+        """Counts a member admitted by the server this one took over from, even beyond the cap"""
+        with self.lock:
+            self.members += 1
+
+    def leave(self):
+        with self.lock:
+            self.members -= 1
@@ -0,0 +1 @@
+"""Benchmarks for the chat server and client. Run from the repository root, e.g. ``python -m benchmarks.engines``."""
@@ -0,0 +1,180 @@
+"""
+Benchmark for admission control: does one abusive client degrade everyone else?
+
+Runs a well-behaved channel, whose owner sends at a steady rate while probe
+members time every message, next to a flood channel whose senders write as
+fast as the server will read and whose listeners multiply every message.
+Meanwhile a storm of connections is opened that never send a request. Each
+configuration reports the well-behaved channel's latency and delivery rate,
+how long a fresh join takes during the storm, and what the server refused.
+
+    python -m benchmarks.admission --flooders 4 --storm 500
+"""
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import time
+
+from benchmarks.batching import probe_latency, send_at_rate
+from benchmarks.common import free_port, percentile, raise_fd_limit, start_server, stop_server
+from benchmarks.engines import DeliveryCounter, count_messages, open_member
+from benchmarks.metrics import scrape
+from protocol import encode_message
+
+CONFIGS = {
+    "unlimited": [],
+    "limited": [
+        "--member-rate", "100", "--member-burst", "50",
+        "--max-handshakes", "64", "--handshake-timeout", "2",
+    ],
+}
+
+
+async def join_channel(port, name, members):
+    """Create a channel and join members to it; returns the readers and writers"""
+    channel = {"channelName": name, "channelPassword": "", "memberName": "owner"}
+    reader, writer = await open_member(port, {"action": "createChannel", **channel})
+    streams = [(reader, writer)]
+    for index in range(members - 1):
+        streams.append(await open_member(port, {
+            "action": "joinChannel", **channel, "memberName": f"member{index}"
+        }))
+    return streams
+
+
+async def late_join(port, timeout=30.0):
+    """Join the calm channel, retrying like a client would; returns (ms taken, attempts)"""
+    started = time.perf_counter()
+    attempts = 0
+    while time.perf_counter() - started < timeout:
+        attempts += 1
+        try:
+            _, writer = await asyncio.wait_for(open_member(port, {
+                "action": "joinChannel", "channelName": "calm", "channelPassword": "", "memberName": "late"
+            }), timeout=timeout)
+        except (asyncio.TimeoutError, OSError):
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return round((time.perf_counter() - started) * 1000, 1), attempts
+    return None, attempts
+
+
+async def flood(writer, stop):
+    """Write messages as fast as the server reads them"""
+    payload = encode_message({"action": "message", "message": "x" * 100})
+    while not stop.is_set():
+        writer.write(payload * 32)
+        await writer.drain()
+
+
+def open_storm(port, count):
+    """Connections that never send a request (closed by the server or left hanging)"""
+    sockets = []
+    for _ in range(count):
+        try:
+            sockets.append(socket.create_connection(("127.0.0.1", port), timeout=1))
+        except OSError:
+            break
+    return sockets
+
+
+async def run(mode, config, members, probes, flooders, listeners, storm, rate, duration):
+    port = free_port()
+    metrics_port = free_port()
+    process = start_server(port, mode, [
+        "--stats-interval", "0", "--log-level", "error",
+        "--metrics", f"tcp:127.0.0.1:{metrics_port}",
+        *CONFIGS[config],
+    ])
+    streams = []
+    storm_sockets = []
+    try:
+        calm = await join_channel(port, "calm", members)
+        noisy = await join_channel(port, "noisy", flooders + listeners)
+        streams = calm + noisy
+
+        counter = DeliveryCounter()
+        latencies = []
+        tasks = [
+            asyncio.create_task(probe_latency(reader, counter, latencies) if index < probes
+                                else count_messages(reader, counter))
+            for index, (reader, _) in enumerate(calm)
+        ]
+        # The noisy channel's deliveries are drained but not counted
+        tasks += [asyncio.create_task(count_messages(reader, DeliveryCounter())) for reader, _ in noisy]
+
+        stop = asyncio.Event()
+        tasks += [asyncio.create_task(flood(writer, stop)) for _, writer in noisy[:flooders]]
+        storm_sockets = await asyncio.to_thread(open_storm, port, storm)
+
+        join_ms, join_attempts = await late_join(port)
+
+        started = time.perf_counter()
+        sent = await send_at_rate(calm[0][1], rate, duration)
+        expected = sent * members
+        try:
+            counter.expect(expected)
+            await asyncio.wait_for(counter.reached.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - started
+        stop.set()
+
+        samples, _ = scrape(metrics_port)
+        throttled = samples["chat_messages_throttled_total"]
+        for task in tasks:
+            task.cancel()
+        return {
+            "mode": mode,
+            "config": config,
+            "calm_delivered_pct": round(min(counter.delivered, expected) / expected * 100, 1),
+            "calm_deliveries_per_sec": round(min(counter.delivered, expected) / elapsed),
+            "calm_latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "calm_latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "join_during_storm_ms": join_ms,
+            "join_attempts": join_attempts,
+            "flood_messages_accepted": samples["chat_messages_received_total"] - throttled - sent,
+            "flood_messages_throttled": throttled,
+            "connections_rejected": samples["chat_connections_rejected_total"],
+            "handshake_timeouts": samples["chat_handshake_timeouts_total"],
+        }
+    finally:
+        for sock in storm_sockets:
+            sock.close()
+        for _, writer in streams:
+            writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--configs", nargs="+", choices=sorted(CONFIGS), default=["unlimited", "limited"])
+    parser.add_argument("--members", type=int, default=20, help="members of the well-behaved channel")
+    parser.add_argument("--probes", type=int, default=5)
+    parser.add_argument("--flooders", type=int, default=4)
+    parser.add_argument("--listeners", type=int, default=50, help="members of the flood channel that only read")
+    parser.add_argument("--storm", type=int, default=500, help="connections that never send a request")
+    parser.add_argument("--rate", type=int, default=50, help="messages per second in the well-behaved channel")
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        for config in args.configs:
+            try:
+                result = asyncio.run(run(
+                    mode, config, args.members, args.probes, args.flooders, args.listeners,
+                    args.storm, args.rate, args.duration
+                ))
+            except RuntimeError as e:
+                print(f"{mode}/{config}: {e}", file=sys.stderr)
+                sys.exit(1)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark for write batching: the latency/throughput trade-off of --batch-delay.
+
+For each engine, batch delay and send rate, joins members to one channel and
+has the owner send messages at a fixed rate. A few probe members time each
+message from send to receipt; every member counts deliveries. The server's
+metrics give the number of socket writes per delivery and /proc its CPU
+time, so each line of output is one point on the curve: what a delay costs
+in latency and what it saves in system calls and CPU at that rate.
+
+    python -m benchmarks.batching --members 50 --rates 200 1000 4000 --delays 0 1 2 5
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchmarks.common import (
+    chat_messages, cpu_seconds, free_port, percentile, raise_fd_limit, start_server, stop_server
+)
+from benchmarks.engines import DeliveryCounter, count_messages, open_member
+from benchmarks.metrics import scrape
+from protocol import FrameDecoder, encode_message
+
+TICK = 0.001
+
+
+async def probe_latency(reader, counter, latencies):
+    """Count deliveries on one member and record each message's send-to-receipt latency"""
+    decoder = FrameDecoder()
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        now = time.perf_counter()
+        payloads = chat_messages(decoder.feed(chunk))
+        for payload in payloads:
+            latencies.append(now - float(json.loads(payload)["message"]))
+        counter.add(len(payloads))
+
+
+async def send_at_rate(writer, rate, duration):
+    """Open-loop sender: every tick, writes the messages that have fallen due"""
+    started = time.perf_counter()
+    sent = 0
+    while True:
+        elapsed = time.perf_counter() - started
+        if elapsed >= duration:
+            break
+        due = min(int(elapsed * rate) + 1, int(duration * rate))
+        while sent < due:
+            writer.write(encode_message({"action": "message", "message": f"{time.perf_counter():.6f}"}))
+            sent += 1
+        await writer.drain()
+        await asyncio.sleep(TICK)
+    return sent
+
+
+async def run(mode, delay, rate, members, probes, duration):
+    port = free_port()
+    metrics_port = free_port()
+    process = start_server(port, mode, [
+        "--stats-interval", "0", "--log-level", "warning",
+        "--send-queue", str(int(rate * duration) + 16),
+        "--metrics", f"tcp:127.0.0.1:{metrics_port}",
+        "--batch-delay", str(delay),
+    ])
+    writers = []
+    try:
+        channel = {"channelName": "bench", "channelPassword": "", "memberName": "owner"}
+        owner_reader, owner_writer = await open_member(port, {"action": "createChannel", **channel})
+        readers = [owner_reader]
+        writers.append(owner_writer)
+        for index in range(members - 1):
+            reader, writer = await open_member(port, {
+                "action": "joinChannel", **channel, "memberName": f"member{index}"
+            })
+            readers.append(reader)
+            writers.append(writer)
+
+        counter = DeliveryCounter()
+        latencies = []
+        tasks = [
+            asyncio.create_task(probe_latency(reader, counter, latencies) if index < probes
+                                else count_messages(reader, counter))
+            for index, reader in enumerate(readers)
+        ]
+
+        before, _ = scrape(metrics_port)
+        cpu_before = cpu_seconds(process.pid)
+        started = time.perf_counter()
+        sent = await send_at_rate(owner_writer, rate, duration)
+        counter.expect(sent * members)
+        await asyncio.wait_for(counter.reached.wait(), timeout=120)
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(process.pid) - cpu_before
+        after, _ = scrape(metrics_port)
+        for task in tasks:
+            task.cancel()
+
+        deliveries = sent * members
+        writes = after["chat_socket_writes_total"] - before["chat_socket_writes_total"]
+        return {
+            "mode": mode,
+            "batch_delay_ms": delay,
+            "rate": rate,
+            "members": members,
+            "deliveries_per_sec": round(deliveries / elapsed),
+            "latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "deliveries_per_write": round(deliveries / max(writes, 1), 2),
+            "server_cpu_us_per_delivery": round(cpu / deliveries * 1e6, 2),
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--delays", nargs="+", type=float, default=[0, 1, 2, 5], help="batch delays in ms")
+    parser.add_argument("--rates", nargs="+", type=int, default=[200, 1000, 4000], help="messages per second")
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--probes", type=int, default=5, help="members that measure latency")
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        for rate in args.rates:
+            for delay in args.delays:
+                try:
+                    result = asyncio.run(run(mode, delay, rate, args.members, args.probes, args.duration))
+                except (RuntimeError, asyncio.TimeoutError) as e:
+                    print(f"{mode}/{delay}ms/{rate}: {e!r}", file=sys.stderr)
+                    sys.exit(1)
+                print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Aggregate broadcast throughput of a cluster as the number of workers grows.
+
+For each worker count, starts cluster.py (bus hub plus workers sharing one
+port through SO_REUSEPORT), spreads members of several channels across the
+workers and has one member per channel send as fast as it can. Deliveries
+are counted at every member, so the result includes cross-worker traffic
+relayed over the bus.
+
+    python -m benchmarks.cluster --workers 1 2 4 --channels 4 --members 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import REPO_ROOT, chat_messages, free_port, raise_fd_limit, wait_for_port
+from benchmarks.engines import open_member
+from protocol import FrameDecoder, encode_message
+
+
+async def count_frames(reader, counter):
+    decoder = FrameDecoder()
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        counter[0] += len(chat_messages(decoder.feed(chunk)))
+
+
+async def flood(writer, stop, payload_size, batch=50):
+    text = "m" * payload_size
+    frame = encode_message({"action": "message", "message": text})
+    while not stop.is_set():
+        writer.write(frame * batch)
+        await writer.drain()
+        await asyncio.sleep(0)
+
+
+async def run_cluster(workers, mode, channels, members, seconds, payload_size):
+    port = free_port()
+    bus = f"unix:{os.path.join(tempfile.mkdtemp(prefix='chat-bench-'), 'bus.sock')}"
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_ROOT, "cluster.py"), "--workers", str(workers),
+         "--host", "127.0.0.1", "--port", str(port), "--mode", mode, "--bus", bus,
+         "--", "--stats-interval", "0", "--send-queue", "100000"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    writers = []
+    tasks = []
+    try:
+        wait_for_port(port)
+        await asyncio.sleep(1.0)
+
+        senders = []
+        for index in range(channels):
+            channel = {"channelName": f"bench{index}", "channelPassword": "", "memberName": "sender"}
+            reader, writer = await open_member(port, {"action": "createChannel", **channel})
+            senders.append((reader, writer))
+            writers.append(writer)
+        # Give the bus time to replicate the new channels to every worker
+        await asyncio.sleep(0.5)
+
+        counter = [0]
+        for index in range(channels):
+            for member in range(members - 1):
+                reader, writer = await open_member(port, {
+                    "action": "joinChannel", "channelName": f"bench{index}",
+                    "channelPassword": "", "memberName": f"member{member}",
+                })
+                writers.append(writer)
+                tasks.append(asyncio.create_task(count_frames(reader, counter)))
+        for reader, _ in senders:
+            tasks.append(asyncio.create_task(count_frames(reader, counter)))
+
+        stop = asyncio.Event()
+        tasks.extend(asyncio.create_task(flood(writer, stop, payload_size)) for _, writer in senders)
+        await asyncio.sleep(1.0)  # warm up
+
+        started_count = counter[0]
+        started = time.perf_counter()
+        await asyncio.sleep(seconds)
+        delivered = counter[0] - started_count
+        elapsed = time.perf_counter() - started
+        stop.set()
+
+        return {
+            "workers": workers,
+            "mode": mode,
+            "channels": channels,
+            "members": channels * members,
+            "deliveries_per_sec": round(delivered / elapsed),
+        }
+    finally:
+        for task in tasks:
+            task.cancel()
+        for writer in writers:
+            writer.close()
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--mode", default="async")
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--members", type=int, default=50, help="members per channel")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--payload-size", type=int, default=100)
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{os.cpu_count()} CPUs available; throughput can only scale up to that many workers")
+    for workers in args.workers:
+        result = asyncio.run(run_cluster(
+            workers, args.mode, args.channels, args.members, args.seconds, args.payload_size
+        ))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("  ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
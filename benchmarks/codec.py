@@ -0,0 +1,69 @@
+"""
+Microbenchmark comparing the JSON and binary wire codecs.
+
+For a few representative payloads, reports encode and decode time per
+message and the bytes each one takes on the wire (frame header included).
+
+    python -m benchmarks.codec --iterations 200000
+"""
+import argparse
+import json
+import time
+
+import codec
+from protocol import HEADER
+
+
+def per_call(function, argument, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function(argument)
+    return (time.perf_counter() - started) / iterations
+
+
+def sample_payloads(text_size):
+    text = "hello there, " * (text_size // 13 + 1)
+    text = text[:text_size]
+    return {
+        # What the server fans out for every chat message
+        "broadcast": {
+            "action": "message", "message": text, "memberName": "alice_Q2xk9fVb3mE",
+            "timestamp": "12:34:56", "sentAt": 1760000000000,
+        },
+        # What a client sends for every chat message
+        "send": {"action": "message", "message": text},
+        "history header": {"action": "history", "channelName": "general", "count": 50},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--text-size", type=int, default=40, help="characters of message text")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    members = codec.MemberIds()
+    for name, data in sample_payloads(args.text_size).items():
+        member_id = members.intern(data["memberName"]) if "memberName" in data else None
+
+        json_payload = json.dumps(data).encode('utf-8')
+        binary_payload = codec.pack_message(data, member_id)
+
+        result = {
+            "payload": name,
+            "json_bytes": HEADER.size + len(json_payload),
+            "binary_bytes": HEADER.size + len(binary_payload),
+            "json_encode_us": round(per_call(lambda d: json.dumps(d).encode('utf-8'), data, args.iterations) * 1e6, 3),
+            "binary_encode_us": round(per_call(lambda d: codec.pack_message(d, member_id), data, args.iterations) * 1e6, 3),
+            "json_decode_us": round(per_call(lambda p: json.loads(p.decode('utf-8')), json_payload, args.iterations) * 1e6, 3),
+            "binary_decode_us": round(per_call(codec.decode, binary_payload, args.iterations) * 1e6, 3),
+        }
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("  ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Helpers shared by the benchmark scripts: server subprocesses, /proc sampling and statistics."""
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# How every JSON chat message the benchmarks send starts, and so every broadcast of one
+MESSAGE_PREFIX = b'{"action": "message"'
+
+
+def raise_fd_limit():
+    """Raise the soft open-file limit to the hard limit (inherited by spawned servers)"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def free_port():
+    """Ask the kernel for an unused TCP port on localhost"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    """Block until something accepts connections on the given port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"server did not start listening on port {port}")
+
+
+def start_server(port, mode="threaded", extra_args=()):
+    """Start server.py in a subprocess and wait until it is accepting connections"""
+    command = [
+        sys.executable, os.path.join(REPO_ROOT, "server.py"),
+        "--host", "127.0.0.1", "--port", str(port), "--mode", mode,
+        *extra_args,
+    ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+    except TimeoutError:
+        process.kill()
+        raise
+    return process
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def read_proc_status(pid, field):
+    """Return an integer field (e.g. VmRSS in kB, Threads) from /proc/<pid>/status"""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def rss_kb(pid):
+    return read_proc_status(pid, "VmRSS")
+
+
+def thread_count(pid):
+    return read_proc_status(pid, "Threads")
+
+
+def cpu_seconds(pid):
+    """User + system CPU time consumed by a process so far"""
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    ticks = int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def chat_messages(payloads):
+    """The chat messages among decoded JSON frames, leaving out presence updates and other notices"""
+    return [payload for payload in payloads if payload.startswith(MESSAGE_PREFIX)]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
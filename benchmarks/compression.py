@@ -0,0 +1,154 @@
+"""
+Benchmark for per-connection compression of what the server sends.
+
+Broadcasts chat messages to a channel of in-process members, through the
+same EncodedMessage and Outbox code the server uses, once per payload size,
+codec and compression mode, writing each member's queue out every --batch
+messages. Reports the bytes on the wire per delivery and the ratio to the
+uncompressed size, the server CPU per message (the whole fan-out) and per
+delivery, and the client's CPU to inflate and split one delivery. The text
+is words drawn with Zipf weights from a small vocabulary, with a few random
+tokens, and the inflated stream of one member is checked against what it
+would have received uncompressed.
+
+    python -m benchmarks.compression --payload-sizes 20 100 500 2000 --members 100
+"""
+import argparse
+import itertools
+import json
+import random
+import string
+import time
+
+import codec
+from codec import BinarySession, MemberIds
+from compression import COMPRESSIONS, STREAM, InflatingDecoder, StreamCompressor
+from fanout import EncodedMessage, Outbox
+from protocol import FrameDecoder
+
+WORDS = (
+    "the to and you it is that of for in this on we have be just can so but not with what do are was"
+    " ok yes no lol thanks please i'll check build deploy server test fix merge review branch release"
+    " meeting today tomorrow later now looks good works for me sure back in a minute anyone seen the"
+    " logs error again after restart channel message latency cpu memory queue config update"
+).split()
+
+
+class Recipient:
+    """The parts of a member's connection that EncodedMessage and Outbox look at"""
+
+    framed = True
+
+    def __init__(self, members, codec_name, compression):
+        self.binary = BinarySession(members) if codec_name == codec.BINARY else None
+        self.compression = compression
+        self.outbox = Outbox(lambda data: EncodedMessage.from_dict(data).for_connection(self))
+        if compression == STREAM:
+            self.outbox.compress(StreamCompressor())
+        self.sent = 0
+        self.wire = None
+
+    def drain(self):
+        while True:
+            chunks = self.outbox.peek_many()
+            if not chunks:
+                return
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                if self.wire is not None:
+                    self.wire += chunk
+            self.outbox.consume(size)
+            self.sent += size
+
+
+def chat_messages(count, payload_size, senders, rng):
+    cumulative = list(itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
+    names = [f"user{index}_{''.join(rng.choices(string.ascii_letters + string.digits, k=11))}"
+             for index in range(senders)]
+    sent_at = int(time.time() * 1000)
+    messages = []
+    for index in range(count):
+        words = []
+        length = 0
+        while length < payload_size:
+            if rng.random() < 0.05:
+                word = "".join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(4, 10)))
+            else:
+                word = rng.choices(WORDS, cum_weights=cumulative)[0]
+            words.append(word)
+            length += len(word) + 1
+        sent_at += rng.randint(1, 2000)
+        messages.append({
+            "action": "message", "message": " ".join(words)[:payload_size],
+            "memberName": rng.choice(names), "timestamp": time.strftime("%H:%M:%S", time.localtime(sent_at / 1000)),
+            "sentAt": sent_at,
+        })
+    return messages
+
+
+def run(messages, members_count, codec_name, compression, batch):
+    """Fans the messages out; returns (recipients, server CPU seconds)"""
+    members = MemberIds()
+    recipients = [Recipient(members, codec_name, compression) for _ in range(members_count)]
+    recipients[0].wire = bytearray()
+
+    started = time.process_time()
+    for index, data in enumerate(messages, 1):
+        message = EncodedMessage(json.dumps(data).encode('utf-8'), data)
+        for recipient in recipients:
+            recipient.outbox.push(message.for_connection(recipient))
+        if index % batch == 0 or index == len(messages):
+            for recipient in recipients:
+                recipient.drain()
+    return recipients, time.process_time() - started
+
+
+def inflate(wire, compression):
+    """Splits (and inflates) one member's stream; returns (payloads, CPU seconds)"""
+    decoder = InflatingDecoder(compression) if compression else FrameDecoder()
+    started = time.process_time()
+    payloads = []
+    for start in range(0, len(wire), 65536):
+        payloads += decoder.feed(bytes(wire[start:start + 65536]))
+    return payloads, time.process_time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[20, 100, 500, 2000],
+                        help="characters of message text")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--members", type=int, default=50, help="members each message is delivered to")
+    parser.add_argument("--senders", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=1,
+                        help="messages queued between writes (1: every message is written on its own)")
+    parser.add_argument("--codecs", nargs="+", choices=codec.CODECS, default=list(codec.CODECS))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for payload_size in args.payload_sizes:
+        messages = chat_messages(args.messages, payload_size, args.senders, random.Random(args.seed))
+        for codec_name in args.codecs:
+            baseline = None
+            for compression in (None, *COMPRESSIONS):
+                recipients, seconds = run(messages, args.members, codec_name, compression, args.batch)
+                payloads, inflate_seconds = inflate(recipients[0].wire, compression)
+                if baseline is None:
+                    baseline = (recipients[0].sent, payloads)
+                assert payloads == baseline[1], f"{compression} changed what a member receives"
+                deliveries = args.messages * args.members
+                print(json.dumps({
+                    "payload_size": payload_size,
+                    "codec": codec_name,
+                    "compression": compression or "none",
+                    "bytes_per_delivery": round(recipients[0].sent / args.messages, 1),
+                    "ratio": round(recipients[0].sent / baseline[0], 3),
+                    "server_us_per_message": round(seconds / args.messages * 1e6, 1),
+                    "server_us_per_delivery": round(seconds / deliveries * 1e6, 2),
+                    "client_us_per_message": round(inflate_seconds / args.messages * 1e6, 2),
+                }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Benchmark for targeted delivery: direct messages to a few members against a channel-wide broadcast.
+
+Joins a large channel, then has the owner send rounds of messages either to
+the whole channel or, with "to", to a handful of named members. Each round
+waits until every expected copy has arrived. Reports bytes sent, deliveries
+and server CPU per message, taken from the metrics endpoint and /proc, and
+send-to-receipt latency percentiles.
+
+    python -m benchmarks.direct --members 2000 --recipients 3
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import cpu_seconds, free_port, percentile, raise_fd_limit, start_server, stop_server
+from benchmarks.engines import DeliveryCounter, count_messages
+from benchmarks.metrics import scrape
+from protocol import FrameDecoder, encode_message
+
+CHANNEL = {"channelName": "bench", "channelPassword": ""}
+
+
+async def join(port, request):
+    """Connect and join; returns the reader, writer and the member name the server assigned"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(encode_message(request))
+    await writer.drain()
+    decoder = FrameDecoder()
+    while True:
+        chunk = await reader.read(4096)
+        if not chunk:
+            raise ConnectionError("server closed the connection during the handshake")
+        for payload in decoder.feed(chunk):
+            reply = json.loads(payload)
+            if reply["action"] == "joinChannel":
+                return reader, writer, reply["memberName"]
+
+
+async def run(mode, members, recipients, rounds, concurrency):
+    port = free_port()
+    metrics_port = free_port()
+    process = start_server(port, mode, [
+        "--stats-interval", "0", "--log-level", "warning", "--metrics", f"tcp:127.0.0.1:{metrics_port}",
+    ])
+    writers = []
+    tasks = []
+    try:
+        owner_reader, owner, _ = await join(port, {"action": "createChannel", **CHANNEL, "memberName": "owner"})
+        writers.append(owner)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def join_member(index):
+            async with semaphore:
+                return await join(port, {"action": "joinChannel", **CHANNEL, "memberName": f"member{index}"})
+
+        joined = await asyncio.gather(*(join_member(index) for index in range(members)))
+        writers.extend(writer for _, writer, _ in joined)
+        names = [name for _, _, name in joined]
+
+        counter = DeliveryCounter()
+        readers = [owner_reader, *(reader for reader, _, _ in joined)]
+        tasks = [asyncio.create_task(count_messages(reader, counter)) for reader in readers]
+        await asyncio.sleep(0.5)
+
+        results = []
+        for how in ("broadcast", "direct"):
+            message = {"action": "message", "message": "x" * 64}
+            if how == "direct":
+                message["to"] = names[:recipients]
+                # The recipients, plus the sender's own copy
+                copies = recipients + 1
+            else:
+                copies = members + 1
+
+            before, _ = scrape(metrics_port)
+            cpu_before = cpu_seconds(process.pid)
+            latencies = []
+            for _ in range(rounds):
+                counter.expect(counter.delivered + copies)
+                started = time.perf_counter()
+                owner.write(encode_message(message))
+                await owner.drain()
+                await asyncio.wait_for(counter.reached.wait(), timeout=60)
+                latencies.append(time.perf_counter() - started)
+            cpu = cpu_seconds(process.pid) - cpu_before
+            after, _ = scrape(metrics_port)
+
+            sent = after["chat_messages_sent_total"] - before["chat_messages_sent_total"]
+            bytes_sent = after["chat_bytes_sent_total"] - before["chat_bytes_sent_total"]
+            results.append({
+                "mode": mode,
+                "send": how,
+                "members": members + 1,
+                "recipients": copies,
+                "deliveries_per_msg": round(sent / rounds, 1),
+                "bytes_sent_per_msg": round(bytes_sent / rounds),
+                "server_cpu_us_per_msg": round(cpu / rounds * 1e6, 1),
+                "latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            })
+        return results
+    finally:
+        for task in tasks:
+            task.cancel()
+        for writer in writers:
+            writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=3, help="members named in each direct message")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=200, help="maximum number of handshakes in flight")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        for result in asyncio.run(run(mode, args.members, args.recipients, args.rounds, args.concurrency)):
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Load benchmark comparing the threaded and asyncio server engines.
+
+Opens a large number of idle channel members against each engine, then samples
+the server's memory and thread count and times a series of broadcasts to every
+member.
+
+    python -m benchmarks.engines --members 10000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import (
+    chat_messages, free_port, percentile, raise_fd_limit, rss_kb, start_server, stop_server, thread_count
+)
+from protocol import FrameDecoder, encode_message
+
+
+class DeliveryCounter:
+    """Counts broadcast deliveries across all members and wakes waiters at a target"""
+
+    def __init__(self):
+        self.delivered = 0
+        self.target = None
+        self.reached = asyncio.Event()
+
+    def add(self, count):
+        self.delivered += count
+        if self.target is not None and self.delivered >= self.target:
+            self.reached.set()
+
+    def expect(self, target):
+        self.target = target
+        self.reached.clear()
+        if self.delivered >= target:
+            self.reached.set()
+
+
+async def open_member(port, request):
+    """Connect, perform the handshake and return the stream pair once joined"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(encode_message(request))
+    await writer.drain()
+    decoder = FrameDecoder()
+    while True:
+        chunk = await reader.read(4096)
+        if not chunk:
+            raise ConnectionError("server closed the connection during the handshake")
+        for payload in decoder.feed(chunk):
+            if json.loads(payload)["action"] == "joinChannel":
+                return reader, writer
+
+
+async def count_messages(reader, counter):
+    """Count broadcast messages arriving on one member connection"""
+    decoder = FrameDecoder()
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        counter.add(len(chat_messages(decoder.feed(chunk))))
+
+
+async def run_engine(mode, members, rounds, concurrency):
+    port = free_port()
+    process = start_server(port, mode)
+    writers = []
+    readers = []
+    try:
+        await asyncio.sleep(0.2)
+        baseline_rss = rss_kb(process.pid)
+
+        channel = {"channelName": "bench", "channelPassword": "", "memberName": "owner"}
+        owner_reader, owner_writer = await open_member(port, {"action": "createChannel", **channel})
+        writers.append(owner_writer)
+        readers.append(owner_reader)
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def join(index):
+            async with semaphore:
+                return await open_member(port, {
+                    "action": "joinChannel", **channel, "memberName": f"member{index}"
+                })
+
+        started = time.perf_counter()
+        for reader, writer in await asyncio.gather(*(join(i) for i in range(members))):
+            readers.append(reader)
+            writers.append(writer)
+        connect_seconds = time.perf_counter() - started
+
+        await asyncio.sleep(0.5)
+        joined_rss = rss_kb(process.pid)
+        threads = thread_count(process.pid)
+
+        counter = DeliveryCounter()
+        tasks = [asyncio.create_task(count_messages(reader, counter)) for reader in readers]
+
+        latencies = []
+        recipients = len(readers)
+        for round_number in range(1, rounds + 1):
+            counter.expect(recipients * round_number)
+            started = time.perf_counter()
+            owner_writer.write(encode_message({"action": "message", "message": f"ping {round_number}"}))
+            await owner_writer.drain()
+            await asyncio.wait_for(counter.reached.wait(), timeout=60)
+            latencies.append(time.perf_counter() - started)
+
+        for task in tasks:
+            task.cancel()
+
+        return {
+            "mode": mode,
+            "members": recipients,
+            "connects_per_sec": round(members / connect_seconds, 1),
+            "rss_mb": round(joined_rss / 1024, 1),
+            "rss_per_member_kb": round((joined_rss - baseline_rss) / recipients, 2),
+            "threads": threads,
+            "broadcast_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "broadcast_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=200,
+                        help="maximum number of handshakes in flight")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        result = asyncio.run(run_engine(mode, args.members, args.rounds, args.concurrency))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("  ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Throughput benchmark for the length-prefixed wire protocol.
+
+First measures the raw FrameDecoder on a stream chopped into random read sizes,
+then pipelines thousands of messages over a single connection to a live server
+and checks every one arrives intact at a second member.
+
+    python -m benchmarks.framing --messages 20000 --payload-size 2048
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from benchmarks.common import chat_messages, free_port, raise_fd_limit, start_server, stop_server
+from benchmarks.engines import open_member
+from protocol import FrameDecoder, encode_frame, encode_message
+
+
+def bench_decoder(messages, payload_size, seed=1):
+    """Decode a pre-built stream split at random offsets"""
+    payload = b"x" * payload_size
+    stream = encode_frame(payload) * messages
+    rng = random.Random(seed)
+    chunks = []
+    offset = 0
+    while offset < len(stream):
+        size = rng.randint(1, 8192)
+        chunks.append(stream[offset:offset + size])
+        offset += size
+
+    decoder = FrameDecoder()
+    decoded = 0
+    started = time.perf_counter()
+    for chunk in chunks:
+        for frame in decoder.feed(chunk):
+            if frame != payload:
+                raise AssertionError("decoder returned a corrupted frame")
+            decoded += 1
+    elapsed = time.perf_counter() - started
+
+    if decoded != messages:
+        raise AssertionError(f"decoded {decoded} of {messages} frames")
+    return {
+        "stage": "decoder",
+        "messages": messages,
+        "payload_size": payload_size,
+        "reads": len(chunks),
+        "messages_per_sec": round(messages / elapsed),
+        "mb_per_sec": round(len(stream) / elapsed / 1e6, 1),
+    }
+
+
+async def drain(reader, expected, received):
+    """Decode frames from one member until the expected number of broadcasts arrived"""
+    decoder = FrameDecoder()
+    while received[0] < expected:
+        chunk = await reader.read(65536)
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        for payload in chat_messages(decoder.feed(chunk)):
+            json.loads(payload)
+            received[0] += 1
+
+
+async def bench_pipeline(mode, messages, payload_size, batch):
+    port = free_port()
+    process = start_server(port, mode)
+    writers = []
+    try:
+        channel = {"channelName": "framing", "channelPassword": "", "memberName": "sender"}
+        sender_reader, sender_writer = await open_member(port, {"action": "createChannel", **channel})
+        receiver_reader, receiver_writer = await open_member(port, {"action": "joinChannel", **channel})
+        writers = [sender_writer, receiver_writer]
+
+        text = "y" * payload_size
+        sender_count = [0]
+        receiver_count = [0]
+        drains = [
+            asyncio.create_task(drain(sender_reader, messages, sender_count)),
+            asyncio.create_task(drain(receiver_reader, messages, receiver_count)),
+        ]
+
+        started = time.perf_counter()
+        for first in range(0, messages, batch):
+            frames = b"".join(
+                encode_message({"action": "message", "message": text, "seq": seq})
+                for seq in range(first, min(messages, first + batch))
+            )
+            sender_writer.write(frames)
+            await sender_writer.drain()
+        await asyncio.wait_for(asyncio.gather(*drains), timeout=300)
+        elapsed = time.perf_counter() - started
+
+        return {
+            "stage": "pipeline",
+            "mode": mode,
+            "messages": messages,
+            "payload_size": payload_size,
+            "delivered": receiver_count[0],
+            "messages_per_sec": round(messages / elapsed),
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--payload-size", type=int, default=2048)
+    parser.add_argument("--batch", type=int, default=100,
+                        help="messages written per send call on the pipelined connection")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    results = [bench_decoder(args.messages, args.payload_size)]
+    for mode in args.modes:
+        results.append(asyncio.run(bench_pipeline(mode, args.messages, args.payload_size, args.batch)))
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("  ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
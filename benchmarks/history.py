@@ -0,0 +1,105 @@
+"""
+Benchmark for the persistent channel history log.
+
+Appends messages to a ChannelLog, then times "last N" and "since T" replays
+served from the memory-mapped segments, and how long it takes to reopen
+(recover) the log.
+
+    python -m benchmarks.history --messages 200000 --replay 1000 5000
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+from benchmarks.common import percentile
+from fanout import EncodedMessage
+from history import ChannelLog, MessageLog
+from protocol import FrameDecoder
+
+
+def timed(function, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - started)
+    return result, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--payload-size", type=int, default=100)
+    parser.add_argument("--segment-mb", type=float, default=8)
+    parser.add_argument("--replay", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="chat-history-")
+    segment_bytes = int(args.segment_mb * 1024 * 1024)
+    try:
+        # The log alone; benchmarks.search measures the search index
+        history = MessageLog(directory, segment_bytes=segment_bytes, search_bytes=0)
+        log = history.channel("bench")
+
+        text = "h" * args.payload_size
+        base_time = int(time.time() * 1000)
+        frames = [
+            EncodedMessage.from_dict({
+                "action": "message", "message": text, "memberName": "bench_member",
+                "timestamp": "12:00:00", "sentAt": base_time + index,
+            }).framed
+            for index in range(args.messages)
+        ]
+
+        started = time.perf_counter()
+        for index, frame in enumerate(frames):
+            log.append(frame, base_time + index)
+        history.sync()
+        elapsed = time.perf_counter() - started
+        print(json.dumps({
+            "stage": "append",
+            "messages": args.messages,
+            "segments": len(log.segments),
+            "appends_per_sec": round(args.messages / elapsed),
+        }))
+
+        for count in args.replay:
+            batch, samples = timed(lambda: log.read_last(count), args.repeat)
+            decoded = FrameDecoder(max_frame_size=len(batch.framed) + 1).feed(batch.framed)
+            assert len(decoded) == batch.count == min(count, args.messages)
+            print(json.dumps({
+                "stage": "read_last",
+                "messages": batch.count,
+                "bytes": len(batch.framed),
+                "p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "p99_ms": round(percentile(samples, 99) * 1000, 3),
+            }))
+
+            since = base_time + args.messages - count
+            batch, samples = timed(lambda: log.read_since(since, count), args.repeat)
+            assert batch.count == min(count, args.messages)
+            print(json.dumps({
+                "stage": "read_since",
+                "messages": batch.count,
+                "p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "p99_ms": round(percentile(samples, 99) * 1000, 3),
+            }))
+
+        history.close()
+        started = time.perf_counter()
+        reopened = ChannelLog(log.directory, segment_bytes, search_bytes=0)
+        elapsed = time.perf_counter() - started
+        assert reopened.next_offset == args.messages
+        print(json.dumps({"stage": "recover", "segments": len(reopened.segments),
+                          "ms": round(elapsed * 1000, 2)}))
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
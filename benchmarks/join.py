@@ -0,0 +1,118 @@
+"""
+Benchmark for the join handshake, as in a reconnect storm.
+
+First times the pieces of a join in-process: generating a member id the old
+way (a fresh secrets call plus a uniqueness probe) against taking one from
+the registry's IdPool, and checking a channel password in plain text,
+through PBKDF2, and through the PasswordCache. Then has many concurrent
+clients join a channel over real sockets and leave again, and reports
+joins per second and join latency for an open and a password-protected
+channel.
+
+    python -m benchmarks.join --joins 5000 --concurrency 200
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import time
+import timeit
+
+from benchmarks.common import free_port, percentile, raise_fd_limit, start_server, stop_server
+from benchmarks.engines import open_member
+from tools import IdPool, PasswordCache, generate_secure_user_id, hash_password, verify_password
+
+
+def micro(calls):
+    """Microseconds per call of each handshake step, old and new"""
+    members = {f"member_{generate_secure_user_id(8)}": None for _ in range(1000)}
+
+    def old_member_id():
+        name = f"member_{generate_secure_user_id(8)}"
+        count = 0
+        original = name
+        while name in members:
+            count += 1
+            name = f"{original}_{count}"
+        return name
+
+    # A join only allocates; the release happens when the member leaves
+    pool = IdPool(8, size=calls)
+
+    def pooled_member_id():
+        return f"member_{pool.allocate()}"
+
+    stored = hash_password("secret")
+    cache = PasswordCache()
+    cache.check("secret", stored)
+
+    def per_call(function, number):
+        return round(min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6, 2)
+
+    return {
+        "member_id_secrets_us": per_call(old_member_id, calls),
+        "member_id_pool_us": per_call(pooled_member_id, calls // 4),
+        "password_plain_us": per_call(lambda: hmac.compare_digest("secret", "secret"), calls),
+        "password_pbkdf2_us": per_call(lambda: verify_password("secret", stored), 10),
+        "password_cached_us": per_call(lambda: cache.check("secret", stored), calls),
+    }
+
+
+async def join_storm(port, password, joins, concurrency):
+    """Join and leave `joins` times with `concurrency` clients at once; returns join latencies"""
+    latencies = []
+    remaining = iter(range(joins))
+
+    async def client():
+        for index in remaining:
+            started = time.perf_counter()
+            _, writer = await open_member(port, {
+                "action": "joinChannel", "channelName": "bench", "channelPassword": password,
+                "memberName": f"member{index}",
+            })
+            latencies.append(time.perf_counter() - started)
+            writer.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies
+
+
+async def run(mode, password, joins, concurrency):
+    port = free_port()
+    process = start_server(port, mode, ["--stats-interval", "0", "--log-level", "warning"])
+    try:
+        _, owner = await open_member(port, {
+            "action": "createChannel", "channelName": "bench", "channelPassword": password, "memberName": "owner"
+        })
+        started = time.perf_counter()
+        latencies = await join_storm(port, password, joins, concurrency)
+        elapsed = time.perf_counter() - started
+        owner.close()
+        return {
+            "mode": mode,
+            "password": bool(password),
+            "joins_per_sec": round(joins / elapsed),
+            "join_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "join_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        }
+    finally:
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--joins", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--calls", type=int, default=100000, help="calls per in-process measurement")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(json.dumps(micro(args.calls)))
+    for mode in args.modes:
+        for password in ("", "secret"):
+            print(json.dumps(asyncio.run(run(mode, password, args.joins, args.concurrency))))
+
+
+if __name__ == "__main__":
+    main()
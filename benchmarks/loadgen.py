@@ -0,0 +1,395 @@
+"""
+Reproducible load generator for the chat server.
+
+Simulates channels full of members speaking the normal createChannel /
+joinChannel / message protocol. Every member is a ClientCore, the chat
+client's own networking core without the curses UI, and each load process
+runs all of its members on one event loop.
+
+Senders follow a fixed, open-loop schedule (--rate messages per second per
+channel) and stamp each message with the time it was due to be sent, so a
+stalled server shows up as latency instead of silently lowering the rate.
+Every member records the end-to-end latency of every message it receives.
+Payloads come from a seeded generator, so two runs with the same arguments
+send exactly the same bytes.
+
+The result is a single JSON object: the configuration plus the connect rate,
+delivery latency percentiles, throughput, and the server's RSS and CPU use.
+With --output it is also appended to a JSON-lines file; --compare checks it
+against the last result with the same configuration in such a file and
+exits non-zero on a regression.
+
+    python -m benchmarks.loadgen --channels 10 --members 200 --rate 20 --duration 20
+    python -m benchmarks.loadgen --mode async --output results.jsonl --compare results.jsonl
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import string
+import sys
+import threading
+import time
+from array import array
+
+import codec
+from benchmarks.common import (
+    cpu_seconds, free_port, percentile, raise_fd_limit, rss_kb, start_server, stop_server
+)
+from client_core import CLOSED, FAILED, ClientCore
+
+MARKER = "lg:"
+
+# Metric name -> True if a higher value is better
+COMPARED = {
+    "connects_per_sec": True,
+    "deliveries_per_sec": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "server_cpu_percent": False,
+    "server_rss_peak_mb": False,
+}
+
+
+def member_slots(config, worker):
+    """The (channel, member) pairs a load process is responsible for"""
+    slots = []
+    for channel in range(config["channels"]):
+        for member in range(config["members"]):
+            if (channel * config["members"] + member) % config["processes"] == worker:
+                slots.append((channel, member))
+    return slots
+
+
+def make_payloads(config, channel, count=64):
+    """Deterministic filler text for one channel's messages"""
+    generator = random.Random(f"{config['seed']}-{channel}")
+    size = max(0, config["payload_size"] - len(MARKER) - 20)
+    alphabet = string.ascii_letters + string.digits + " "
+    return ["".join(generator.choice(alphabet) for _ in range(size)) for _ in range(count)]
+
+
+class LoadProcess:
+    """The members handled by one load-generating process, all on one event loop"""
+
+    def __init__(self, host, port, config, worker):
+        self.host = host
+        self.port = port
+        self.config = config
+        self.slots = member_slots(config, worker)
+        self.loop = asyncio.new_event_loop()
+        self.cores = []
+        self.senders = []
+        self.handshake_seconds = []
+        self.latencies = array("d")
+        self.start = None
+        self.running = False
+        self.last_delivery = 0.0
+        self.sent = 0
+        self.received = 0
+        self.disconnects = 0
+
+    def on_event(self, event):
+        action = event.get("action")
+        if action == "message":
+            message = event.get("message", "")
+            if not message.startswith(MARKER):
+                return
+            now = time.monotonic()
+            sent_at = float(message[len(MARKER):message.index(":", len(MARKER))])
+            self.received += 1
+            self.last_delivery = now
+            if sent_at >= self.start + self.config["warmup"]:
+                self.latencies.append(now - sent_at)
+        elif action == "status" and event["state"] in (CLOSED, FAILED) and self.running:
+            self.disconnects += 1
+
+    async def handshake(self, semaphore, channel, member):
+        """Connect one member and create or join its channel"""
+        async with semaphore:
+            started = time.perf_counter()
+            core = ClientCore(
+                self.host, self.port, self.config["codec"], on_event=self.on_event, loop=self.loop, reconnect=False
+            )
+            action = "createChannel" if member == 0 else "joinChannel"
+            reply = await asyncio.wrap_future(core.start(action, f"load-{channel}", "", f"m{channel}-{member}"))
+            if not reply.get("success", False):
+                print(f"loadgen: m{channel}-{member} could not join: {reply.get('message')}", file=sys.stderr)
+                return
+            self.cores.append(core)
+            self.handshake_seconds.append(time.perf_counter() - started)
+            if member < self.config["senders"]:
+                self.senders.append((channel, core))
+
+    async def connect_all(self, slots):
+        semaphore = asyncio.Semaphore(self.config["concurrency"])
+        await asyncio.gather(*(self.handshake(semaphore, channel, member) for channel, member in slots))
+
+    def connect(self, slots):
+        self.loop.run_until_complete(self.connect_all(slots))
+
+    async def send_and_drain(self):
+        """Send on schedule until the run ends, then wait for what is still in flight"""
+        config = self.config
+        end = self.start + config["duration"]
+        interval = config["senders"] / config["rate"]
+        payloads = {channel: make_payloads(config, channel) for channel, _ in self.senders}
+        # Spread the senders over one interval so they do not all fire at once
+        schedule = [
+            [self.start + interval * index / max(1, len(self.senders)), channel, core, 0]
+            for index, (channel, core) in enumerate(self.senders)
+        ]
+
+        await asyncio.sleep(max(0.0, self.start - time.monotonic()))
+        while True:
+            now = time.monotonic()
+            for entry in schedule:
+                while entry[0] <= now and entry[0] < end:
+                    due, channel, core, count = entry
+                    text = payloads[channel][count % len(payloads[channel])]
+                    core.send(f"{MARKER}{due:.6f}:{text}")
+                    self.sent += 1
+                    entry[0] += interval
+                    entry[3] += 1
+            pending = [entry[0] for entry in schedule if entry[0] < end]
+            if not pending:
+                break
+            await asyncio.sleep(max(0.0, min(pending) - time.monotonic()))
+
+        self.last_delivery = time.monotonic()
+        while time.monotonic() - self.last_delivery < config["drain"]:
+            await asyncio.sleep(0.05)
+
+    def run(self, start):
+        self.start = start
+        self.running = True
+        self.loop.run_until_complete(self.send_and_drain())
+        self.running = False
+        for core in self.cores:
+            core.close()
+        # Let the closes go out
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+        self.loop.close()
+
+    def result(self):
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "disconnects": self.disconnects,
+            "handshake_seconds": self.handshake_seconds,
+            "latencies": self.latencies.tobytes(),
+        }
+
+
+def load_process(host, port, config, worker, barrier, start_time, results):
+    """Entry point of one load process; moves through the phases in step with the others"""
+    load = LoadProcess(host, port, config, worker)
+    try:
+        # Creators first, so every channel exists before anybody joins it
+        load.connect([slot for slot in load.slots if slot[1] == 0])
+        barrier.wait()
+        load.connect([slot for slot in load.slots if slot[1] != 0])
+        barrier.wait()
+        barrier.wait()
+        load.run(start_time.value)
+    except BaseException:
+        # Release everybody waiting on this process instead of hanging the run
+        barrier.abort()
+        raise
+    results.put(load.result())
+
+
+class ServerSampler:
+    """Samples the server's peak RSS in the background"""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.peak = rss_kb(pid)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, args=(interval,), daemon=True)
+        self.thread.start()
+
+    def sample(self, interval):
+        while not self.stopped.wait(interval):
+            self.peak = max(self.peak, rss_kb(self.pid))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+
+def run(config, server_args, address=None, server_pid=None):
+    """Drive one load test and return its result"""
+    process = None
+    if address is None:
+        host, port = "127.0.0.1", free_port()
+        process = start_server(port, config["server_mode"], ["--stats-interval", "0", *server_args])
+        server_pid = process.pid
+        time.sleep(0.2)
+    else:
+        host, port = address.rsplit(":", 1)
+        port = int(port)
+
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(config["processes"] + 1)
+    start_time = context.Value("d", 0.0)
+    results = context.Queue()
+    workers = [
+        context.Process(target=load_process, args=(host, port, config, worker, barrier, start_time, results))
+        for worker in range(config["processes"])
+    ]
+    try:
+        baseline_rss = rss_kb(server_pid) if server_pid else 0
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        barrier.wait()
+        barrier.wait()
+        connect_seconds = time.perf_counter() - started
+
+        joined_rss = rss_kb(server_pid) if server_pid else 0
+        sampler = ServerSampler(server_pid) if server_pid else None
+        start_time.value = time.monotonic() + 0.2
+        barrier.wait()
+
+        # CPU is measured over the steady part of the run only
+        time.sleep(max(0.0, start_time.value + config["warmup"] - time.monotonic()))
+        cpu_before = cpu_seconds(server_pid) if server_pid else 0.0
+        time.sleep(max(0.0, start_time.value + config["duration"] - time.monotonic()))
+        cpu_used = cpu_seconds(server_pid) - cpu_before if server_pid else 0.0
+
+        collected = [results.get(timeout=config["duration"] + config["drain"] + 60) for _ in workers]
+        for worker in workers:
+            worker.join()
+        peak_rss = sampler.stop() if sampler else 0
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        if process is not None:
+            stop_server(process)
+
+    latencies = array("d")
+    handshakes = []
+    for result in collected:
+        latencies.frombytes(result["latencies"])
+        handshakes.extend(result["handshake_seconds"])
+    sent = sum(result["sent"] for result in collected)
+    received = sum(result["received"] for result in collected)
+    members = config["channels"] * config["members"]
+    measured_seconds = config["duration"] - config["warmup"]
+
+    return {
+        "config": config,
+        "members": members,
+        "connect_errors": members - len(handshakes),
+        "connects_per_sec": round(len(handshakes) / connect_seconds, 1),
+        "handshake_p99_ms": round(percentile(handshakes, 99) * 1000, 2),
+        "disconnects": sum(result["disconnects"] for result in collected),
+        "messages_sent": sent,
+        "deliveries": received,
+        "delivery_ratio": round(received / max(1, sent * config["members"]), 4),
+        "messages_per_sec": round(sent / config["duration"], 1),
+        "deliveries_per_sec": round(len(latencies) / measured_seconds, 1),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "latency_p90_ms": round(percentile(latencies, 90) * 1000, 3),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "latency_max_ms": round(max(latencies, default=0.0) * 1000, 3),
+        "server_rss_baseline_mb": round(baseline_rss / 1024, 1),
+        "server_rss_joined_mb": round(joined_rss / 1024, 1),
+        "server_rss_peak_mb": round(peak_rss / 1024, 1),
+        "server_cpu_percent": round(cpu_used / measured_seconds * 100, 1),
+    }
+
+
+def compare(result, path, tolerance):
+    """Compare against the last result with the same configuration; returns the regressions"""
+    previous = None
+    if os.path.exists(path):
+        with open(path) as results:
+            for line in results:
+                record = json.loads(line)
+                if record.get("config") == result["config"]:
+                    previous = record
+    if previous is None:
+        print(f"loadgen: no earlier result with this configuration in {path}", file=sys.stderr)
+        return []
+
+    regressions = []
+    for name, higher_is_better in COMPARED.items():
+        before, after = previous.get(name), result.get(name)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        print(f"{name}: {before} -> {after} ({change:+.1%})", file=sys.stderr)
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--server", metavar="HOST:PORT",
+                        help="load an already running server instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="pid of --server, to sample its RSS and CPU")
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded",
+                        help="engine of the server started for the run")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--members", type=int, default=100, help="members per channel")
+    parser.add_argument("--senders", type=int, default=1, help="members per channel that send")
+    parser.add_argument("--rate", type=float, default=10, help="messages per second per channel")
+    parser.add_argument("--payload-size", type=int, default=100, help="characters per message")
+    parser.add_argument("--codec", choices=codec.CODECS, default=codec.BINARY)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending")
+    parser.add_argument("--warmup", type=float, default=2,
+                        help="seconds at the start of the run left out of latency and throughput")
+    parser.add_argument("--drain", type=float, default=1,
+                        help="seconds without traffic after the run before giving up on stragglers")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="load-generating processes the members are spread over")
+    parser.add_argument("--concurrency", type=int, default=50, help="handshakes in flight per process")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="append the result to this JSON-lines file")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare with the last result of the same configuration in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative change treated as a regression by --compare")
+    parser.add_argument("server_args", nargs="*", help="extra arguments for server.py, after --")
+    args = parser.parse_args()
+    if args.warmup >= args.duration:
+        parser.error("--warmup must be shorter than --duration")
+
+    config = {
+        "server_mode": args.mode if args.server is None else "external",
+        "server_args": args.server_args,
+        "channels": args.channels,
+        "members": args.members,
+        "senders": min(args.senders, args.members),
+        "rate": args.rate,
+        "payload_size": args.payload_size,
+        "codec": args.codec,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "drain": args.drain,
+        "processes": args.processes,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+    }
+    raise_fd_limit()
+    result = run(config, args.server_args, args.server, args.server_pid)
+
+    regressions = compare(result, args.compare, args.tolerance) if args.compare else []
+    print(json.dumps(result))
+    if args.output:
+        with open(args.output, "a") as output:
+            output.write(json.dumps(result) + "\n")
+    if regressions:
+        print(f"loadgen: regression in {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark for the metrics endpoint and the cost of logging on the hot path.
+
+Joins members to one channel, pipelines broadcasts through the server and
+then scrapes the metrics endpoint, checking that the message counters match
+what the clients saw. Each run is repeated at several log levels: with
+debug, every received message is logged, which shows what the rate limiter
+and the background log writer cost the broadcasting thread.
+
+    python -m benchmarks.metrics --members 200 --messages 2000
+"""
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import time
+
+from benchmarks.common import free_port, raise_fd_limit, start_server, stop_server
+from benchmarks.engines import DeliveryCounter, count_messages, open_member
+from protocol import encode_message
+
+
+def scrape(port):
+    """Fetch /metrics and return the samples as a dict, plus how long the request took"""
+    started = time.perf_counter()
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response += data
+    elapsed = time.perf_counter() - started
+
+    header, _, body = response.partition(b"\r\n\r\n")
+    if not header.startswith(b"HTTP/1.0 200"):
+        raise RuntimeError(f"unexpected scrape response: {header[:80]!r}")
+    samples = {}
+    for line in body.decode('utf-8').splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples, elapsed
+
+
+def histogram_quantile(samples, name, quantile):
+    """Upper bound of the bucket holding the given quantile"""
+    buckets = sorted(
+        (float(key.split('le="')[1].rstrip('"}')), value)
+        for key, value in samples.items() if key.startswith(name + "_bucket{")
+    )
+    total = samples.get(name + "_count", 0)
+    for bound, count in buckets:
+        if count >= quantile * total:
+            return bound
+    return float("inf")
+
+
+async def run(mode, log_level, members, messages):
+    port = free_port()
+    metrics_port = free_port()
+    process = start_server(port, mode, [
+        "--stats-interval", "0", "--log-level", log_level,
+        "--send-queue", str(messages + 16),
+        "--metrics", f"tcp:127.0.0.1:{metrics_port}",
+    ])
+    writers = []
+    try:
+        channel = {"channelName": "bench", "channelPassword": "", "memberName": "owner"}
+        owner_reader, owner_writer = await open_member(port, {"action": "createChannel", **channel})
+        readers = [owner_reader]
+        writers.append(owner_writer)
+        for index in range(members - 1):
+            reader, writer = await open_member(port, {
+                "action": "joinChannel", **channel, "memberName": f"member{index}"
+            })
+            readers.append(reader)
+            writers.append(writer)
+
+        counter = DeliveryCounter()
+        tasks = [asyncio.create_task(count_messages(reader, counter)) for reader in readers]
+        counter.expect(messages * members)
+
+        started = time.perf_counter()
+        for index in range(messages):
+            owner_writer.write(encode_message({"action": "message", "message": f"message {index}"}))
+        await owner_writer.drain()
+        await asyncio.wait_for(counter.reached.wait(), timeout=120)
+        elapsed = time.perf_counter() - started
+        for task in tasks:
+            task.cancel()
+
+        samples, scrape_seconds = scrape(metrics_port)
+        received = samples["chat_messages_received_total"]
+        sent = samples["chat_messages_sent_total"]
+        if received != messages or sent != messages * members:
+            raise RuntimeError(f"metrics disagree with clients: received={received} sent={sent}")
+
+        return {
+            "mode": mode,
+            "log_level": log_level,
+            "members": members,
+            "deliveries_per_sec": round(messages * members / elapsed),
+            "connections": samples["chat_connections"],
+            "bytes_sent": samples["chat_bytes_sent_total"],
+            "fanout_p50_ms": histogram_quantile(samples, "chat_fanout_latency_seconds", 0.5) * 1000,
+            "fanout_p99_ms": histogram_quantile(samples, "chat_fanout_latency_seconds", 0.99) * 1000,
+            "scrape_ms": round(scrape_seconds * 1000, 2),
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--log-levels", nargs="+", default=["warning", "debug"])
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        for log_level in args.log_levels:
+            try:
+                result = asyncio.run(run(mode, log_level, args.members, args.messages))
+            except RuntimeError as e:
+                print(f"{mode}/{log_level}: {e}", file=sys.stderr)
+                sys.exit(1)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
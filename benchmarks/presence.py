@@ -0,0 +1,178 @@
+"""
+Benchmark for coalesced presence updates against forwarding every keystroke.
+
+For each server engine, fills a channel with --members members, of which
+--typists report typing --keystrokes times per second each for --seconds,
+as clients that did no debouncing of their own would. Reports what one
+member receives per second, frames and bytes, and the server CPU per
+second. The same load is then sent as chat messages, which is what
+broadcasting each keystroke through the message path would cost.
+
+Then --joins more members join the full channel one at a time, with
+presence on and with it off, and the join latency and the size of the join
+reply (which carries the roster) are reported.
+
+    python -m benchmarks.presence --members 500 --typists 20 --keystrokes 5
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import cpu_seconds, free_port, percentile, raise_fd_limit, start_server, stop_server
+from benchmarks.engines import open_member
+from protocol import FrameDecoder, encode_message
+
+
+class Receiver:
+    """Counts the frames and bytes arriving on one member connection, by action"""
+
+    def __init__(self):
+        self.frames = {}
+        self.bytes = 0
+
+    async def run(self, reader):
+        decoder = FrameDecoder()
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                return
+            self.bytes += len(chunk)
+            for payload in decoder.feed(chunk):
+                action = json.loads(payload).get("action")
+                self.frames[action] = self.frames.get(action, 0) + 1
+
+    def reset(self):
+        self.frames = {}
+        self.bytes = 0
+
+
+async def type_away(writer, frame, rate, seconds):
+    """Writes frame rate times per second for seconds"""
+    started = time.perf_counter()
+    sent = 0
+    while True:
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds:
+            return
+        due = int(elapsed * rate) + 1
+        while sent < due:
+            writer.write(frame)
+            sent += 1
+        await writer.drain()
+        await asyncio.sleep(max(0.0, due / rate - (time.perf_counter() - started)))
+
+
+async def load(process, members, typists, frame, args):
+    """Runs one stage of typing; returns what a quiet member received per second"""
+    receiver, _ = members[-1]
+    await asyncio.sleep(args.interval * 2)
+    receiver.reset()
+    cpu = cpu_seconds(process.pid)
+    started = time.perf_counter()
+    await asyncio.gather(*(type_away(writer, frame, args.keystrokes, args.seconds) for writer in typists))
+    # Let the last update go out
+    await asyncio.sleep(args.interval * 1.5)
+    elapsed = time.perf_counter() - started
+    return {
+        "frames_per_member_per_sec": round(sum(receiver.frames.values()) / elapsed, 2),
+        "bytes_per_member_per_sec": round(receiver.bytes / elapsed),
+        "server_cpu_percent": round((cpu_seconds(process.pid) - cpu) / elapsed * 100, 1),
+    }
+
+
+async def join_latency(port, joins):
+    """Joins members one at a time; returns (latencies, reply sizes)"""
+    latencies = []
+    sizes = []
+    writers = []
+    for index in range(joins):
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(encode_message({"action": "joinChannel", "channelName": "bench", "channelPassword": "",
+                                     "memberName": f"late{index}"}))
+        decoder = FrameDecoder()
+        reply = None
+        while reply is None:
+            for payload in decoder.feed(await reader.read(65536)):
+                if json.loads(payload).get("action") == "joinChannel":
+                    reply = payload
+                    break
+        latencies.append(time.perf_counter() - started)
+        sizes.append(len(reply))
+        writers.append(writer)
+    for writer in writers:
+        writer.close()
+    return latencies, sizes
+
+
+async def run(mode, args):
+    results = []
+    for interval in (args.interval, 0):
+        port = free_port()
+        process = start_server(port, mode, [
+            "--stats-interval", "0", "--log-level", "warning", "--session-grace", "0",
+            "--presence-interval", str(interval), "--send-queue", "100000",
+        ])
+        writers = []
+        tasks = []
+        try:
+            members = []
+            for index in range(args.members):
+                action = "createChannel" if index == 0 else "joinChannel"
+                reader, writer = await open_member(port, {
+                    "action": action, "channelName": "bench", "channelPassword": "", "memberName": f"member{index}"
+                })
+                receiver = Receiver()
+                tasks.append(asyncio.create_task(receiver.run(reader)))
+                members.append((receiver, writer))
+                writers.append(writer)
+            typists = [writer for _, writer in members[:args.typists]]
+
+            if interval:
+                stage = await load(process, members, typists,
+                                   encode_message({"action": "presence", "state": "typing"}), args)
+                results.append(dict(stage, stage="typing", mode=mode, presence="coalesced",
+                                    forwarded_frames_per_sec=args.typists * args.keystrokes))
+                stage = await load(process, members, typists,
+                                   encode_message({"action": "message", "message": "typing"}), args)
+                results.append(dict(stage, stage="typing", mode=mode, presence="broadcast"))
+
+            latencies, sizes = await join_latency(port, args.joins)
+            results.append({
+                "stage": "join",
+                "mode": mode,
+                "presence": "on" if interval else "off",
+                "members": args.members,
+                "join_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "join_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+                "reply_bytes": round(sum(sizes) / len(sizes)),
+            })
+        finally:
+            for task in tasks:
+                task.cancel()
+            for writer in writers:
+                writer.close()
+            stop_server(process)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument("--typists", type=int, default=20, help="members typing at once")
+    parser.add_argument("--keystrokes", type=float, default=5, help="typing reports per second per typist")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--interval", type=float, default=1.0, help="the server's --presence-interval")
+    parser.add_argument("--joins", type=int, default=200, help="members joining the full channel, one at a time")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        for result in asyncio.run(run(mode, args)):
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Benchmark for the cost of the always-on spans and the sampling profiler.
+
+Joins members to one channel and pipelines rounds of broadcasts through the
+server, alternating rounds with the sampling profiler stopped and running
+(toggled with SIGUSR1, as an operator would). Reports the delivery rate of
+each and the overhead of sampling, then checks that stopping the profiler
+wrote a folded stack file and that GET /profile returns stacks too. The cost
+of one span record is measured in-process.
+
+    python -m benchmarks.profiling --members 200 --messages 1000 --rounds 4
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+
+from benchmarks.common import free_port, raise_fd_limit, start_server, stop_server
+from benchmarks.engines import DeliveryCounter, count_messages, open_member
+from benchmarks.metrics import scrape
+from profiling import Spans
+from protocol import encode_message
+
+
+def span_record_cost(calls=200000):
+    """Seconds per perf_counter() pair plus Spans.record(), as the server pays it"""
+    spans = Spans()
+
+    def timed():
+        started = time.perf_counter()
+        spans.record("bench", time.perf_counter() - started)
+
+    return min(timeit.repeat(timed, number=calls, repeat=3)) / calls
+
+
+def fetch(port, path):
+    """GET a path from the metrics endpoint and return the body"""
+    with socket.create_connection(("127.0.0.1", port), timeout=90) as sock:
+        sock.sendall(f"GET {path} HTTP/1.0\r\n\r\n".encode('ascii'))
+        response = b""
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response += data
+    header, _, body = response.partition(b"\r\n\r\n")
+    if not header.startswith(b"HTTP/1.0 200"):
+        raise RuntimeError(f"unexpected response to {path}: {header[:80]!r}")
+    return body.decode('utf-8')
+
+
+def wait_for_profiles(directory, count, timeout=10.0):
+    """Stacks from the folded files the server wrote, once there are count of them"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        paths = glob.glob(os.path.join(directory, "chat-profile-*.folded"))
+        if len(paths) >= count:
+            # The last file may still be being written
+            time.sleep(0.2)
+            lines = []
+            for path in paths:
+                with open(path) as profile:
+                    lines.extend(profile.read().splitlines())
+            return lines
+        time.sleep(0.05)
+    raise RuntimeError(f"stopping the profiler wrote {len(paths)} of {count} .folded files")
+
+
+async def run(mode, members, messages, rounds, directory):
+    port = free_port()
+    metrics_port = free_port()
+    process = start_server(port, mode, [
+        "--stats-interval", "0", "--log-level", "warning",
+        "--send-queue", str(messages + 16),
+        "--metrics", f"tcp:127.0.0.1:{metrics_port}",
+        "--profile-dir", directory,
+    ])
+    writers = []
+    try:
+        channel = {"channelName": "bench", "channelPassword": "", "memberName": "owner"}
+        owner_reader, owner_writer = await open_member(port, {"action": "createChannel", **channel})
+        readers = [owner_reader]
+        writers.append(owner_writer)
+        for index in range(members - 1):
+            reader, writer = await open_member(port, {
+                "action": "joinChannel", **channel, "memberName": f"member{index}"
+            })
+            readers.append(reader)
+            writers.append(writer)
+
+        counter = DeliveryCounter()
+        tasks = [asyncio.create_task(count_messages(reader, counter)) for reader in readers]
+        rates = {False: [], True: []}
+        sampling = False
+        sent = 0
+        for index in range(rounds * 2):
+            sent += messages
+            counter.expect(sent * members)
+            started = time.perf_counter()
+            for number in range(messages):
+                owner_writer.write(encode_message({"action": "message", "message": f"message {number}"}))
+            await owner_writer.drain()
+            await asyncio.wait_for(counter.reached.wait(), timeout=120)
+            rates[sampling].append(messages * members / (time.perf_counter() - started))
+
+            # Toggle between rounds, so every "on" round is sampled throughout
+            process.send_signal(signal.SIGUSR1)
+            sampling = not sampling
+            await asyncio.sleep(0.05)
+
+        dumped = wait_for_profiles(directory, rounds)
+        if not dumped:
+            raise RuntimeError("the folded stack files are empty")
+
+        served = await asyncio.to_thread(fetch, metrics_port, "/profile?seconds=1")
+        if not served.strip():
+            raise RuntimeError("GET /profile returned no stacks")
+        for task in tasks:
+            task.cancel()
+
+        samples, _ = scrape(metrics_port)
+        spans = {
+            key.split('"')[1]: value for key, value in samples.items()
+            if key.startswith("chat_span_calls_total{")
+        }
+        off = statistics.median(rates[False])
+        on = statistics.median(rates[True])
+        return {
+            "mode": mode,
+            "members": members,
+            "deliveries_per_sec_off": round(off),
+            "deliveries_per_sec_on": round(on),
+            "overhead_pct": round((off - on) / off * 100, 2),
+            "folded_stacks": len(dumped),
+            "samples": sum(int(line.rsplit(" ", 1)[1]) for line in dumped),
+            "span_calls": spans,
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=4, help="rounds with the profiler off, and as many on")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(json.dumps({"span_record_ns": round(span_record_cost() * 1e9)}))
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                result = asyncio.run(run(mode, args.members, args.messages, args.rounds, directory))
+            except RuntimeError as e:
+                print(f"{mode}: {e}", file=sys.stderr)
+                sys.exit(1)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
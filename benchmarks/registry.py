@@ -0,0 +1,187 @@
+"""
+Stress test for the channel registry under join/leave churn.
+
+The registry target hammers ChannelRegistry directly from many threads with
+a tiny GIL switch interval, then checks its invariants. The server target
+does the same through real sockets against a running server and checks it is
+still accepting joins afterwards.
+
+    python -m benchmarks.registry --target registry --threads 32 --seconds 5
+    python -m benchmarks.registry --target server --mode threaded
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+from benchmarks.common import free_port, raise_fd_limit, start_server, stop_server
+from client import ChatClient
+from registry import ChannelRegistry
+
+
+class FakeConnection:
+    """Stands in for a client connection; counts the broadcasts it would receive"""
+
+    def __init__(self):
+        self.received = 0
+
+    def enqueue(self, message):
+        self.received += 1
+        return True
+
+
+def registry_worker(registry, channel_names, deadline, seed, stats, errors):
+    rng = random.Random(seed)
+    live = []
+    operations = 0
+    try:
+        while time.monotonic() < deadline:
+            operation = rng.random()
+            name = rng.choice(channel_names)
+            channel = registry.get(name)
+
+            if channel is None or operation < 0.05:
+                registry.create(name, password="")
+            elif operation < 0.45:
+                connection = FakeConnection()
+                member_name = registry.add_member(channel, "member", connection)
+                live.append((channel, member_name, connection))
+            elif operation < 0.80 and live:
+                channel, member_name, connection = live.pop(rng.randrange(len(live)))
+                if not registry.remove_member(channel, member_name, connection):
+                    raise AssertionError(f"{member_name} vanished before it was removed")
+            else:
+                for _, connection in registry.members(channel):
+                    connection.enqueue(None)
+            operations += 1
+    except Exception as e:
+        errors.append(repr(e))
+    stats.append((operations, live))
+
+
+def stress_registry(threads, seconds):
+    previous_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    registry = ChannelRegistry()
+    channel_names = [f"channel{i}" for i in range(32)]
+    deadline = time.monotonic() + seconds
+    stats = []
+    errors = []
+    workers = [
+        threading.Thread(target=registry_worker, args=(registry, channel_names, deadline, i, stats, errors))
+        for i in range(threads)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    sys.setswitchinterval(previous_interval)
+
+    channels = registry.values()
+    ids = [channel["channelId"] for channel in channels]
+    if len(ids) != len(set(ids)):
+        errors.append("duplicate channel ids")
+
+    expected = {(channel["channelName"], member_name) for _, live in stats for channel, member_name, _ in live}
+    actual = {(channel["channelName"], member_name) for channel in channels for member_name in channel["members"]}
+    if expected != actual:
+        errors.append(f"membership mismatch: {len(expected ^ actual)} members differ")
+
+    for channel in channels:
+        if dict(registry.members(channel)) != channel["members"]:
+            errors.append(f"stale snapshot in {channel['channelName']}")
+
+    operations = sum(count for count, _ in stats)
+    return {
+        "target": "registry",
+        "threads": threads,
+        "operations": operations,
+        "ops_per_sec": round(operations / elapsed),
+        "channels": len(channels),
+        "members": len(actual),
+        "errors": errors,
+    }
+
+
+def server_worker(port, channel_names, deadline, seed, counts, errors):
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        client = ChatClient("127.0.0.1", port)
+        try:
+            name = rng.choice(channel_names)
+            if not client.join_channel(name, "", "churn"):
+                if client.last_error.startswith("could not connect"):
+                    errors.append(client.last_error)
+                    continue
+                client.disconnect()
+                client = ChatClient("127.0.0.1", port)
+                if not client.create_channel(name, "", "churn") and not client.join_channel(name, "", "churn"):
+                    continue
+            for _ in range(rng.randint(0, 3)):
+                client.send_message("churn")
+            counts[0] += 1
+        except Exception as e:
+            errors.append(repr(e))
+        finally:
+            client.disconnect()
+
+
+def stress_server(mode, threads, seconds):
+    port = free_port()
+    process = start_server(port, mode)
+    try:
+        channel_names = [f"channel{i}" for i in range(8)]
+        deadline = time.monotonic() + seconds
+        counts = [0]
+        errors = []
+        workers = [
+            threading.Thread(target=server_worker, args=(port, channel_names, deadline, i, counts, errors))
+            for i in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        probe = ChatClient("127.0.0.1", port)
+        alive = probe.create_channel("probe", "", "probe")
+        probe.disconnect()
+        if process.poll() is not None:
+            errors.append("server exited")
+        return {
+            "target": "server",
+            "mode": mode,
+            "threads": threads,
+            "sessions": counts[0],
+            "sessions_per_sec": round(counts[0] / seconds),
+            "alive": bool(alive),
+            "errors": errors[:10],
+        }
+    finally:
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", choices=["registry", "server"], default="registry")
+    parser.add_argument("--mode", default="threaded", help="server engine for --target server")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    if args.target == "registry":
+        result = stress_registry(args.threads, args.seconds)
+    else:
+        result = stress_server(args.mode, args.threads, args.seconds)
+    print(json.dumps(result))
+    if result["errors"] or result.get("alive") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
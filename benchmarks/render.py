@@ -0,0 +1,122 @@
+"""
+Headless benchmark for the curses client UI: bytes written to the terminal
+per incoming message and per keystroke.
+
+Runs the ChatClient renderer inside a pseudo-terminal, feeds it messages the
+way the listener thread does and counts what reaches the terminal. For
+comparison, the full mode clears and repaints the whole screen for every
+event, as the client used to.
+
+    python -m benchmarks.render --messages 500 --keys 200 --size 40x120
+"""
+import argparse
+import curses
+import fcntl
+import json
+import os
+import pty
+import struct
+import sys
+import tempfile
+import termios
+import traceback
+
+from client import ChatClient
+
+MODES = ("incremental", "full")
+
+
+def full_repaint(stdscr, client):
+    """Clear the screen and draw everything, like the old draw_interface"""
+    stdscr.clear()
+    stdscr.addstr(0, 0, f"Chat Client - Channel: {client.channel_name}"[:curses.COLS - 1])
+    stdscr.addstr(1, 0, "-" * (curses.COLS - 1))
+    height = client.get_message_area_height()
+    for row, (_, line) in enumerate(client.visible_rows(height, curses.COLS - 1)):
+        stdscr.addstr(2 + row, 0, line)
+    stdscr.addstr(curses.LINES - 3, 0, "-" * (curses.COLS - 1))
+    stdscr.addstr(curses.LINES - 2, 0, "Message: " + client.input_text[:curses.COLS - 11])
+    stdscr.refresh()
+
+
+def drive(stdscr, mode, messages, keys):
+    client = ChatClient("localhost", 0)
+    client.channel_name = "bench"
+    client.start_interface()
+
+    for index in range(messages):
+        client.add_message(f"message number {index}", f"member_{index % 7}", f"12:00:{index % 60:02d}")
+        if mode == "incremental":
+            client.draw_interface()
+        else:
+            full_repaint(stdscr, client)
+
+    # Type lines of 39 characters, each followed by Enter
+    for index in range(keys):
+        key = 10 if index % 40 == 39 else ord("a") + index % 26
+        if mode == "incremental":
+            client.handle_input(key)
+            client.draw_interface()
+        else:
+            client.input_text = "" if key == 10 else client.input_text + chr(key)
+            full_repaint(stdscr, client)
+
+
+def terminal_bytes(mode, messages, keys, lines, columns):
+    """Run the UI in a pseudo-terminal and return how many bytes it wrote"""
+    error_file = tempfile.NamedTemporaryFile(prefix="chat-render-", delete=False)
+    error_file.close()
+    pid, master = pty.fork()
+    if pid == 0:
+        try:
+            fcntl.ioctl(sys.stdout.fileno(), termios.TIOCSWINSZ, struct.pack("HHHH", lines, columns, 0, 0))
+            os.environ["TERM"] = "xterm"
+            curses.wrapper(drive, mode, messages, keys)
+        except BaseException:
+            with open(error_file.name, "w") as errors:
+                errors.write(traceback.format_exc())
+            os._exit(1)
+        os._exit(0)
+
+    total = 0
+    while True:
+        try:
+            data = os.read(master, 65536)
+        except OSError:
+            break
+        if not data:
+            break
+        total += len(data)
+    os.close(master)
+    _, status = os.waitpid(pid, 0)
+
+    with open(error_file.name) as errors:
+        failure = errors.read()
+    os.unlink(error_file.name)
+    if status:
+        raise RuntimeError(f"renderer failed in the pseudo-terminal:\n{failure}")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--keys", type=int, default=200)
+    parser.add_argument("--size", default="40x120", help="terminal LINESxCOLUMNS")
+    args = parser.parse_args()
+    lines, columns = (int(value) for value in args.size.split("x"))
+
+    for mode in MODES:
+        baseline = terminal_bytes(mode, 0, 0, lines, columns)
+        with_messages = terminal_bytes(mode, args.messages, 0, lines, columns)
+        with_keys = terminal_bytes(mode, 0, args.keys, lines, columns)
+        print(json.dumps({
+            "mode": mode,
+            "terminal": args.size,
+            "bytes_per_message": round((with_messages - baseline) / max(1, args.messages), 1),
+            "bytes_per_key": round((with_keys - baseline) / max(1, args.keys), 1),
+        }))
+
+
+if __name__ == "__main__":
+    main()
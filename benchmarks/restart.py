@@ -0,0 +1,196 @@
+"""
+Benchmark for restarting a server under load: stop and start against handing over.
+
+Joins --members resumable members to one channel, one of which sends
+--rate messages per second, and replaces the server while they do, either
+by stopping it (SIGTERM, which drains and sends every member a shutdown
+notice) and starting a new one, or by starting the new one with --takeover
+so the old one hands over its listening socket and connections. Members
+behave like the client core: when dropped, they wait a random part of the
+notice's retryAfter, resume their session and join again if it expired.
+Meanwhile a prober opens a connection every 10 ms.
+
+Reports how many members were dropped, how many probes were refused, and
+the longest gap between two messages a member received, as p50 and max over
+the members.
+
+    python -m benchmarks.restart --members 500 --rate 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import REPO_ROOT, free_port, percentile, raise_fd_limit, start_server, stop_server, wait_for_port
+from protocol import FrameDecoder, encode_message
+
+CHANNEL = {"channelName": "bench", "channelPassword": ""}
+
+
+class Member:
+    """A member connection that comes back after the server drops it, and notes when messages arrive"""
+
+    def __init__(self, port, index):
+        self.port = port
+        self.request = dict(CHANNEL, memberName=f"member{index}", resumable=True)
+        self.session = None
+        self.writer = None
+        self.retry_after = 0.0
+        self.drops = 0
+        self.arrivals = []
+
+    async def connect(self):
+        """Resumes if there is a session, else joins, or creates the channel a new server lacks"""
+        requests = [{"action": "resume", "session": self.session}] if self.session else []
+        requests += [dict(self.request, action="joinChannel"), dict(self.request, action="createChannel")]
+        for request in requests:
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            writer.write(encode_message(request))
+            decoder = FrameDecoder()
+            reply = None
+            while reply is None:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+                for payload in decoder.feed(chunk):
+                    message = json.loads(payload)
+                    if message["action"] in ("joinChannel", "resume"):
+                        reply = message
+                        break
+            if reply is not None and reply.get("success"):
+                self.session = reply.get("session")
+                self.writer = writer
+                # Anything that came with the reply is a replay, not a live message
+                return reader
+            writer.close()
+        raise ConnectionError("could not rejoin")
+
+    async def run(self, reader):
+        while True:
+            decoder = FrameDecoder()
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                now = time.perf_counter()
+                for payload in decoder.feed(chunk):
+                    message = json.loads(payload)
+                    if message.get("action") == "message":
+                        self.arrivals.append(now)
+                    elif message.get("action") == "shutdown":
+                        self.retry_after = message["retryAfter"]
+            self.drops += 1
+            self.writer = None
+            await asyncio.sleep(random.uniform(0, self.retry_after) or 0.05)
+            self.retry_after = 0.0
+            while True:
+                try:
+                    reader = await self.connect()
+                    break
+                except OSError:
+                    await asyncio.sleep(0.05)
+
+
+async def send_messages(sender, rate):
+    """Sends rate messages per second through the first member, whenever it is connected"""
+    count = 0
+    while True:
+        if sender.writer is not None and not sender.writer.is_closing():
+            sender.writer.write(encode_message({"action": "message", "message": f"message {count}"}))
+            count += 1
+        await asyncio.sleep(1 / rate)
+
+
+async def probe(port, results):
+    """Opens a connection every 10 ms; counts the attempts and the refusals"""
+    while True:
+        results["probes"] += 1
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+        except OSError:
+            results["refused"] += 1
+        await asyncio.sleep(0.01)
+
+
+def replace_server(how, port, mode, server_args, old, path):
+    """Replaces the server process old; returns the new one"""
+    if how == "restart":
+        stop_server(old)
+        return start_server(port, mode, server_args)
+    command = [
+        sys.executable, os.path.join(REPO_ROOT, "server.py"), "--host", "127.0.0.1", "--port", str(port),
+        "--mode", mode, *server_args, "--takeover", path,
+    ]
+    new = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    old.wait()
+    wait_for_port(port)
+    return new
+
+
+async def run(mode, how, args):
+    port = free_port()
+    path = os.path.join(tempfile.gettempdir(), f"chat-bench-handoff-{port}.sock")
+    server_args = ["--stats-interval", "0", "--log-level", "warning", "--handoff", path]
+    process = start_server(port, mode, server_args)
+    tasks = []
+    members = [Member(port, index) for index in range(args.members)]
+    try:
+        for member in members:
+            tasks.append(asyncio.create_task(member.run(await member.connect())))
+        tasks.append(asyncio.create_task(send_messages(members[0], args.rate)))
+        await asyncio.sleep(1)
+
+        probes = {"probes": 0, "refused": 0}
+        tasks.append(asyncio.create_task(probe(port, probes)))
+        started = time.perf_counter()
+        process = await asyncio.get_running_loop().run_in_executor(
+            None, replace_server, how, port, mode, server_args, process, path
+        )
+        # Long enough for members told to wait up to RECONNECT_SPREAD to be back
+        await asyncio.sleep(args.settle)
+
+        gaps = []
+        for member in members[1:]:
+            arrivals = [at for at in member.arrivals if at >= started - 1]
+            gaps.append(max((b - a for a, b in zip(arrivals, arrivals[1:])), default=args.settle))
+        return {
+            "mode": mode,
+            "how": how,
+            "members": args.members,
+            "dropped": sum(member.drops for member in members),
+            "probes": probes["probes"],
+            "refused": probes["refused"],
+            "gap_p50_ms": round(percentile(gaps, 50) * 1000, 1),
+            "gap_max_ms": round(max(gaps) * 1000, 1),
+        }
+    finally:
+        for task in tasks:
+            task.cancel()
+        for member in members:
+            if member.writer is not None:
+                member.writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=20, help="messages per second sent to the channel")
+    parser.add_argument("--settle", type=float, default=8, help="seconds to keep measuring after the restart")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        for how in ("restart", "handoff"):
+            print(json.dumps(asyncio.run(run(mode, how, args))))
+
+
+if __name__ == "__main__":
+    main()
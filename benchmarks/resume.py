@@ -0,0 +1,124 @@
+"""
+Benchmark for reconnecting after a network flap: rejoining against resuming a session.
+
+Joins members to a password-protected channel, drops every connection at
+once, and reconnects them all concurrently, either with a fresh joinChannel
+(sessions disabled, as before session tokens) or with the "resume" action
+and the session token from the join reply. Reports reconnects per second,
+reconnect latency, the server CPU spent on the storm, how many members kept
+their name, and how many members the channel holds afterwards.
+
+    python -m benchmarks.resume --members 2000 --concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.common import cpu_seconds, free_port, percentile, raise_fd_limit, start_server, stop_server
+from benchmarks.metrics import scrape
+from protocol import FrameDecoder, encode_message
+
+CHANNEL = {"channelName": "bench", "channelPassword": "secret"}
+
+
+async def handshake(port, request):
+    """Connect and send a handshake request; returns the reader, writer and the reply"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(encode_message(request))
+    await writer.drain()
+    decoder = FrameDecoder()
+    while True:
+        chunk = await reader.read(4096)
+        if not chunk:
+            raise ConnectionError("server closed the connection during the handshake")
+        for payload in decoder.feed(chunk):
+            reply = json.loads(payload)
+            if reply["action"] in ("joinChannel", "resume"):
+                return reader, writer, reply
+
+
+async def reconnect_storm(port, requests, concurrency):
+    """Send each request on a new connection, `concurrency` at a time; returns (latencies, replies, writers)"""
+    latencies = []
+    replies = []
+    writers = []
+    remaining = iter(requests)
+
+    async def client():
+        for request in remaining:
+            started = time.perf_counter()
+            _, writer, reply = await handshake(port, request)
+            latencies.append(time.perf_counter() - started)
+            replies.append(reply)
+            writers.append(writer)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, replies, writers
+
+
+async def run(mode, how, members, concurrency):
+    port = free_port()
+    metrics_port = free_port()
+    process = start_server(port, mode, [
+        "--stats-interval", "0", "--log-level", "warning", "--metrics", f"tcp:127.0.0.1:{metrics_port}",
+        "--session-grace", "60" if how == "resume" else "0",
+    ])
+    writers = []
+    try:
+        _, owner, _ = await handshake(port, {"action": "createChannel", **CHANNEL, "memberName": "owner"})
+        joins = [
+            {"action": "joinChannel", **CHANNEL, "memberName": f"member{index}", "resumable": True}
+            for index in range(members)
+        ]
+        _, replies, writers = await reconnect_storm(port, joins, concurrency)
+        names = {reply["memberName"] for reply in replies}
+
+        # The flap: every member loses its connection at once
+        for writer in writers:
+            writer.transport.abort()
+        await asyncio.sleep(1.0)
+
+        if how == "resume":
+            requests = [{"action": "resume", "session": reply["session"]} for reply in replies]
+        else:
+            requests = joins
+        cpu_before = cpu_seconds(process.pid)
+        started = time.perf_counter()
+        latencies, replies, writers = await reconnect_storm(port, requests, concurrency)
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(process.pid) - cpu_before
+
+        samples, _ = scrape(metrics_port)
+        owner.close()
+        return {
+            "mode": mode,
+            "reconnect": how,
+            "reconnects_per_sec": round(members / elapsed),
+            "reconnect_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "reconnect_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "server_cpu_us_per_reconnect": round(cpu / members * 1e6, 1),
+            "names_kept": sum(reply["memberName"] in names for reply in replies),
+            "channel_members": int(samples['chat_channel_members{channel="bench"}']),
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for mode in args.modes:
+        for how in ("rejoin", "resume"):
+            print(json.dumps(asyncio.run(run(mode, how, args.members, args.concurrency))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark for the client's scrollback store.
+
+Feeds millions of messages into a ChatClient's MessageStore and reports,
+at each milestone, the process RSS and how long it takes to lay out the
+viewport at a new terminal width (what a resize costs), both at the live
+edge and, with --spill-dir, scrolled back to the very first message.
+
+    python -m benchmarks.scrollback --messages 2000000 --spill-dir /tmp
+"""
+import argparse
+import json
+import os
+import time
+
+from benchmarks.common import rss_kb
+from client import ChatClient
+from message_store import DEFAULT_CAPACITY
+
+
+def layout_ms(client, height, width, repeat=20):
+    """Average time to compute the visible rows, at a width not seen before each time"""
+    started = time.perf_counter()
+    for index in range(repeat):
+        client.visible_rows(height, width + index)
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--milestones", type=int, default=4)
+    parser.add_argument("--scrollback", type=int, default=DEFAULT_CAPACITY)
+    parser.add_argument("--spill-dir", help="spill evicted messages to a temporary file in this directory")
+    parser.add_argument("--height", type=int, default=40)
+    parser.add_argument("--width", type=int, default=100)
+    args = parser.parse_args()
+
+    client = ChatClient("localhost", 0, scrollback=args.scrollback, spill_dir=args.spill_dir)
+    text = "the quick brown fox jumps over the lazy dog " * 3
+    step = args.messages // args.milestones
+    added = 0
+    for milestone in range(1, args.milestones + 1):
+        started = time.perf_counter()
+        while added < step * milestone:
+            client.add_message(text, f"member_{added % 50}", "12:00:00")
+            added += 1
+        append_rate = step / (time.perf_counter() - started)
+
+        client.following = True
+        result = {
+            "messages": added,
+            "rss_kb": rss_kb(os.getpid()),
+            "appends_per_sec": round(append_rate),
+            "resize_live_ms": round(layout_ms(client, args.height, args.width), 3),
+        }
+        if args.spill_dir:
+            client.following = False
+            client.scroll_anchor = (0, 0)
+            result["resize_oldest_ms"] = round(layout_ms(client, args.height, args.width), 3)
+        print(json.dumps(result))
+
+    client.messages.close()
+
+
+if __name__ == "__main__":
+    main()
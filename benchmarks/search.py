@@ -0,0 +1,174 @@
+"""
+Benchmark for full-text search over channel history.
+
+Appends messages with Zipf-distributed words from a fixed vocabulary to a
+ChannelLog without search, then reopens it with search, as after a restart,
+and reports how long the background indexing took and how much memory the
+index holds. Appends are timed with and without the index. Then times queries for a rare word, a
+common word, two words together, a word from one member, a member alone and
+a word in a recent time window, plus the next page of the common word, and
+checks each page against a scan of the messages.
+
+    python -m benchmarks.search --messages 1000000
+"""
+import argparse
+import itertools
+import json
+import random
+import shutil
+import tempfile
+import time
+
+from benchmarks.common import percentile
+from fanout import EncodedMessage
+from history import MessageLog
+from search import search_keys
+
+MEMBER_ID_LENGTH = 11
+
+
+def timed(function, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - started)
+    return result, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=10, help="words per message")
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--search-mb", type=float, default=256)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = [f"w{index}" for index in range(args.vocabulary)]
+    # Zipf weights: the word of rank r is used in proportion to 1/r
+    cumulative = list(itertools.accumulate(1 / rank for rank in range(1, args.vocabulary + 1)))
+    members = [f"user{index}_{'x' * MEMBER_ID_LENGTH}" for index in range(args.members)]
+    base_time = int(time.time() * 1000)
+
+    texts = []
+    senders = []
+    messages = []
+    frames = []
+    for index in range(args.messages):
+        text = " ".join(rng.choices(vocabulary, cum_weights=cumulative, k=args.words))
+        member = rng.choice(members)
+        texts.append(text)
+        senders.append(member)
+        message = {
+            "action": "message", "message": text, "memberName": member,
+            "timestamp": "12:00:00", "sentAt": base_time + index,
+        }
+        messages.append(message)
+        frames.append(EncodedMessage.from_dict(message).framed)
+
+    directory = tempfile.mkdtemp(prefix="chat-search-")
+    try:
+        history = MessageLog(directory, search_bytes=0)
+        log = history.channel("bench")
+        split = args.messages * 9 // 10
+        started = time.perf_counter()
+        for index in range(split):
+            log.append(frames[index], base_time + index)
+        plain_rate = split / (time.perf_counter() - started)
+        history.close()
+
+        # Reopened with search, the log indexes what it holds in the background
+        started = time.perf_counter()
+        history = MessageLog(directory, search_bytes=int(args.search_mb * 1024 * 1024),
+                             member_id_length=MEMBER_ID_LENGTH)
+        log = history.channel("bench")
+        while not log.search_index.complete:
+            time.sleep(0.01)
+        backfill_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for index in range(split, args.messages):
+            # As the server does, passing the message it has just encoded
+            log.append(frames[index], base_time + index, messages[index])
+        indexed_rate = (args.messages - split) / (time.perf_counter() - started)
+        history.sync()
+
+        index = log.search_index
+        print(json.dumps({
+            "stage": "index",
+            "messages": args.messages,
+            "backfill_sec": round(backfill_seconds, 2),
+            "backfill_per_sec": round(split / backfill_seconds),
+            "appends_per_sec": round(plain_rate),
+            "indexed_appends_per_sec": round(indexed_rate),
+            "blocks": len(index.blocks),
+            "index_mb": round(index.memory() / 1024 / 1024, 1),
+            "indexed_from": index.first_offset,
+        }))
+
+        rare = vocabulary[args.vocabulary // 2]
+        common = vocabulary[1]
+        member = members[0]
+        recent = base_time + args.messages - args.messages // 100
+        queries = {
+            "rare_word": dict(query=rare),
+            "common_word": dict(query=common),
+            "two_words": dict(query=f"{vocabulary[2]} {vocabulary[3]}"),
+            "word_from_member": dict(query=vocabulary[4], member=member[:-MEMBER_ID_LENGTH - 1]),
+            "member": dict(query="", member=member),
+            "recent_window": dict(query=vocabulary[10], since=recent),
+        }
+        first_page = {}
+        for name, query in queries.items():
+            keys = search_keys(query["query"], query.get("member"))
+            since = query.get("since")
+            (results, _), samples = timed(lambda: log.search(keys, since, limit=args.limit), args.repeat)
+            first_page[name] = results
+            check(results, keys, texts, senders, since and since - base_time, args.limit, index.first_offset)
+            print(json.dumps({
+                "stage": "query",
+                "query": name,
+                "results": len(results),
+                "p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "p99_ms": round(percentile(samples, 99) * 1000, 3),
+            }))
+
+        keys = search_keys(common)
+        before = first_page["common_word"][-1][0]
+        (results, _), samples = timed(lambda: log.search(keys, before=before, limit=args.limit), args.repeat)
+        assert results and results[0][0] < before
+        print(json.dumps({
+            "stage": "query",
+            "query": "common_word_page_2",
+            "results": len(results),
+            "p50_ms": round(percentile(samples, 50) * 1000, 3),
+            "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        }))
+        history.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def check(results, keys, texts, senders, start, limit, first_offset):
+    """Compare a page of results with the newest matches found by scanning every message"""
+    expected = []
+    for offset in range(len(texts) - 1, max(start or 0, first_offset) - 1, -1):
+        sender = senders[offset].lower()
+        message_keys = search_keys(texts[offset]) | {"@" + sender, "@" + sender[:-MEMBER_ID_LENGTH - 1]}
+        if keys <= message_keys:
+            expected.append(offset)
+            if len(expected) == limit:
+                break
+    assert [offset for offset, _ in results] == expected, (keys, results[:3], expected[:3])
+    for offset, payload in results:
+        assert json.loads(payload)["message"] == texts[offset]
+
+
+if __name__ == "__main__":
+    main()
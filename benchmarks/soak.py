@@ -0,0 +1,118 @@
+"""
+Soak test for channel lifecycle: server memory under continuous create/abandon churn.
+
+Clients keep creating channels, joining a few members, exchanging some
+messages and disconnecting, so every channel is abandoned moments after it
+was created. The server's RSS, channel count and estimated channel memory
+are sampled throughout, once with idle eviction (--channel-ttl) and once
+without. With eviction, memory should level off once channels are evicted as
+fast as they are created; without it, it grows with every channel. Exits
+non-zero if memory grew by more than --max-growth percent after the warm-up
+in the run with eviction.
+
+    python -m benchmarks.soak --duration 120 --ttl 2
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchmarks.common import free_port, raise_fd_limit, rss_kb, start_server, stop_server
+from benchmarks.engines import open_member
+from benchmarks.metrics import scrape
+from protocol import encode_message
+
+
+async def churn(port, stop, members, messages, created):
+    """Create, use and abandon channels until stop is set"""
+    while not stop.is_set():
+        channel = {"channelName": f"soak-{next(created)}", "channelPassword": ""}
+        streams = [await open_member(port, {"action": "createChannel", **channel, "memberName": "owner"})]
+        for index in range(members - 1):
+            streams.append(await open_member(port, {
+                "action": "joinChannel", **channel, "memberName": f"member{index}"
+            }))
+        for index in range(messages):
+            streams[index % members][1].write(encode_message({"action": "message", "message": f"soak {index}"}))
+        for _, writer in streams:
+            await writer.drain()
+            writer.close()
+
+
+async def run(mode, ttl, duration, clients, members, messages, interval):
+    port = free_port()
+    metrics_port = free_port()
+    process = start_server(port, mode, [
+        "--stats-interval", "0", "--log-level", "warning", "--metrics", f"tcp:127.0.0.1:{metrics_port}",
+        "--channel-ttl", str(ttl),
+    ])
+    try:
+        counter = iter(range(sys.maxsize))
+        stop = asyncio.Event()
+        tasks = [asyncio.create_task(churn(port, stop, members, messages, counter)) for _ in range(clients)]
+
+        samples = []
+        started = time.perf_counter()
+        while time.perf_counter() - started < duration:
+            await asyncio.sleep(interval)
+            metrics, _ = scrape(metrics_port)
+            samples.append({
+                "seconds": round(time.perf_counter() - started),
+                "rss_kb": rss_kb(process.pid),
+                "channels": int(metrics["chat_channels"]),
+                "channel_memory_kb": round(metrics["chat_channel_memory_bytes"] / 1024),
+            })
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        created = next(counter)
+        metrics, _ = scrape(metrics_port)
+
+        # Growth is measured from the end of the warm-up, a fifth of the run
+        baseline = samples[len(samples) // 5]
+        final = samples[-1]
+        return {
+            "mode": mode,
+            "channel_ttl": ttl,
+            "channels_created": created,
+            "channels_evicted": int(metrics["chat_channels_evicted_total"]),
+            "channels_at_end": final["channels"],
+            "rss_baseline_kb": baseline["rss_kb"],
+            "rss_end_kb": final["rss_kb"],
+            "rss_growth_pct": round((final["rss_kb"] - baseline["rss_kb"]) / baseline["rss_kb"] * 100, 1),
+            "channel_memory_end_kb": final["channel_memory_kb"],
+            "samples": samples,
+        }
+    finally:
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["async"])
+    parser.add_argument("--duration", type=float, default=120.0)
+    parser.add_argument("--ttl", type=float, default=2.0, help="--channel-ttl for the run with eviction")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent churning clients")
+    parser.add_argument("--members", type=int, default=3, help="members per channel")
+    parser.add_argument("--messages", type=int, default=10, help="messages per channel")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between samples")
+    parser.add_argument("--max-growth", type=float, default=10.0,
+                        help="percent RSS growth after warm-up tolerated with eviction")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    failed = False
+    for mode in args.modes:
+        for ttl in (args.ttl, 0):
+            result = asyncio.run(run(
+                mode, ttl, args.duration, args.clients, args.members, args.messages, args.interval
+            ))
+            print(json.dumps(result))
+            if ttl and result["rss_growth_pct"] > args.max_growth:
+                print(f"{mode}: RSS grew {result['rss_growth_pct']}% with eviction", file=sys.stderr)
+                failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Benchmark for the client's cold start: import time and time to first message.
+
+Times `import client` and `import client_core` in fresh interpreters against
+an empty interpreter, and lists the slowest imports. Then starts a server
+with history, fills a channel, and runs client.py in a pseudo-terminal, both
+in fast-start mode (channel and name on the command line) and answering the
+interactive prompts as soon as they appear. It reports how long each takes
+from launch until the newest message of the channel is on the screen.
+
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import fcntl
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+import time
+
+from benchmarks.common import REPO_ROOT, free_port, percentile, start_server, stop_server
+from protocol import FrameDecoder, encode_message
+
+MARKER = "startup-marker"
+CHANNEL = "bench"
+
+
+def interpreter_ms(code, runs):
+    """Median wall time of a fresh interpreter running code"""
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, check=True)
+        samples.append(time.perf_counter() - started)
+    return percentile(samples, 50) * 1000
+
+
+def slowest_imports(module, count):
+    """The modules imported directly by module with the largest cumulative import time"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and name.startswith("   ") and not name.startswith("    "):
+            imports.append((int(cumulative), name.strip()))
+    imports.sort(reverse=True)
+    return {name: round(microseconds / 1000, 1) for microseconds, name in imports[:count]}
+
+
+def fill_channel(port, messages):
+    """Create the channel and send it messages, the last one being MARKER"""
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(encode_message({"action": "createChannel", "channelName": CHANNEL,
+                                     "channelPassword": "", "memberName": "writer"}))
+        decoder = FrameDecoder()
+        joined = False
+        while not joined:
+            joined = any(json.loads(payload).get("action") == "joinChannel"
+                         for payload in decoder.feed(sock.recv(65536)))
+        for index in range(messages - 1):
+            sock.sendall(encode_message({"action": "message", "message": f"history message {index}"}))
+        sock.sendall(encode_message({"action": "message", "message": MARKER}))
+        # Wait for our own copy of the marker so it is in the log
+        seen = False
+        while not seen:
+            seen = any(MARKER in payload.decode('utf-8', errors='replace')
+                       for payload in decoder.feed(sock.recv(65536)))
+
+
+def first_message_ms(port, mode, lines, columns, timeout=30):
+    """Launch client.py in a pseudo-terminal; milliseconds until MARKER is drawn"""
+    command = [sys.executable, os.path.join(REPO_ROOT, "client.py")]
+    if mode == "fast":
+        command += ["--host", "127.0.0.1", "--port", str(port), "--channel", CHANNEL, "--name", "reader"]
+    prompts = [
+        ("Server host", "127.0.0.1"), ("Server port", str(port)), ("create/join", "join"),
+        ("Channel name", CHANNEL), ("Channel password", ""), ("Your name", "reader"),
+    ] if mode == "interactive" else []
+
+    master, slave = os.openpty()
+    fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", lines, columns, 0, 0))
+    started = time.perf_counter()
+    process = subprocess.Popen(command, stdin=slave, stdout=slave, stderr=slave, cwd=REPO_ROOT,
+                               env=dict(os.environ, TERM="xterm"), start_new_session=True,
+                               # The terminal must be the client's controlling one for Ctrl+C to reach it
+                               preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0))
+    os.close(slave)
+    output = b""
+    elapsed = None
+    try:
+        deadline = started + timeout
+        while elapsed is None and time.perf_counter() < deadline:
+            ready, _, _ = select.select([master], [], [], 0.5)
+            if not ready:
+                continue
+            try:
+                data = os.read(master, 65536)
+            except OSError:
+                break
+            output += data
+            text = output.decode('utf-8', errors='replace')
+            while prompts and prompts[0][0] in text:
+                os.write(master, prompts[0][1].encode() + b"\n")
+                output = output[text.index(prompts[0][0]) + len(prompts[0][0]):]
+                text = output.decode('utf-8', errors='replace')
+                prompts.pop(0)
+            if not prompts and MARKER.encode() in output:
+                elapsed = time.perf_counter() - started
+        if elapsed is None:
+            raise RuntimeError(f"{mode} client did not show the newest message:\n{output[-2000:]!r}")
+    finally:
+        os.write(master, b"\x03")  # Ctrl+C quits the UI
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        os.close(master)
+    return elapsed * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--history", type=int, default=50, help="messages in the channel")
+    parser.add_argument("--size", default="40x120", help="terminal LINESxCOLUMNS")
+    args = parser.parse_args()
+    lines, columns = (int(value) for value in args.size.split("x"))
+
+    python = interpreter_ms("pass", args.runs)
+    print(json.dumps({
+        "stage": "import",
+        "python_ms": round(python, 1),
+        "client_ms": round(interpreter_ms("import client", args.runs) - python, 1),
+        "client_core_ms": round(interpreter_ms("import client_core", args.runs) - python, 1),
+        "slowest_ms": slowest_imports("client", 5),
+    }))
+
+    port = free_port()
+    history_dir = tempfile.mkdtemp(prefix="chat-startup-")
+    server = start_server(port, "async", ["--history-dir", history_dir, "--stats-interval", "0"])
+    try:
+        fill_channel(port, args.history)
+        for mode in ("fast", "interactive"):
+            samples = [first_message_ms(port, mode, lines, columns) for _ in range(args.runs)]
+            print(json.dumps({
+                "stage": "first_message",
+                "mode": mode,
+                "p50_ms": round(percentile(samples, 50), 1),
+                "min_ms": round(min(samples), 1),
+                "max_ms": round(max(samples), 1),
+            }))
+    finally:
+        stop_server(server)
+        shutil.rmtree(history_dir)
+
+
+if __name__ == "__main__":
+    main()
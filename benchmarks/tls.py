@@ -0,0 +1,264 @@
+"""
+Benchmark for TLS on client connections against plaintext.
+
+Generates a self-signed certificate for localhost with the openssl command.
+First times, in-process through tls.TLSStream, the CPU of a full handshake,
+of one that resumes a session, and of encrypting (and decrypting) a message.
+Then, for each server engine, plain and with TLS:
+
+  * handshakes: --concurrency clients connect, join a channel and
+    disconnect again, as in a reconnect storm, for --seconds. With TLS
+    once with a full handshake every time and once resuming the session of
+    the client's previous connection. Reports connections per second,
+    connect-to-join latency and server CPU per connection.
+  * messages: one member sends --messages to a channel of --members, and
+    the server CPU per delivery and bytes written per delivery are reported.
+
+    python -m benchmarks.tls --key-type rsa --concurrency 50
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import timeit
+import urllib.request
+
+from benchmarks.common import cpu_seconds, free_port, percentile, raise_fd_limit, start_server, stop_server
+from protocol import FrameDecoder, encode_message
+from tls import TLSStream, client_context, server_context
+
+KEY_TYPES = {
+    "rsa": ["-newkey", "rsa:2048"],
+    "ec": ["-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:P-256"],
+}
+
+
+def make_certificate(directory, key_type):
+    """A self-signed certificate for localhost; returns (certificate, key) paths"""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", *KEY_TYPES[key_type], "-nodes", "-days", "1", "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1", "-keyout", keyfile, "-out", certfile],
+        check=True, capture_output=True,
+    )
+    return certfile, keyfile
+
+
+def handshake_pair(server_tls, client_tls, session=None):
+    """A client and server TLSStream that have completed a handshake in memory"""
+    server = TLSStream(server_tls, server_side=True)
+    client = TLSStream(client_tls, server_hostname="localhost", session=session)
+    data = client.handshake()
+    while not (client.established and server.established):
+        data = client.handshake(server.handshake(data))
+    # The session tickets follow the server's last handshake message
+    client.decrypt(server.encrypt(b"x"))
+    return server, client
+
+
+def micro(server_tls, client_tls, calls):
+    """Microseconds of CPU, for both ends together, per handshake and per message"""
+    _, client = handshake_pair(server_tls, client_tls)
+    session = client.session
+    assert handshake_pair(server_tls, client_tls, session)[1].resumed
+
+    server, _ = handshake_pair(server_tls, client_tls)
+    # Records must be decrypted in order, so the round trip has a pair of its own
+    writer, reader = handshake_pair(server_tls, client_tls)
+    message = encode_message({
+        "action": "message", "message": "x" * 100, "memberName": "member_abcdefghijk",
+        "timestamp": "12:00:00", "sentAt": 1700000000000,
+    })
+
+    def per_call(function, number):
+        return round(min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6, 1)
+
+    return {
+        "stage": "micro",
+        "full_handshake_us": per_call(lambda: handshake_pair(server_tls, client_tls), max(calls // 100, 10)),
+        "resumed_handshake_us": per_call(lambda: handshake_pair(server_tls, client_tls, session),
+                                         max(calls // 100, 10)),
+        "encrypt_us": per_call(lambda: server.encrypt(message), calls),
+        "record_overhead_bytes": len(server.encrypt(message)) - len(message),
+        "encrypt_and_decrypt_us": per_call(lambda: reader.decrypt(writer.encrypt(message)), calls),
+    }
+
+
+def connect(port, context, session=None):
+    """A blocking client socket, wrapped in TLS when there is a context"""
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if context is None:
+        return sock
+    return context.wrap_socket(sock, server_hostname="localhost", session=session)
+
+
+def request(sock, data, action):
+    """Send a request and read frames until the reply with that action"""
+    sock.sendall(encode_message(data))
+    decoder = FrameDecoder()
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        for payload in decoder.feed(chunk):
+            if json.loads(payload).get("action") == action:
+                return decoder
+
+
+def reconnect_storm(port, context, resume, concurrency, seconds):
+    """Clients join and leave in a loop; returns (connections, resumed, latencies, elapsed)"""
+    latencies = []
+    resumed = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(index):
+        session = None
+        count = 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            sock = connect(port, context, session if resume else None)
+            request(sock, {"action": "joinChannel", "channelName": "bench", "channelPassword": "",
+                           "memberName": f"member{index}_{count}"}, "joinChannel")
+            elapsed = time.perf_counter() - started
+            if context is not None:
+                with lock:
+                    resumed[0] += sock.session_reused
+                session = sock.session
+            sock.close()
+            with lock:
+                latencies.append(elapsed)
+            count += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), resumed[0], latencies, time.perf_counter() - started
+
+
+def bytes_sent(metrics_port):
+    text = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics").read().decode('utf-8')
+    for line in text.splitlines():
+        if line.startswith("chat_bytes_sent_total "):
+            return int(line.split()[1])
+    return 0
+
+
+def fan_out(port, context, members, messages):
+    """One member sends messages to the channel; returns seconds until every member has them"""
+    receivers = []
+    for index in range(members):
+        sock = connect(port, context)
+        decoder = request(sock, {"action": "joinChannel", "channelName": "bench", "channelPassword": "",
+                                 "memberName": f"reader{index}"}, "joinChannel")
+        receivers.append((sock, decoder))
+    sender = connect(port, context)
+    request(sender, {"action": "joinChannel", "channelName": "bench", "channelPassword": "",
+                     "memberName": "sender"}, "joinChannel")
+
+    def receive(sock, decoder):
+        count = 0
+        while count < messages:
+            count += sum(1 for payload in decoder.feed(sock.recv(65536))
+                         if json.loads(payload).get("action") == "message")
+
+    threads = [threading.Thread(target=receive, args=receiver) for receiver in receivers]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    text = "x" * 100
+    for _ in range(messages):
+        sender.sendall(encode_message({"action": "message", "message": text}))
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    for sock, _ in receivers:
+        sock.close()
+    sender.close()
+    return elapsed
+
+
+def run(mode, transport, certificate, args):
+    port = free_port()
+    metrics_port = free_port()
+    extra = ["--stats-interval", "0", "--log-level", "warning", "--session-grace", "0",
+             "--send-queue", str(args.messages + 16), "--metrics", f"tcp:127.0.0.1:{metrics_port}"]
+    context = None
+    if transport != "plain":
+        extra += ["--tls-cert", certificate[0], "--tls-key", certificate[1]]
+        context = client_context(certificate[0])
+    process = start_server(port, mode, extra)
+    try:
+        owner = connect(port, context)
+        request(owner, {"action": "createChannel", "channelName": "bench", "channelPassword": "",
+                        "memberName": "owner"}, "joinChannel")
+
+        for resume in ((False, True) if context is not None else (False,)):
+            cpu = cpu_seconds(process.pid)
+            connections, resumed, latencies, elapsed = reconnect_storm(
+                port, context, resume, args.concurrency, args.seconds
+            )
+            print(json.dumps({
+                "stage": "handshakes",
+                "mode": mode,
+                "transport": transport if not resume else "tls-resumed",
+                "connections_per_sec": round(connections / elapsed),
+                "resumed": round(resumed / connections, 3),
+                "join_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "join_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+                "server_cpu_us_per_connection": round((cpu_seconds(process.pid) - cpu) / connections * 1e6),
+            }))
+
+        cpu = cpu_seconds(process.pid)
+        sent = bytes_sent(metrics_port)
+        elapsed = fan_out(port, context, args.members, args.messages)
+        deliveries = args.members * args.messages
+        print(json.dumps({
+            "stage": "messages",
+            "mode": mode,
+            "transport": transport,
+            "deliveries_per_sec": round(deliveries / elapsed),
+            "server_cpu_us_per_delivery": round((cpu_seconds(process.pid) - cpu) / deliveries * 1e6, 2),
+            "bytes_per_delivery": round((bytes_sent(metrics_port) - sent) / deliveries, 1),
+        }))
+        owner.close()
+    finally:
+        stop_server(process)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    parser.add_argument("--key-type", choices=sorted(KEY_TYPES), default="rsa")
+    parser.add_argument("--concurrency", type=int, default=50, help="clients connecting at once")
+    parser.add_argument("--seconds", type=float, default=5, help="length of each reconnect storm")
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--calls", type=int, default=20000, help="calls per in-process measurement")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    directory = tempfile.mkdtemp(prefix="chat-tls-")
+    try:
+        certificate = make_certificate(directory, args.key_type)
+        print(json.dumps(dict(micro(server_context(*certificate), client_context(certificate[0]), args.calls),
+                              key_type=args.key_type)))
+        for mode in args.modes:
+            for transport in ("plain", "tls"):
+                run(mode, transport, certificate, args)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
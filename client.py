@@ -1,200 +1,490 @@
-import socket
-import threading
+import argparse
+import concurrent.futures
 import json
+import os
+import queue
+import selectors
+import sys
 import curses
 import time
 from datetime import datetime
 
+import codec
+from client_core import JOINED, ClientCore
+from compression import COMPRESSIONS
+from message_store import DEFAULT_CAPACITY, MessageRecord, MessageStore
+from presence import ACTIVE, IDLE, TYPING
+from tls import client_context
+
+# Seconds to wait for the server to answer a create or join request
+JOIN_TIMEOUT = 10
+
+# Seconds without a key press before the channel is told we are idle
+IDLE_AFTER = 300
+
+# What a fast start uses for options given neither on the command line nor in --config
+DEFAULT_OPTIONS = {
+    "host": "localhost",
+    "port": 12345,
+    "channel": None,
+    "name": None,
+    "password": "",
+    "create": False,
+    "history": 50,
+    "scrollback": DEFAULT_CAPACITY,
+    "spill_dir": None,
+    "compress": None,
+    "tls": False,
+    "ca_file": None,
+}
+
 
 class ChatClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, codec_name=codec.BINARY, scrollback=DEFAULT_CAPACITY, spill_dir=None,
+                 compression=None, tls=None):
         self.host = host
         self.port = port
-        self.socket = None
-        self.connected = False
-        self.messages = []
-        self.scroll_pos = 0
+        self.codec_name = codec_name
+        # Networking runs on the core's event loop; its events reach the UI through a queue
+        self.core = ClientCore(host, port, codec_name, on_event=self.receive_event, compression=compression,
+                               tls=tls)
+        self.events = queue.Queue()
+        self.status = ""
+        self.last_error = None
+        self.messages = MessageStore(scrollback, spill_dir)
         self.input_text = ""
         self.cursor_pos = 0
         self.channel_name = ""
         self.member_name = ""
         self.channel_joined = False
-
-    def connect(self):
-        """Connect to the server"""
+        # Every member of the channel and what they are doing
+        self.roster = {}
+        self.last_input = time.monotonic()
+        self.idle = False
+        # Future of the server's answer while a fast start is still joining
+        self.joining = None
+        self.join_deadline = None
+        # The last search, and the offset its next page starts before
+        self.search_request = None
+        self.search_next = None
+        self.wake_reader = None
+        self.wake_writer = None
+        # The message area shows display rows starting at scroll_anchor, a
+        # (message sequence number, wrapped line) pair, unless it is
+        # following the newest messages; drawn_rows identifies what each
+        # screen row showed last time
+        self.scroll_anchor = (0, 0)
+        self.following = True
+        self.drawn_rows = []
+        self.input_dirty = True
+        self.title_dirty = True
+        self.layout_dirty = True
+
+    def receive_event(self, event):
+        """Called on the network thread: queue an event for the UI thread and wake it"""
+        self.events.put(event)
+        self.notify()
+
+    def open_channel(self, action, channel_name, channel_password, member_name, history=None):
+        """
+        Create or join a channel, waiting for the server's answer.
+
+        The connection itself lives on the network thread and keeps running,
+        reconnecting as needed, until disconnect().
+        """
+        future = self.core.start(action, channel_name, channel_password, member_name, history)
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.host, self.port))
-            self.connected = True
+            response = future.result(JOIN_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            self.core.close()
+            response = {"success": False, "message": "timed out waiting for the server"}
+        return self.handle_join_response(response, channel_name, member_name)
+
+    def start_channel(self, action, channel_name, channel_password, member_name, history=None):
+        """
+        Create or join a channel without waiting for the server's answer.
+
+        The UI loop picks the answer up when it arrives (see check_join), so
+        the terminal is set up while the connection is being made. Messages
+        typed in the meantime are sent once the channel is joined.
+        """
+        self.channel_name = channel_name
+        self.member_name = member_name
+        self.joining = self.core.start(action, channel_name, channel_password, member_name, history)
+        self.join_deadline = time.monotonic() + JOIN_TIMEOUT
+        self.joining.add_done_callback(lambda future: self.notify())
+
+    def check_join(self):
+        """Applies the answer to start_channel() once it is in; returns False if the join failed"""
+        if self.joining is None:
             return True
-        except Exception as e:
-            return False
+        if self.joining.done():
+            response = self.joining.result()
+        elif time.monotonic() >= self.join_deadline:
+            self.core.close()
+            response = {"success": False, "message": "timed out waiting for the server"}
+        else:
+            return True
+        self.joining = None
+        self.layout_dirty = True
+        return self.handle_join_response(response, self.channel_name, self.member_name)
+
+    def handle_join_response(self, response_data, channel_name, member_name):
+        """Record channel membership from a joinChannel response"""
+        if response_data and response_data.get("success", False):
+            self.channel_name = channel_name
+            self.member_name = response_data.get("memberName", member_name)
+            self.channel_joined = True
+            return True
+        self.last_error = (response_data or {}).get("message", "no response from server")
+        return False
 
     def create_channel(self, channel_name, channel_password, member_name):
-        """Create a new channel"""
-        if not self.connected:
-            return False
-
-        request = {
-            "action": "createChannel",
-            "channelName": channel_name,
-            "channelPassword": channel_password,
-            "memberName": member_name
-        }
-
-        try:
-            self.socket.send(json.dumps(request).encode('utf-8'))
-            response = self.socket.recv(1024)
-            response_data = json.loads(response.decode('utf-8'))
-            return response_data.get("success", False)
-        except Exception as e:
-            return False
+        """Create a new channel (the server joins its creator automatically)"""
+        return self.open_channel("createChannel", channel_name, channel_password, member_name)
 
-    def join_channel(self, channel_name, channel_password, member_name):
-        """Join an existing channel"""
-        if not self.connected:
-            return False
+    def join_channel(self, channel_name, channel_password, member_name, history_last=50):
+        """Join an existing channel, asking the server to replay its last history_last messages"""
+        history = {"last": history_last} if history_last else None
+        return self.open_channel("joinChannel", channel_name, channel_password, member_name, history)
 
-        request = {
-            "action": "joinChannel",
-            "channelName": channel_name,
-            "channelPassword": channel_password,
-            "memberName": member_name
-        }
-
-        try:
-            self.socket.send(json.dumps(request).encode('utf-8'))
-            response = self.socket.recv(1024)
-            response_data = json.loads(response.decode('utf-8'))
-
-            if response_data.get("success", False):
-                self.channel_name = channel_name
-                self.member_name = member_name
-                self.channel_joined = True
-                return True
-            return False
-        except Exception as e:
-            return False
-
-    def send_message(self, message):
-        """Send a message to the channel"""
-        if not self.channel_joined:
+    def send_message(self, message, to=None):
+        """Queue a message for the channel, or for the members in to; the network thread sends it without blocking the UI"""
+        if not self.channel_joined and self.joining is None:
             return False
+        self.core.send(message, to)
+        return True
 
-        message_data = {
-            "action": "message",
-            "message": message,
-            "timestamp": datetime.now().strftime("%H:%M:%S")
-        }
+    def handle_events(self):
+        """
+        Apply every event the network thread has queued.
 
-        try:
-            self.socket.send(json.dumps(message_data).encode('utf-8'))
-
-            return True
-        except Exception as e:
-            self.messages.append(f"ERROR: Failed to send message: {str(e)}")
-            return False
-
-    def listen_for_messages(self, stdscr):
-        """Listen for incoming messages in a separate thread"""
-        while self.connected and self.channel_joined:
+        Runs on the UI thread, which is the only thread that touches curses
+        or the scrollback.
+        """
+        while True:
             try:
-                message = self.socket.recv(1024)
-                if not message:
-                    break
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return
 
-                data = json.loads(message.decode('utf-8'))
+            action = event.get("action")
+            if action == "message":
+                message_text = event.get("message", "")
+                if message_text:  # Only add if there's actual message content
+                    timestamp = event.get("timestamp", datetime.now().strftime("%H:%M:%S"))
+                    sender = event.get("memberName", "Unknown")
+                    if "to" in event:
+                        # A direct message, shown with who it went to
+                        sender = f"{sender} -> {', '.join(event['to'])}"
+                    self.add_message(message_text, sender, timestamp)
+
+            elif action == "ack":
+                if event.get("missing"):
+                    self.add_message(f"*** not delivered to {', '.join(event['missing'])} (no such member)")
+
+            elif action == "skipped":
+                # The server dropped messages because we fell behind
+                self.add_message(
+                    f"{event.get('count', 0)} messages skipped (connection too slow)", "System",
+                    datetime.now().strftime("%H:%M:%S")
+                )
+
+            elif action == "status":
+                state = event["state"]
+                self.status = "" if state == JOINED else f" ({state})"
+                self.member_name = self.core.member_name or self.member_name
+                self.layout_dirty = True
+                if "message" in event:
+                    self.add_message(f"*** {event['message']}")
+
+            elif action == "search":
+                self.show_search_results(event)
+
+            elif action == "presence":
+                self.roster = event["roster"]
+                self.title_dirty = True
+
+            elif action == "error":
+                self.add_message(f"ERROR: {event.get('message', '')}")
+
+    def search(self, text):
+        """Search the channel's history for words, with from:name to pick a sender"""
+        words = [word for word in text.split() if not word.startswith("from:")]
+        senders = [word[5:] for word in text.split() if word.startswith("from:")]
+        self.search_request = {"query": " ".join(words), "member": senders[-1] if senders else None}
+        self.search_next = None
+        self.core.search(**self.search_request)
+
+    def search_more(self):
+        """Fetch the next page of the last search"""
+        if self.search_next is None:
+            self.add_message("*** no more results")
+            return
+        self.core.search(**self.search_request, before=self.search_next)
+
+    def show_search_results(self, event):
+        """Add a page of search results to the scrollback and jump to it"""
+        if not event.get("enabled", True):
+            self.add_message("*** this server keeps no history to search")
+            return
+        results = event.get("results", [])
+        self.search_next = event.get("next")
+        notes = []
+        if self.search_next is not None:
+            notes.append("/more for older")
+        if not event.get("complete", True):
+            notes.append("older messages are still being indexed")
+        header = f"*** {len(results)} results for '{self.search_request['query']}'" if self.search_request else "***"
+        if notes:
+            header += f" ({', '.join(notes)})"
+
+        first = len(self.messages)
+        self.add_message(header)
+        for result in results:
+            sent_at = result.get("sentAt")
+            if isinstance(sent_at, int):
+                timestamp = datetime.fromtimestamp(sent_at / 1000).strftime("%Y-%m-%d %H:%M")
+            else:
+                timestamp = result.get("timestamp", "")
+            self.add_message(result.get("message", ""), result.get("memberName", "Unknown"), timestamp)
+        # Scroll to the results; scrolling down past them returns to live messages
+        self.scroll_anchor = (first, 0)
+        self.following = False
+
+    def typing_line(self):
+        """Who else is typing, for the title area, or "" if nobody is"""
+        typing = [name for name, state in self.roster.items() if state == TYPING and name != self.member_name]
+        if not typing:
+            return ""
+        if len(typing) == 1:
+            return f"{typing[0]} is typing..."
+        if len(typing) <= 3:
+            return f"{', '.join(typing[:-1])} and {typing[-1]} are typing..."
+        return f"{len(typing)} members are typing..."
+
+    def report_typing(self):
+        """Tell the channel we are typing while there is a message (not a command) in the input line"""
+        if self.input_text.strip() and not self.input_text.lstrip().startswith("/"):
+            self.core.set_presence(TYPING)
+        else:
+            self.core.set_presence(ACTIVE)
 
+    def check_idle(self):
+        """
+        Tells the channel we are idle once no key has been pressed for IDLE_AFTER seconds.
 
+        Returns the seconds until then, or None if we are idle already.
+        """
+        if self.idle:
+            return None
+        remaining = self.last_input + IDLE_AFTER - time.monotonic()
+        if remaining > 0:
+            return remaining
+        self.idle = True
+        self.core.set_presence(IDLE)
+        return None
 
-                member_name = data.get("memberName", "Unknown")
-                message_text = data.get("message", "")
-                timestamp = data.get("timestamp", datetime.now().strftime("%H:%M:%S"))
+    def add_message(self, text, member_name=None, timestamp=None):
+        """Store a message for display; without a member name it is shown as a bare notice"""
+        self.messages.append(MessageRecord(timestamp, member_name, text))
 
-                if message_text:  # Only add if there's actual message content
-                    formatted_message = f"[{timestamp}] {member_name}: {message_text}"
-                    self.messages.append(formatted_message)
-
-                # Auto-scroll to bottom if we're at the bottom
-                message_area_height = self.get_message_area_height()
-                max_scroll = max(0, len(self.messages) - message_area_height)
-                if self.scroll_pos >= max_scroll - 1:  # Near bottom
-                    self.scroll_pos = max_scroll
-
-                # Refresh the display
-                self.draw_interface(stdscr)
-                stdscr.refresh()
-
-            except json.JSONDecodeError as e:
-                # Handle JSON decode errors
-                self.messages.append(f"ERROR: Invalid JSON received: {message.decode('utf-8', errors='ignore')}")
-            except Exception as e:
-                self.messages.append(f"ERROR: Connection error: {str(e)}")
-                break
+    def notify(self):
+        """Wake the UI thread so it handles newly queued events"""
+        if self.wake_writer is not None:
+            try:
+                os.write(self.wake_writer, b"\0")
+            except (BlockingIOError, OSError):
+                pass
 
     def get_message_area_height(self):
         """Get the height of the message display area"""
-        return curses.LINES - 5  # Reserve space for borders and input
-
-    def draw_interface(self, stdscr):
-        """Draw the chat interface"""
-        stdscr.clear()
-
-        # Draw title
-        title = f"Chat Client - Channel: {self.channel_name}"
-        stdscr.addstr(0, 0, title[:curses.COLS - 1])
-
-        # Draw horizontal line
-        stdscr.addstr(1, 0, "-" * (curses.COLS - 1))
-
-        # Draw messages
-        message_area_height = self.get_message_area_height()
-        start_y = 2
-
-        # Calculate which messages to display based on scroll position
-        visible_messages = self.messages[self.scroll_pos:self.scroll_pos + message_area_height]
+        return max(1, curses.LINES - 5)  # Reserve space for borders and input
+
+    def setup_windows(self):
+        """
+        (Re)create the three screen regions for the current terminal size:
+        the title, the message area and the input area.
+        """
+        self.title_window = curses.newwin(2, curses.COLS, 0, 0)
+        self.message_window = curses.newwin(self.get_message_area_height(), curses.COLS, 2, 0)
+        self.input_window = curses.newwin(3, curses.COLS, curses.LINES - 3, 0)
+
+        # Let curses move existing lines with the terminal's scroll
+        # operations instead of rewriting them
+        self.message_window.scrollok(True)
+        self.message_window.idlok(True)
+
+        self.input_window.keypad(True)
+        self.input_window.nodelay(True)
+
+        self.layout_dirty = True
+
+    def draw_interface(self):
+        """
+        Draw whatever changed since the last call and push it to the terminal
+        in one update.
+
+        Each region is only touched when it is dirty: new messages are drawn
+        into the rows they occupy, scrolling shifts the message area and
+        draws the rows it exposes, and typing redraws just the input line.
+        """
+        width = curses.COLS
+        if self.layout_dirty or self.title_dirty:
+            here = f" ({len(self.roster)} here)" if self.roster else ""
+            self.title_window.erase()
+            self.title_window.addstr(0, 0, f"Chat Client - Channel: {self.channel_name}{here}{self.status}"[:width - 1])
+            typing = self.typing_line()
+            ruler = f"-- {typing} " if typing else ""
+            self.title_window.addstr(1, 0, (ruler + "-" * width)[:width - 1])
+            self.title_window.noutrefresh()
+            self.title_dirty = False
+
+        if self.layout_dirty:
+            self.input_window.erase()
+            self.input_window.addstr(0, 0, "-" * (width - 1))
+            help_text = "Ctrl+C: Quit | Up/Down: Scroll | Enter: Send message"
+            self.input_window.addstr(2, 0, help_text[:width - 1])
+            self.input_dirty = True
+
+        self.draw_messages()
 
-        for i, message in enumerate(visible_messages):
-            if start_y + i < curses.LINES - 3:
-                # Truncate message if it's too long
-                display_message = message[:curses.COLS - 1]
-                stdscr.addstr(start_y + i, 0, display_message)
-
-        # Draw input area separator
-        input_y = curses.LINES - 3
-        stdscr.addstr(input_y, 0, "-" * (curses.COLS - 1))
-
-        # Draw input prompt and text
         prompt = "Message: "
-        stdscr.addstr(input_y + 1, 0, prompt)
-
-        # Display input text with cursor
-        input_display = self.input_text
-        if len(input_display) > curses.COLS - len(prompt) - 1:
-            # Scroll input text if it's too long
-            start_pos = max(0, self.cursor_pos - (curses.COLS - len(prompt) - 10))
-            input_display = input_display[start_pos:]
+        if self.input_dirty:
+            # Display input text, scrolling it if it's too long
+            input_display = self.input_text
+            if len(input_display) > width - len(prompt) - 1:
+                start_pos = max(0, self.cursor_pos - (width - len(prompt) - 10))
+                input_display = input_display[start_pos:]
+
+            self.input_window.move(1, 0)
+            self.input_window.clrtoeol()
+            self.input_window.addstr(1, 0, prompt)
+            self.input_window.addstr(1, len(prompt), input_display[:width - len(prompt) - 1])
+            self.input_dirty = False
+
+        # The input window goes last so the terminal cursor ends up in it
+        cursor_x = len(prompt) + min(self.cursor_pos, width - len(prompt) - 1)
+        self.input_window.move(1, cursor_x)
+        self.input_window.noutrefresh()
+
+        self.layout_dirty = False
+        curses.doupdate()
+
+    def bottom_anchor(self, height, width):
+        """The scroll anchor that shows the newest messages at the bottom of the area"""
+        needed = height
+        seq = len(self.messages) - 1
+        while seq >= self.messages.first:
+            lines = len(self.messages.lines(seq, width))
+            if lines >= needed:
+                return seq, lines - needed
+            needed -= lines
+            seq -= 1
+        return self.messages.first, 0
+
+    def visible_rows(self, height, width):
+        """(row key, text) pairs for the rows of the message area, starting at the anchor"""
+        if self.following:
+            self.scroll_anchor = self.bottom_anchor(height, width)
+        elif self.scroll_anchor[0] < self.messages.first:
+            # What we were looking at has been evicted from the scrollback
+            self.scroll_anchor = (self.messages.first, 0)
+
+        rows = []
+        seq, line = self.scroll_anchor
+        count = len(self.messages)
+        while len(rows) < height and seq < count:
+            lines = self.messages.lines(seq, width)
+            for line in range(line, min(len(lines), line + height - len(rows))):
+                rows.append(((seq, line), lines[line]))
+            seq, line = seq + 1, 0
+        return rows
+
+    def scroll(self, direction):
+        """Move the message area one display row up (-1) or down (1)"""
+        height, width = self.message_window.getmaxyx()
+        width -= 1
+        bottom = self.bottom_anchor(height, width)
+        seq, line = bottom if self.following else self.scroll_anchor
+
+        if direction < 0:
+            if line > 0:
+                line -= 1
+            elif seq > self.messages.first:
+                seq -= 1
+                line = len(self.messages.lines(seq, width)) - 1
+        elif (seq, line) < bottom:
+            if line + 1 < len(self.messages.lines(seq, width)):
+                line += 1
+            else:
+                seq, line = seq + 1, 0
+
+        self.scroll_anchor = (seq, line)
+        self.following = self.scroll_anchor >= bottom
+
+    def draw_messages(self):
+        """
+        Draw the message area, touching only rows whose content changed.
+
+        Rows are identified by (message, wrapped line). If the new first row
+        was already on screen the window is scrolled to match and only the
+        rows that moved in are drawn, so the cost depends on the size of the
+        viewport, never on the length of the history.
+        """
+        window = self.message_window
+        height, width = window.getmaxyx()
+        rows = self.visible_rows(height, width - 1)
+        keys = [key for key, _ in rows]
+        keys += [None] * (height - len(keys))
+        previous = self.drawn_rows
+
+        if self.layout_dirty or len(previous) != height:
+            window.erase()
+            previous = [None] * height
+            changed = range(len(rows))
+        else:
+            shift = 0
+            if keys[0] is not None and keys[0] != previous[0]:
+                if keys[0] in previous:
+                    shift = previous.index(keys[0])
+                elif previous[0] in keys:
+                    shift = -keys.index(previous[0])
+                else:
+                    shift = height
+
+            if abs(shift) >= height:
+                window.erase()
+                previous = [None] * height
+            elif shift:
+                window.scroll(shift)
+                if shift > 0:
+                    previous = previous[shift:] + [None] * shift
+                else:
+                    previous = [None] * -shift + previous[:shift]
 
-        stdscr.addstr(input_y + 1, len(prompt), input_display[:curses.COLS - len(prompt) - 1])
+            changed = [row for row in range(height) if keys[row] != previous[row]]
+            if not changed:
+                return
 
-        # Position cursor
-        cursor_x = len(prompt) + min(self.cursor_pos, curses.COLS - len(prompt) - 1)
-        stdscr.move(input_y + 1, cursor_x)
+        for row in changed:
+            window.move(row, 0)
+            window.clrtoeol()
+            if row < len(rows):
+                window.addstr(row, 0, rows[row][1])
 
-        # Draw help text
-        help_text = "Ctrl+C: Quit | Up/Down: Scroll | Enter: Send message"
-        if curses.LINES > input_y + 2:
-            stdscr.addstr(input_y + 2, 0, help_text[:curses.COLS - 1])
+        self.drawn_rows = keys
+        window.noutrefresh()
 
-    def handle_input(self, stdscr, key):
+    def handle_input(self, key):
         """Handle keyboard input"""
-        if key == curses.KEY_UP:
-            # Scroll up
-            self.scroll_pos = max(0, self.scroll_pos - 1)
+        if key == curses.KEY_RESIZE:
+            curses.update_lines_cols()
+            self.setup_windows()
+        elif key == curses.KEY_UP:
+            self.scroll(-1)
         elif key == curses.KEY_DOWN:
-            # Scroll down
-            max_scroll = max(0, len(self.messages) - self.get_message_area_height())
-            self.scroll_pos = min(max_scroll, self.scroll_pos + 1)
+            self.scroll(1)
         elif key == curses.KEY_LEFT:
             # Move cursor left
             self.cursor_pos = max(0, self.cursor_pos - 1)
@@ -206,58 +496,119 @@ class ChatClient:
             if self.cursor_pos > 0:
                 self.input_text = self.input_text[:self.cursor_pos - 1] + self.input_text[self.cursor_pos:]
                 self.cursor_pos -= 1
+                self.input_dirty = True
+                self.report_typing()
         elif key == 10 or key == 13:  # Enter key
             # Send message
             if self.input_text.strip():
                 if self.input_text.strip().lower() == '/test':
                     # Add a test message locally to verify interface works
-                    self.messages.append(f"[{datetime.now().strftime('%H:%M:%S')}] System: Test message added locally")
+                    self.add_message("Test message added locally", "System", datetime.now().strftime('%H:%M:%S'))
+                elif self.input_text.strip().lower().startswith('/search '):
+                    self.search(self.input_text.strip()[8:])
+                elif self.input_text.strip().lower() == '/more':
+                    self.search_more()
+                elif self.input_text.strip().lower().startswith('/msg '):
+                    # /msg name[,name...] text sends to those members only
+                    parts = self.input_text.strip().split(None, 2)
+                    if len(parts) == 3:
+                        self.send_message(parts[2], parts[1].split(','))
+                    else:
+                        self.add_message("*** usage: /msg name[,name...] message")
                 else:
                     self.send_message(self.input_text.strip())
                 self.input_text = ""
                 self.cursor_pos = 0
+                self.input_dirty = True
+                self.report_typing()
         elif 32 <= key <= 126:  # Printable characters
             # Add character to input
             self.input_text = self.input_text[:self.cursor_pos] + chr(key) + self.input_text[self.cursor_pos:]
             self.cursor_pos += 1
+            self.input_dirty = True
+            self.report_typing()
 
-    def run_chat_interface(self, stdscr):
-        """Main chat interface loop"""
-        # Setup curses
+    def start_interface(self):
+        """Prepare the terminal and the screen regions"""
         curses.curs_set(1)  # Show cursor
-        stdscr.nodelay(1)  # Don't block on getch()
-        stdscr.timeout(100)  # Refresh every 100ms
+        self.setup_windows()
+        self.draw_interface()
 
-        # Start message listener thread
-        listener_thread = threading.Thread(target=self.listen_for_messages, args=(stdscr,))
-        listener_thread.daemon = True
-        listener_thread.start()
+    def run_chat_interface(self, stdscr):
+        """
+        Main chat interface loop.
+
+        Nothing is polled: the loop sleeps until a key is pressed or the
+        network thread queues an event, then redraws what changed.
+        """
+        self.start_interface()
+
+        # select() only works on sockets on Windows, so poll the keyboard there
+        selector = None
+        if os.name != "nt":
+            self.wake_reader, self.wake_writer = os.pipe()
+            os.set_blocking(self.wake_reader, False)
+            os.set_blocking(self.wake_writer, False)
+            selector = selectors.DefaultSelector()
+            selector.register(sys.stdin, selectors.EVENT_READ)
+            selector.register(self.wake_reader, selectors.EVENT_READ)
+        else:
+            self.input_window.timeout(100)
 
         # Main input loop
-        while True:
-            try:
-                self.draw_interface(stdscr)
-                stdscr.refresh()
-
-                key = stdscr.getch()
-                if key != -1:  # Key was pressed
-                    if key == 3:  # Ctrl+C
+        try:
+            while True:
+                if not self.check_join():
+                    return
+                self.handle_events()
+
+                while True:
+                    key = self.input_window.getch()
+                    if key == -1:
                         break
-                    self.handle_input(stdscr, key)
-
-                time.sleep(0.01)  # Small delay to prevent high CPU usage
-
-            except KeyboardInterrupt:
-                break
+                    if key == 3:  # Ctrl+C
+                        return
+                    self.last_input = time.monotonic()
+                    if self.idle:
+                        self.idle = False
+                        self.core.set_presence(ACTIVE)
+                    self.handle_input(key)
+                idle_in = self.check_idle()
+
+                self.draw_interface()
+
+                if selector is not None:
+                    # Wake up in time to go idle, and while joining, to give up on the server
+                    timeout = idle_in
+                    if self.joining is not None:
+                        join_in = max(0, self.join_deadline - time.monotonic())
+                        timeout = join_in if timeout is None else min(timeout, join_in)
+                    for key, _ in selector.select(timeout):
+                        if key.fd == self.wake_reader:
+                            try:
+                                while os.read(self.wake_reader, 4096):
+                                    pass
+                            except BlockingIOError:
+                                pass
+
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if selector is not None:
+                selector.close()
+                wake_reader, wake_writer = self.wake_reader, self.wake_writer
+                self.wake_writer = None
+                os.close(wake_reader)
+                os.close(wake_writer)
 
     def disconnect(self):
         """Disconnect from the server"""
-        self.connected = False
-        if self.socket:
-            self.socket.close()
+        self.channel_joined = False
+        self.core.close()
+        self.messages.close()
 
 
-def setup_connection():
+def setup_connection(scrollback=DEFAULT_CAPACITY, spill_dir=None, compression=None, tls=None):
     """Setup connection dialog"""
     print("Chat Client Setup")
     print("-" * 20)
@@ -271,15 +622,6 @@ def setup_connection():
         print("Invalid port number. Using default 12345.")
         port = 12345
 
-    print("\nConnecting to server...")
-    client = ChatClient(host, port)
-
-    if not client.connect():
-        print(f"Failed to connect to {host}:{port}")
-        return None
-
-    print("Connected successfully!")
-
     # Channel setup
     print("\nChannel Setup")
     action = input("Create new channel or join existing? (create/join): ").strip().lower()
@@ -290,22 +632,21 @@ def setup_connection():
 
     if not all([channel_name, member_name]):
         print("Channel name and member name are required.")
-        client.disconnect()
         return None
 
+    # Connecting and joining happen together on the network thread
+    print(f"\nConnecting to {host}:{port}...")
+    client = ChatClient(host, port, scrollback=scrollback, spill_dir=spill_dir, compression=compression,
+                        tls=tls)
+
     if action == "create":
         if client.create_channel(channel_name, channel_password, member_name):
             print("Channel created successfully!")
-            # After creating, we need to join it
-            if client.join_channel(channel_name, channel_password, member_name):
-                print("Joined channel successfully!")
-                return client
-            else:
-                print("Failed to join the created channel.")
-                client.disconnect()
-                return None
+            # The server joins the creator to the new channel automatically
+            print("Joined channel successfully!")
+            return client
         else:
-            print("Failed to create channel.")
+            print(f"Failed to create channel: {client.last_error}")
             client.disconnect()
             return None
     else:
@@ -313,27 +654,107 @@ def setup_connection():
             print("Joined channel successfully!")
             return client
         else:
-            print("Failed to join channel.")
+            print(f"Failed to join channel: {client.last_error}")
             client.disconnect()
             return None
 
 
+def load_options(args):
+    """Options from the command line, then the --config file, then DEFAULT_OPTIONS"""
+    options = dict(DEFAULT_OPTIONS)
+    if args.config:
+        with open(args.config) as config_file:
+            config = json.load(config_file)
+        if not isinstance(config, dict):
+            raise ValueError("expected a JSON object")
+        unknown = set(config) - set(options)
+        if unknown:
+            raise ValueError(f"unknown options: {', '.join(sorted(unknown))}")
+        options.update(config)
+    options.update((key, value) for key, value in vars(args).items() if key in options and value is not None)
+    return options
+
+
+def tls_options(options):
+    """The TLS context the options ask for, or None for a plain connection"""
+    if options["tls"] or options["ca_file"]:
+        return client_context(options["ca_file"])
+    return None
+
+
+def fast_start(options, tls=None):
+    """
+    Start creating or joining the configured channel without any prompts.
+
+    The connection is made on the network thread while the caller sets up
+    the terminal; ChatClient.check_join picks up the server's answer.
+    """
+    client = ChatClient(options["host"], options["port"], scrollback=options["scrollback"],
+                        spill_dir=options["spill_dir"], compression=options["compress"], tls=tls)
+    if options["create"]:
+        client.start_channel("createChannel", options["channel"], options["password"], options["name"])
+    else:
+        history = {"last": options["history"]} if options["history"] else None
+        client.start_channel("joinChannel", options["channel"], options["password"], options["name"], history)
+    return client
+
+
 def main():
-    client = setup_connection()
-    if not client:
-        return
+    parser = argparse.ArgumentParser(
+        description="Console chat client. Given a channel and a name, it connects straight away; "
+                    "otherwise it asks for them."
+    )
+    parser.add_argument("--config", metavar="FILE",
+                        help="JSON object of option values, e.g. {\"host\": ..., \"channel\": ..., \"name\": ...}; "
+                             "command-line options take precedence")
+    parser.add_argument("--host", help=f"server host (default: {DEFAULT_OPTIONS['host']})")
+    parser.add_argument("--port", type=int, help=f"server port (default: {DEFAULT_OPTIONS['port']})")
+    parser.add_argument("--channel", help="channel to join")
+    parser.add_argument("--name", help="your name in the channel")
+    parser.add_argument("--password", help="channel password (visible to other local users; prefer --config)")
+    parser.add_argument("--create", action="store_true", default=None, help="create the channel instead of joining it")
+    parser.add_argument("--history", type=int,
+                        help=f"recent messages to show on joining (default: {DEFAULT_OPTIONS['history']})")
+    parser.add_argument("--scrollback", type=int,
+                        help=f"number of messages kept in memory (default: {DEFAULT_CAPACITY})")
+    parser.add_argument("--spill-dir",
+                        help="keep older messages in a temporary file in this directory instead of dropping them")
+    parser.add_argument("--compress", choices=COMPRESSIONS,
+                        help="ask the server to compress what it sends (deflate: best ratio, "
+                             "deflate-frame: cheapest for the server)")
+    parser.add_argument("--tls", action="store_true", default=None, help="connect to a server that serves TLS")
+    parser.add_argument("--ca-file", metavar="FILE",
+                        help="trust the server certificates signed by this PEM file instead of the system's CAs "
+                             "(implies --tls)")
+    args = parser.parse_args()
+    try:
+        options = load_options(args)
+    except (OSError, ValueError) as e:
+        parser.error(f"cannot read {args.config}: {e}")
+    try:
+        tls = tls_options(options)
+    except OSError as e:
+        parser.error(f"cannot load {options['ca_file']}: {e}")
 
-    print("\nStarting chat interface...")
-    print("Use Ctrl+C to quit, Up/Down arrows to scroll messages")
-    time.sleep(2)
+    if options["channel"] and options["name"]:
+        client = fast_start(options, tls)
+    else:
+        client = setup_connection(options["scrollback"], options["spill_dir"], options["compress"], tls)
+        if not client:
+            return
+        print("\nStarting chat interface...")
+        print("Use Ctrl+C to quit, Up/Down arrows to scroll messages")
 
     try:
         curses.wrapper(client.run_chat_interface)
     except KeyboardInterrupt:
         pass
     finally:
+        joined = client.channel_joined
         client.disconnect()
-        print("\nDisconnected from server. Goodbye!")
+    if not joined and client.last_error is not None:
+        sys.exit(f"Failed to join channel: {client.last_error}")
+    print("\nDisconnected from server. Goodbye!")
 
 
 if __name__ == "__main__":
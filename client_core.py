@@ -0,0 +1,684 @@
+"""
+Non-blocking networking core of the chat client.
+
+ClientCore owns the connection to the server and runs entirely on an asyncio
+event loop: by default one loop shared by every core in the process, running
+in a daemon thread, or a loop supplied by the caller (the load generator
+drives thousands of cores from one). Nothing in here ever blocks the caller.
+
+Everything the server sends, and every change in the connection's state, is
+handed to on_event as a dict. The curses client puts these on a queue and
+drains it from its UI thread, so the UI never touches the socket.
+
+Outbound messages are pipelined: up to `pipeline` messages may be in flight
+at once, each tagged with a "ref" that the server acknowledges with
+{"action": "ack", "ref": N}. Messages that were not acknowledged when the
+connection dropped are sent again after reconnecting, so delivery is
+at-least-once.
+
+A server that rate-limits the member answers a message with
+{"action": "throttled", "ref": N, "retryAfter": seconds} instead of an ack;
+the message goes back to the head of the queue, nothing is sent until
+retryAfter has passed, and the pipeline starts again at one message in
+flight, growing by one with each ack. A server that is full refuses the join with a
+"retryAfter" hint, and the core tries again after at least that long. A
+server that is shutting down sends {"action": "shutdown", "retryAfter":
+seconds} before it closes the connection, and the core reconnects after a
+random part of retryAfter, resuming its session on whichever server has
+taken over.
+
+A dropped connection (EOF, a reset, TCP keepalive giving up, or an
+acknowledgement overdue by more than ack_timeout seconds) is retried with
+exponential backoff and jitter. If the server gave the member a session
+token, the core first tries to resume it, keeping its member name and its
+place in the channel; the server replays what it missed. Otherwise, or once
+the session has expired, it rejoins the channel with the member name it
+first asked for and requests the history it missed since the last message it
+saw. Messages are identified by their "sentAt" stamp, so a replayed message
+the client already has is dropped instead of shown twice. close() tells the
+server the member is leaving, so it is not kept around for a resume.
+
+roster holds every member of the channel and what they are doing (see
+presence.py): it is taken from the join (or resume) reply and updated by the
+server's presence updates, each of which is handed to on_event as a
+{"action": "presence", "changes": {...}, "roster": {...}} event with a copy of
+the whole roster. set_presence() reports typing and idle; repeated typing
+reports are sent at most every TYPING_REFRESH seconds.
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import os
+import random
+import socket
+import ssl
+import threading
+import time
+from collections import OrderedDict, deque
+
+import codec
+from compression import COMPRESSIONS, InflatingDecoder
+from presence import ACTIVE, LEFT, TYPING, TYPING_REFRESH
+from protocol import FrameDecoder, FrameError, encode_frame, encode_message
+from tls import TLSStream
+
+DEFAULT_PIPELINE = 64
+ACK_TIMEOUT = 15.0
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 30.0
+# TCP keepalive: probe after 10 s of silence, every 5 s, give up after 3 misses
+KEEPALIVE = (("TCP_KEEPIDLE", 10), ("TCP_KEEPINTVL", 5), ("TCP_KEEPCNT", 3))
+
+# Connection states reported in "status" events
+CONNECTING = "connecting"
+JOINED = "joined"
+RECONNECTING = "reconnecting"
+FAILED = "failed"
+CLOSED = "closed"
+
+shared_loop = None
+shared_loop_lock = threading.Lock()
+
+
+def network_loop():
+    """The event loop shared by cores that were not given one, started on first use"""
+    global shared_loop
+    with shared_loop_lock:
+        if shared_loop is None:
+            shared_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=shared_loop.run_forever, name="chat-network")
+            thread.daemon = True
+            thread.start()
+        return shared_loop
+
+
+def forget_network_loop():
+    """A forked child does not inherit the loop's thread, so it must start its own"""
+    global shared_loop, shared_loop_lock
+    shared_loop = None
+    shared_loop_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=forget_network_loop)
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class ClientCore(asyncio.Protocol):
+    """
+    One member's connection to a channel, with automatic reconnect and resume.
+
+    With compression ("deflate" or "deflate-frame") the core asks the server
+    to compress what it sends, and inflates it if the server agrees (see
+    compression.py). With tls, an ssl.SSLContext from tls.client_context(),
+    every connection starts with a TLS handshake, and a reconnect resumes
+    the TLS session of the last connection (see tls.py).
+
+    start(), send() and close() may be called from any thread. on_event is
+    called on the event loop's thread.
+    """
+
+    def __init__(self, host, port, codec_name=codec.BINARY, on_event=None, loop=None,
+                 reconnect=True, pipeline=DEFAULT_PIPELINE, ack_timeout=ACK_TIMEOUT,
+                 backoff_initial=BACKOFF_INITIAL, backoff_max=BACKOFF_MAX, compression=None, tls=None):
+        self.host = host
+        self.port = port
+        self.codec_name = codec_name
+        self.compression = compression
+        self.tls_context = tls
+        self.on_event = on_event or (lambda event: None)
+        self.loop = loop
+        self.reconnect = reconnect
+        self.pipeline = pipeline
+        self.ack_timeout = ack_timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self.channel_name = None
+        self.channel_password = None
+        self.requested_name = None
+        self.member_name = None
+        self.history = None
+        self.creator = False
+        self.create = False
+
+        self.task = None
+        self.transport = None
+        self.lost = None
+        self.joined = None
+        self.state = CLOSED
+        self.closing = False
+        self.rejected = False
+        self.failure = None
+        self.retry_after = None
+        self.retry_now = False
+        self.session = None
+        self.throttled_until = 0.0
+        self.throttle_handle = None
+        self.window = pipeline
+        self.decoder = None
+        self.tls = None
+        self.tls_session = None
+        self.binary = False
+        self.members = {}
+        self.roster = {}
+        # What the server was last told this member is doing, and when typing is next reported again
+        self.presence = ACTIVE
+        self.typing_refresh = 0.0
+        self.awaiting = None
+        self.watchdog = None
+
+        self.refs = itertools.count(1)
+        self.outbox = deque()
+        self.unacked = OrderedDict()  # ref -> [message, time sent]
+
+        # Resume position: the newest sentAt seen, and what was seen at that instant
+        self.last_sent_at = None
+        self.seen_at_last = set()
+        self.joined_at = None
+        self.replaying = 0
+
+    # Thread-safe API
+
+    def start(self, action, channel_name, channel_password, member_name, history=None):
+        """
+        Connect and create or join a channel in the background.
+
+        Returns a concurrent.futures.Future of the server's reply to the first
+        join, with "success": False if it was refused or the server could not
+        be reached. Do not wait on it from the event loop's own thread.
+        """
+        if self.loop is None:
+            self.loop = network_loop()
+        self.channel_name = channel_name
+        self.channel_password = channel_password
+        self.requested_name = self.member_name = member_name
+        self.history = history
+        self.creator = self.create = action == "createChannel"
+        self.closing = False
+        self.rejected = False
+        self.failure = None
+        self.session = None
+        self.joined = concurrent.futures.Future()
+        self.call(self.begin)
+        return self.joined
+
+    def send(self, message, to=None):
+        """
+        Queue a chat message; returns the ref its acknowledgement will carry.
+
+        With to (a member name or a list of them), the message goes only to
+        those members, and the acknowledgement lists any that were not found
+        under "missing".
+        """
+        ref = next(self.refs)
+        data = {"action": "message", "message": message, "ref": ref}
+        if to is not None:
+            data["to"] = to
+        self.call(self.queue_message, data)
+        return ref
+
+    def search(self, query, member=None, before=None, limit=20):
+        """
+        Search the channel's history on the server.
+
+        The reply arrives as a {"action": "search", "results": [...]} event,
+        newest first; pass its "next" as before to get the page after it.
+        Nothing is sent while the core is not joined.
+        """
+        request = {"action": "search", "query": query, "limit": limit}
+        if member:
+            request["member"] = member
+        if before is not None:
+            request["before"] = before
+        self.call(self.send_request, request)
+
+    def set_presence(self, state):
+        """Report "typing", "active" or "idle" to the channel; dropped while not joined"""
+        self.call(self.report_presence, state)
+
+    def close(self):
+        """Leave the channel: flush what is written, close the connection, stop reconnecting"""
+        if self.loop is not None:
+            self.call(self.shutdown)
+
+    def call(self, callback, *args):
+        """Run callback on the event loop, directly if we are already on it"""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    # Connection management (event loop only)
+
+    def begin(self):
+        if self.task is None or self.task.done():
+            self.task = self.loop.create_task(self.run())
+
+    async def run(self):
+        delay = self.backoff_initial
+        while not self.closing:
+            self.lost = self.loop.create_future()
+            self.set_state(CONNECTING)
+            try:
+                await self.loop.create_connection(lambda: self, self.host, self.port)
+            except OSError as e:
+                self.failure = f"could not connect: {e}"
+                if self.joined_at is None:
+                    break
+            else:
+                if await self.lost:
+                    # This connection joined, so the next outage starts over
+                    delay = self.backoff_initial
+
+            if self.closing or self.rejected or not self.reconnect:
+                break
+            if self.joined_at is None and self.retry_after is None:
+                break
+
+            wait = max(delay * random.uniform(0.5, 1.0), self.retry_after or 0)
+            reason = self.failure if self.retry_after is not None else "connection lost"
+            if self.retry_now:
+                # The session could not be resumed; join again straight away
+                wait = 0
+            self.retry_after = None
+            self.retry_now = False
+            self.set_state(RECONNECTING, f"{reason}, reconnecting in {wait:.1f}s")
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, self.backoff_max)
+
+        self.finish()
+
+    def finish(self):
+        if self.joined is not None and not self.joined.done():
+            self.joined.set_result({"success": False, "message": self.failure or "closed"})
+        if self.closing or self.failure is None:
+            self.set_state(CLOSED)
+        else:
+            self.set_state(FAILED, self.failure)
+
+    def shutdown(self):
+        self.closing = True
+        if self.transport is not None:
+            if self.session is not None and self.awaiting is None:
+                self.write({"action": "leave"})
+            self.transport.close()
+        elif self.task is not None:
+            self.task.cancel()
+            self.finish()
+
+    def set_state(self, state, message=None):
+        if state == self.state and message is None:
+            return
+        self.state = state
+        event = {"action": "status", "state": state}
+        if message is not None:
+            event["message"] = message
+        self.on_event(event)
+
+    # asyncio.Protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.decoder = FrameDecoder()
+        self.binary = False
+        # Member ids are only meaningful within one connection
+        self.members = {}
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for name, value in KEEPALIVE:
+                if hasattr(socket, name):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+        self.tls = None
+        if self.tls_context is not None:
+            # The request goes out once the TLS handshake is done
+            self.awaiting = "tls"
+            self.tls = TLSStream(self.tls_context, server_hostname=self.host, session=self.tls_session)
+            transport.write(self.tls.handshake())
+            return
+        self.request_channel()
+
+    def request_channel(self):
+        if self.session is not None and self.joined_at is not None:
+            self.awaiting = "resume"
+            self.write(self.resume_request())
+        elif self.create:
+            self.awaiting = "createChannel"
+            self.write(self.join_request("createChannel"))
+        else:
+            self.awaiting = "joinChannel"
+            self.write(self.join_request("joinChannel"))
+
+    def data_received(self, data):
+        if self.tls is not None:
+            try:
+                data = self.decrypt(data)
+            except ssl.SSLError as e:
+                self.failure = f"TLS error: {e}"
+                self.transport.abort()
+                return
+            if data is None:
+                self.transport.close()
+                return
+        try:
+            # One frame at a time until joined: the reply may turn on
+            # compression for whatever follows it in the same read
+            while self.awaiting is not None:
+                payloads = self.decoder.feed(data, limit=1)
+                data = b""
+                if not payloads:
+                    return
+                self.receive(payloads[0])
+                if self.transport is None or self.transport.is_closing():
+                    return
+            payloads = self.decoder.feed(data)
+        except FrameError as e:
+            self.failure = f"protocol error: {e}"
+            self.transport.abort()
+            return
+
+        for payload in payloads:
+            self.receive(payload)
+
+    def decrypt(self, data):
+        """Plaintext from the server, finishing the TLS handshake first; None once it has closed TLS"""
+        if not self.tls.established:
+            self.transport.write(self.tls.handshake(data))
+            if not self.tls.established:
+                return b""
+            self.request_channel()
+            data = b""
+        return self.tls.decrypt(data)
+
+    def receive(self, payload):
+        try:
+            message = self.decode(payload)
+        except ValueError as e:
+            self.on_event({"action": "error", "message": f"undecodable message from server: {e}"})
+            return
+        if self.awaiting is not None:
+            self.handle_handshake(message)
+        else:
+            self.handle(message)
+
+    def connection_lost(self, exc):
+        joined = self.awaiting is None
+        if self.tls is not None and self.tls.established:
+            # Presented when reconnecting, to skip a full handshake
+            self.tls_session = self.tls.session
+        self.transport = None
+        self.awaiting = None
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+            self.watchdog = None
+        if self.lost is not None and not self.lost.done():
+            self.lost.set_result(joined)
+
+    # Protocol handling
+
+    def join_request(self, action):
+        request = {
+            "action": action,
+            "channelName": self.channel_name,
+            "channelPassword": self.channel_password,
+            "memberName": self.requested_name,
+            "resumable": True,
+        }
+        if self.codec_name != codec.JSON:
+            request["codec"] = self.codec_name
+        if self.compression:
+            request["compress"] = self.compression
+        if self.joined_at is None:
+            if self.history:
+                request["history"] = self.history
+        elif action == "joinChannel":
+            # Rejoining: ask for everything since the last message we saw
+            request["history"] = {"since": self.last_sent_at or self.joined_at}
+            self.replaying = -1  # until the history header says how many
+        return request
+
+    def resume_request(self):
+        request = {
+            "action": "resume",
+            "session": self.session,
+            # Used if the channel keeps history; otherwise the server replays
+            # what it buffered while we were away
+            "history": {"since": self.last_sent_at or self.joined_at},
+        }
+        if self.codec_name != codec.JSON:
+            request["codec"] = self.codec_name
+        if self.compression:
+            request["compress"] = self.compression
+        self.replaying = -1
+        return request
+
+    def handle_handshake(self, message):
+        if not message.get("success", False):
+            reason = message.get("message", "request refused")
+            if "retryAfter" in message:
+                # The server is overloaded or shutting down, not refusing us;
+                # try again later, with the session if we have one
+                self.retry_after = message["retryAfter"]
+                self.failure = reason
+            elif self.awaiting == "resume":
+                # Expired, or resumed on a server that never knew it; join instead
+                self.session = None
+                self.retry_now = True
+                self.failure = reason
+            elif self.joined_at is not None and self.creator and reason == "channel does not exist":
+                # The server lost our channel (restarted without history); recreate it
+                self.create = True
+                self.failure = reason
+            else:
+                self.rejected = True
+                self.failure = reason
+                if not self.joined.done():
+                    self.joined.set_result(message)
+            self.transport.close()
+            return
+
+        if self.awaiting == "createChannel":
+            # The server joins the creator automatically; its join reply follows
+            self.awaiting = "joinChannel"
+            self.create = False
+            return
+
+        # Everything after the join (or resume) reply uses the codec and
+        # compression the server accepted
+        self.awaiting = None
+        self.failure = None
+        self.binary = message.get("codec") == codec.BINARY
+        if message.get("compress") in COMPRESSIONS:
+            self.decoder = InflatingDecoder(message["compress"], self.decoder.buffer)
+        self.member_name = message.get("memberName", self.member_name)
+        self.session = message.get("session", self.session)
+        # The server starts every connection active
+        self.presence = ACTIVE
+        if "roster" in message:
+            self.roster = dict(message["roster"])
+            self.on_event({"action": "presence", "changes": {}, "roster": dict(self.roster)})
+        if message.get("action") == "resume":
+            if "count" in message:
+                # No history header: the buffered messages follow the reply
+                self.replaying = message["count"]
+            resumed = f"resumed session in {self.channel_name} as {self.member_name}"
+            if message.get("skipped"):
+                resumed += f"; {message['skipped']} messages were dropped while disconnected"
+            self.set_state(JOINED, resumed)
+        elif self.joined_at is not None:
+            self.set_state(JOINED, f"reconnected to {self.channel_name} as {self.member_name}")
+        else:
+            self.joined_at = now_ms()
+            self.set_state(JOINED)
+        if not self.joined.done():
+            self.joined.set_result(message)
+
+        # Whatever was in flight when the connection dropped goes first
+        for entry in self.unacked.values():
+            entry[1] = time.monotonic()
+            self.write(entry[0])
+        self.pump()
+        self.watchdog = self.loop.call_later(self.ack_timeout / 2, self.check_acks)
+
+    def handle(self, message):
+        action = message.get("action")
+        if action == "member":
+            # A binary member id definition, already recorded by decode()
+            return
+        if action == "ack":
+            self.unacked.pop(message.get("ref"), None)
+            self.window = min(self.window + 1, self.pipeline)
+            self.on_event(message)
+            self.pump()
+            return
+        if action == "throttled":
+            self.throttled(message)
+            return
+        if action == "shutdown":
+            # The server closes the connection next; come back at a random
+            # point within retryAfter so members do not all reconnect at once
+            self.retry_after = random.uniform(0, float(message.get("retryAfter", 0)))
+            self.failure = "server shutting down"
+            return
+        if action == "presence":
+            changes = message.get("changes", {})
+            for name, state in changes.items():
+                if state == LEFT:
+                    self.roster.pop(name, None)
+                else:
+                    self.roster[name] = state
+            self.on_event({"action": "presence", "changes": changes, "roster": dict(self.roster)})
+            return
+
+        if action == "history" and self.replaying == -1:
+            self.replaying = message.get("count", 0)
+            if not message.get("enabled", True):
+                self.on_event({
+                    "action": "status", "state": JOINED,
+                    "message": "the server keeps no history; messages sent while disconnected were missed"
+                })
+            return
+
+        if action == "message":
+            if self.replaying > 0:
+                self.replaying -= 1
+                if self.already_seen(message):
+                    return
+            self.remember(message)
+        self.on_event(message)
+
+    def already_seen(self, message):
+        sent_at = message.get("sentAt")
+        if self.last_sent_at is None or not isinstance(sent_at, int):
+            return False
+        if sent_at < self.last_sent_at:
+            return True
+        return sent_at == self.last_sent_at and self.message_key(message) in self.seen_at_last
+
+    def remember(self, message):
+        sent_at = message.get("sentAt")
+        if not isinstance(sent_at, int):
+            return
+        if self.last_sent_at is None or sent_at > self.last_sent_at:
+            self.last_sent_at = sent_at
+            self.seen_at_last = {self.message_key(message)}
+        elif sent_at == self.last_sent_at:
+            self.seen_at_last.add(self.message_key(message))
+
+    def message_key(self, message):
+        return message.get("memberName"), message.get("message")
+
+    # Outbound messages
+
+    def queue_message(self, message):
+        # Sending a message ends typing on the server too
+        if self.presence == TYPING:
+            self.presence = ACTIVE
+        self.outbox.append(message)
+        self.pump()
+
+    def report_presence(self, state):
+        if self.transport is None or self.awaiting is not None:
+            return
+        now = self.loop.time()
+        if state == self.presence and (state != TYPING or now < self.typing_refresh):
+            return
+        self.presence = state
+        if state == TYPING:
+            self.typing_refresh = now + TYPING_REFRESH
+        self.write({"action": "presence", "state": state})
+
+    def throttled(self, message):
+        """The server refused a message for now: queue it again and pause sending"""
+        entry = self.unacked.pop(message.get("ref"), None)
+        if entry is not None:
+            # Ahead of newer messages, behind older ones refused just before it
+            index = 0
+            while index < len(self.outbox) and self.outbox[index]["ref"] < entry[0]["ref"]:
+                index += 1
+            self.outbox.insert(index, entry[0])
+        retry_after = float(message.get("retryAfter", 1.0))
+        if self.window == self.pipeline:
+            self.set_state(JOINED, f"sending too fast; the server asked to wait {retry_after:.1f}s")
+        # Resend one at a time, widening the window again with each ack
+        self.window = 1
+        self.throttled_until = max(self.throttled_until, self.loop.time() + retry_after)
+        if self.throttle_handle is not None:
+            self.throttle_handle.cancel()
+        self.throttle_handle = self.loop.call_at(self.throttled_until, self.end_throttle)
+
+    def end_throttle(self):
+        self.throttle_handle = None
+        self.pump()
+
+    def pump(self):
+        """Send queued messages while the pipeline has room"""
+        if self.transport is None or self.awaiting is not None or self.throttle_handle is not None:
+            return
+        while self.outbox and len(self.unacked) < self.window:
+            message = self.outbox.popleft()
+            self.unacked[message["ref"]] = [message, time.monotonic()]
+            self.write(message)
+
+    def check_acks(self):
+        """Treat the connection as dead if the oldest message has waited too long for its ack"""
+        self.watchdog = None
+        if self.transport is None:
+            return
+        if self.unacked:
+            _, sent = next(iter(self.unacked.values()))
+            if time.monotonic() - sent > self.ack_timeout:
+                self.failure = "server stopped acknowledging messages"
+                self.transport.abort()
+                return
+        self.watchdog = self.loop.call_later(self.ack_timeout / 2, self.check_acks)
+
+    def send_request(self, request):
+        """Send a request that is neither acknowledged nor resent, if joined"""
+        if self.transport is not None and self.awaiting is None:
+            self.write(request)
+
+    def write(self, message):
+        if self.binary:
+            data = encode_frame(codec.encode(message))
+        else:
+            data = encode_message(message)
+        if self.tls is not None:
+            data = self.tls.encrypt(data)
+        self.transport.write(data)
+
+    def decode(self, payload):
+        if self.binary:
+            return codec.decode(payload, self.members)
+        return json.loads(payload.decode('utf-8'))
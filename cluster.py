@@ -0,0 +1,354 @@
+"""
+Runs several server worker processes behind one listening port and links
+them with a pub/sub bus, so a message sent to a channel on one worker reaches
+members connected to every other worker.
+
+    python cluster.py --workers 4 --port 12345 --mode async
+
+Workers bind the same port with SO_REUSEPORT and the kernel spreads incoming
+connections across them. Each worker connects to a BusHub, which relays
+channel events to every other worker and replays channel creations to workers
+that connect later. The hub listens on a Unix-domain socket by default; give
+it a tcp:HOST:PORT address to link workers on several hosts:
+
+    python cluster.py --workers 0 --bus tcp:0.0.0.0:12400          # hub host
+    python server.py --reuse-port --bus tcp:hub-host:12400          # each worker
+
+Each worker listens for a successor on its own --handoff socket. On SIGHUP
+the workers are restarted one at a time: a new worker takes over the
+listening socket, channels and connections of the old one (see handoff.py)
+before the next is replaced, so a deploy needs no reconnect storm.
+
+With --history-dir DIR each worker keeps its history in DIR/worker-N.
+Workers store the messages the bus relays to them as well as their own, so
+they must never share one history directory.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import queue
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from logs import LOG_LEVELS, setup_logging
+from protocol import HEADER, RECV_SIZE, FrameDecoder
+
+log = logging.getLogger("chat.cluster")
+
+# Bus event kinds
+MESSAGE = 1
+CHANNEL_CREATED = 2
+DIRECT = 3
+
+# kind, channel name length; followed by the channel name and the payload
+EVENT_HEADER = struct.Struct("!BH")
+
+# Bus events wrap client payloads, so they may be a little larger than a client frame
+BUS_MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+
+def encode_event(kind, channel_name, payload):
+    """Build a framed bus event"""
+    name = channel_name.encode('utf-8')
+    body_length = EVENT_HEADER.size + len(name) + len(payload)
+    return b"".join((HEADER.pack(body_length), EVENT_HEADER.pack(kind, len(name)), name, payload))
+
+
+def decode_event(body):
+    """Split an unframed bus event into (kind, channel_name, payload)"""
+    kind, name_length = EVENT_HEADER.unpack_from(body)
+    name_end = EVENT_HEADER.size + name_length
+    return kind, body[EVENT_HEADER.size:name_end].decode('utf-8'), body[name_end:]
+
+
+def parse_address(address):
+    """Turn "unix:PATH" or "tcp:HOST:PORT" into (family, sockaddr)"""
+    scheme, _, rest = address.partition(":")
+    if scheme == "unix":
+        return socket.AF_UNIX, rest
+    if scheme == "tcp":
+        host, _, port = rest.rpartition(":")
+        return socket.AF_INET, (host, int(port))
+    raise ValueError(f"bus address must be unix:PATH or tcp:HOST:PORT, not {address!r}")
+
+
+class Broker:
+    """
+    Interface between a server worker and the bus.
+
+    start() registers a callback that receives (kind, channel_name, payload)
+    for every event published by other workers; publish() must not block.
+    """
+
+    def start(self, on_event):
+        raise NotImplementedError
+
+    def publish(self, kind, channel_name, payload):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalBus:
+    """In-process stand-in for BusHub, linking several Server instances in one process"""
+
+    def __init__(self):
+        self.brokers = []
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def broker(self):
+        broker = LocalBroker(self)
+        with self.lock:
+            self.brokers.append(broker)
+        return broker
+
+    def publish(self, sender, kind, channel_name, payload):
+        with self.lock:
+            if kind == CHANNEL_CREATED:
+                self.channels.setdefault(channel_name, payload)
+            brokers = [broker for broker in self.brokers if broker is not sender]
+        for broker in brokers:
+            if broker.on_event is not None:
+                broker.on_event(kind, channel_name, payload)
+
+
+class LocalBroker(Broker):
+    def __init__(self, bus):
+        self.bus = bus
+        self.on_event = None
+
+    def start(self, on_event):
+        self.on_event = on_event
+        with self.bus.lock:
+            channels = list(self.bus.channels.items())
+        for channel_name, payload in channels:
+            on_event(CHANNEL_CREATED, channel_name, payload)
+
+    def publish(self, kind, channel_name, payload):
+        self.bus.publish(self, kind, channel_name, payload)
+
+    def close(self):
+        with self.bus.lock:
+            if self in self.bus.brokers:
+                self.bus.brokers.remove(self)
+
+
+class SocketBroker(Broker):
+    """
+    Links a worker to a BusHub over a Unix-domain or TCP socket.
+
+    Published events go through a queue to a writer thread, which batches
+    whatever has accumulated into one write; a reader thread decodes incoming
+    events and hands them to the server's callback.
+    """
+
+    def __init__(self, address, connect_timeout=10.0):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.outgoing = queue.SimpleQueue()
+        self.socket = None
+
+    def connect(self):
+        family, sockaddr = parse_address(self.address)
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            bus_socket = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                bus_socket.connect(sockaddr)
+                return bus_socket
+            except OSError:
+                bus_socket.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def start(self, on_event):
+        self.socket = self.connect()
+        log.info("Connected to bus at %s", self.address)
+
+        reader = threading.Thread(target=self.read_events, args=(on_event,), name="bus-reader")
+        reader.daemon = True
+        reader.start()
+
+        writer = threading.Thread(target=self.write_events, name="bus-writer")
+        writer.daemon = True
+        writer.start()
+
+    def publish(self, kind, channel_name, payload):
+        self.outgoing.put(encode_event(kind, channel_name, payload))
+
+    def read_events(self, on_event):
+        decoder = FrameDecoder(max_frame_size=BUS_MAX_FRAME_SIZE)
+        try:
+            while True:
+                data = self.socket.recv(RECV_SIZE)
+                if not data:
+                    break
+                for body in decoder.feed(data):
+                    on_event(*decode_event(body))
+        except OSError as e:
+            log.warning("Bus connection error: %s", e)
+        log.info("Disconnected from bus")
+
+    def write_events(self):
+        try:
+            while True:
+                batch = [self.outgoing.get()]
+                while len(batch) < 1024:
+                    try:
+                        batch.append(self.outgoing.get_nowait())
+                    except queue.Empty:
+                        break
+                self.socket.sendall(b"".join(batch))
+        except OSError as e:
+            log.warning("Bus connection error: %s", e)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+
+class BusHub:
+    """Relays bus events between worker connections"""
+
+    def __init__(self):
+        self.links = set()
+        self.channels = {}
+
+    async def serve(self, address):
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(sockaddr):
+                os.unlink(sockaddr)
+            server = await asyncio.start_unix_server(self.handle_link, sockaddr)
+        else:
+            server = await asyncio.start_server(self.handle_link, *sockaddr)
+        log.info("Bus hub listening on %s", address)
+        return server
+
+    async def handle_link(self, reader, writer):
+        # Bring a late-joining worker up to date with existing channels
+        for frame in self.channels.values():
+            writer.write(frame)
+        self.links.add(writer)
+
+        decoder = FrameDecoder(max_frame_size=BUS_MAX_FRAME_SIZE)
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for body in decoder.feed(data):
+                    frame = HEADER.pack(len(body)) + body
+                    kind, channel_name, _ = decode_event(body)
+                    if kind == CHANNEL_CREATED:
+                        self.channels.setdefault(channel_name, frame)
+                    for link in self.links:
+                        if link is not writer:
+                            link.write(frame)
+        except (ConnectionError, ValueError) as e:
+            log.warning("Bus link error: %s", e)
+        except asyncio.CancelledError:
+            # The hub is shutting down
+            pass
+        finally:
+            self.links.discard(writer)
+            writer.close()
+
+
+def handoff_path(index):
+    return os.path.join(tempfile.gettempdir(), f"chat-handoff-{os.getpid()}-{index}.sock")
+
+
+def spawn_worker(args, index, takeover=False):
+    """Starts worker index; with takeover, it takes over from the worker it replaces"""
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+        "--host", args.host, "--port", str(args.port), "--mode", args.mode,
+        "--reuse-port", "--bus", args.bus, "--log-level", args.log_level,
+        "--handoff", handoff_path(index), *args.server_args,
+    ]
+    if args.history_dir:
+        # Every worker stores what the bus relays to it, so each needs its own
+        command += ["--history-dir", os.path.join(args.history_dir, f"worker-{index}")]
+    if takeover:
+        command += ["--takeover", handoff_path(index)]
+    return subprocess.Popen(command)
+
+
+async def restart_workers(args, workers):
+    """Replaces each worker in turn, waiting for one to hand over before starting the next"""
+    loop = asyncio.get_running_loop()
+    for index, worker in enumerate(workers):
+        workers[index] = spawn_worker(args, index, takeover=worker.poll() is None)
+        await loop.run_in_executor(None, worker.wait)
+        log.info("Restarted worker %d", index)
+
+
+async def run(args):
+    hub = BusHub()
+    server = await hub.serve(args.bus)
+    workers = [spawn_worker(args, index) for index in range(args.workers)]
+    log.info("Started %d workers on %s:%s", len(workers), args.host, args.port)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    restart = asyncio.Event()
+    loop.add_signal_handler(signal.SIGHUP, restart.set)
+
+    try:
+        while not stop.is_set():
+            if restart.is_set():
+                restart.clear()
+                log.info("Restarting workers")
+                await restart_workers(args, workers)
+            if workers and all(worker.poll() is not None for worker in workers):
+                log.info("All workers exited")
+                break
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+        for index in range(len(workers)):
+            if os.path.exists(handoff_path(index)):
+                os.unlink(handoff_path(index))
+        server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run several chat server workers linked by a pub/sub bus")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes to start (0 runs only the bus hub)")
+    parser.add_argument("--mode", default="async", help="server engine used by each worker")
+    parser.add_argument("--bus", default=f"unix:{os.path.join(tempfile.gettempdir(), 'chat-bus.sock')}",
+                        help="bus hub address, unix:PATH or tcp:HOST:PORT")
+    parser.add_argument("--history-dir",
+                        help="keep history in a directory of its own for each worker, worker-N inside this one")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="info",
+                        help="log level of the supervisor and, unless overridden, the workers")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER,
+                        help="extra arguments passed to every worker after --")
+    args = parser.parse_args()
+    if args.server_args[:1] == ["--"]:
+        args.server_args = args.server_args[1:]
+
+    setup_logging(args.log_level)
+    asyncio.run(run(args))
@@ -0,0 +1,350 @@
+"""
+Compact binary wire codec, negotiated per connection as an alternative to JSON.
+
+A client asks for it with "codec": "binary" in its createChannel/joinChannel
+request. A server that supports it confirms with "codec": "binary" in the join
+reply, which is still JSON, and every frame after that reply is binary in both
+directions. Clients that do not ask, and servers that do not answer, keep
+talking JSON.
+
+Every binary payload starts with a kind byte. Chat messages, by far the most
+common payload, have fixed layouts:
+
+    KIND_BROADCAST  server -> client: member id (uint32), sentAt (uint64 ms), UTF-8 text
+    KIND_SEND       client -> server: UTF-8 text
+    KIND_SEND_REF   client -> server: ref (uint32) to acknowledge, UTF-8 text
+
+Member names are interned per channel: broadcasts carry a small integer id,
+and the server sends a {"action": "member", "memberId", "memberName"}
+definition the first time a connection meets an id. The "timestamp" string is
+left out in favour of the sentAt epoch time and rebuilt on decode.
+
+Everything else, including messages that carry extra fields, is KIND_MAP
+followed by a msgpack-encoded map. Well-known keys and actions in that map are
+small integers.
+"""
+import struct
+import sys
+import threading
+import time
+
+from protocol import encode_frame
+
+JSON = "json"
+BINARY = "binary"
+CODECS = (JSON, BINARY)
+
+KIND_BROADCAST = 1
+KIND_SEND = 2
+KIND_MAP = 3
+KIND_SEND_REF = 4
+
+BROADCAST = struct.Struct("!BIQ")  # kind, member id, sentAt
+SEND_REF = struct.Struct("!BI")  # kind, ref
+
+# Codes are positions in these tuples; only ever append to them
+ACTIONS = ("message", "createChannel", "joinChannel", "history", "skipped", "error", "member", "ack", "throttled",
+           "resume", "leave", "search", "presence", "shutdown")
+KEYS = (
+    "action", "message", "memberName", "memberId", "timestamp", "sentAt", "channelName",
+    "channelPassword", "channelId", "success", "count", "history", "last", "since", "limit",
+    "enabled", "codec", "ref", "retryAfter", "session", "resumable",
+    "to", "missing", "query", "member", "until", "before", "results", "next", "indexedFrom", "complete",
+    "compress", "roster", "changes", "state",
+)
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+KEY_CODES = {key: code for code, key in enumerate(KEYS)}
+
+BROADCAST_FIELDS = frozenset(("action", "message", "memberName", "timestamp", "sentAt"))
+SEND_FIELDS = frozenset(("action", "message"))
+SEND_REF_FIELDS = SEND_FIELDS | {"ref"}
+
+
+class CodecError(ValueError):
+    """Raised when a binary payload cannot be decoded"""
+
+
+def pack(value, out):
+    """Append the msgpack encoding of a None/bool/int/float/str/bytes/list/dict value to out"""
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -32 <= value < 0:
+            out.append(value & 0xff)
+        elif 0 <= value <= 0xff:
+            out += struct.pack("!BB", 0xcc, value)
+        elif 0 <= value <= 0xffff:
+            out += struct.pack("!BH", 0xcd, value)
+        elif 0 <= value <= 0xffffffff:
+            out += struct.pack("!BI", 0xce, value)
+        elif 0 <= value <= 0xffffffffffffffff:
+            out += struct.pack("!BQ", 0xcf, value)
+        elif -0x80000000 <= value < 0:
+            out += struct.pack("!Bi", 0xd2, value)
+        elif -0x8000000000000000 <= value < 0:
+            out += struct.pack("!Bq", 0xd3, value)
+        else:
+            raise CodecError(f"integer {value} does not fit in 64 bits")
+    elif isinstance(value, float):
+        out += struct.pack("!Bd", 0xcb, value)
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        length = len(data)
+        if length < 32:
+            out.append(0xa0 | length)
+        elif length <= 0xff:
+            out += struct.pack("!BB", 0xd9, length)
+        elif length <= 0xffff:
+            out += struct.pack("!BH", 0xda, length)
+        else:
+            out += struct.pack("!BI", 0xdb, length)
+        out += data
+    elif isinstance(value, (bytes, bytearray)):
+        length = len(value)
+        if length <= 0xff:
+            out += struct.pack("!BB", 0xc4, length)
+        elif length <= 0xffff:
+            out += struct.pack("!BH", 0xc5, length)
+        else:
+            out += struct.pack("!BI", 0xc6, length)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        length = len(value)
+        if length < 16:
+            out.append(0x90 | length)
+        elif length <= 0xffff:
+            out += struct.pack("!BH", 0xdc, length)
+        else:
+            out += struct.pack("!BI", 0xdd, length)
+        for item in value:
+            pack(item, out)
+    elif isinstance(value, dict):
+        length = len(value)
+        if length < 16:
+            out.append(0x80 | length)
+        elif length <= 0xffff:
+            out += struct.pack("!BH", 0xde, length)
+        else:
+            out += struct.pack("!BI", 0xdf, length)
+        for key, item in value.items():
+            pack(key, out)
+            pack(item, out)
+    else:
+        raise CodecError(f"cannot encode {type(value).__name__}")
+
+
+# Fixed-size msgpack types: marker -> struct format of the value that follows
+FIXED = {
+    0xcc: struct.Struct("!B"), 0xcd: struct.Struct("!H"), 0xce: struct.Struct("!I"),
+    0xcf: struct.Struct("!Q"), 0xd0: struct.Struct("!b"), 0xd1: struct.Struct("!h"),
+    0xd2: struct.Struct("!i"), 0xd3: struct.Struct("!q"), 0xca: struct.Struct("!f"),
+    0xcb: struct.Struct("!d"),
+}
+# Variable-size msgpack types: marker -> struct format of their length
+LENGTHS = {
+    0xd9: struct.Struct("!B"), 0xda: struct.Struct("!H"), 0xdb: struct.Struct("!I"),
+    0xc4: struct.Struct("!B"), 0xc5: struct.Struct("!H"), 0xc6: struct.Struct("!I"),
+    0xdc: struct.Struct("!H"), 0xdd: struct.Struct("!I"),
+    0xde: struct.Struct("!H"), 0xdf: struct.Struct("!I"),
+}
+
+
+def unpack(data, offset=0):
+    """Decode one msgpack value from data at offset; returns (value, next offset)"""
+    marker = data[offset]
+    offset += 1
+
+    if marker < 0x80:
+        return marker, offset
+    if marker >= 0xe0:
+        return marker - 0x100, offset
+    if marker == 0xc0:
+        return None, offset
+    if marker == 0xc2:
+        return False, offset
+    if marker == 0xc3:
+        return True, offset
+    if marker in FIXED:
+        fixed = FIXED[marker]
+        return fixed.unpack_from(data, offset)[0], offset + fixed.size
+
+    if 0xa0 <= marker <= 0xbf:
+        kind, length = "str", marker & 0x1f
+    elif 0x90 <= marker <= 0x9f:
+        kind, length = "array", marker & 0x0f
+    elif 0x80 <= marker <= 0x8f:
+        kind, length = "map", marker & 0x0f
+    elif marker in LENGTHS:
+        size = LENGTHS[marker]
+        length = size.unpack_from(data, offset)[0]
+        offset += size.size
+        if marker in (0xd9, 0xda, 0xdb):
+            kind = "str"
+        elif marker in (0xc4, 0xc5, 0xc6):
+            kind = "bin"
+        elif marker in (0xdc, 0xdd):
+            kind = "array"
+        else:
+            kind = "map"
+    else:
+        raise CodecError(f"unsupported msgpack type 0x{marker:02x}")
+
+    if kind in ("str", "bin"):
+        end = offset + length
+        if end > len(data):
+            raise CodecError("truncated payload")
+        value = bytes(data[offset:end])
+        return (value.decode('utf-8') if kind == "str" else value), end
+
+    if kind == "array":
+        items = []
+        for _ in range(length):
+            item, offset = unpack(data, offset)
+            items.append(item)
+        return items, offset
+
+    fields = {}
+    for _ in range(length):
+        key, offset = unpack(data, offset)
+        fields[key], offset = unpack(data, offset)
+    return fields, offset
+
+
+def pack_message(data, member_id=None):
+    """Encode a message dict, replacing its memberName with member_id if one is given"""
+    text = data.get("message")
+    if data.get("action") == "message" and isinstance(text, str):
+        if member_id is not None and isinstance(data.get("sentAt"), int) and data.keys() <= BROADCAST_FIELDS:
+            return BROADCAST.pack(KIND_BROADCAST, member_id, data["sentAt"]) + text.encode('utf-8')
+        if member_id is None and data.keys() <= SEND_FIELDS:
+            return bytes((KIND_SEND,)) + text.encode('utf-8')
+        ref = data.get("ref")
+        if member_id is None and data.keys() == SEND_REF_FIELDS and isinstance(ref, int) and 0 <= ref <= 0xffffffff:
+            return SEND_REF.pack(KIND_SEND_REF, ref) + text.encode('utf-8')
+
+    fields = {}
+    for key, value in data.items():
+        if member_id is not None:
+            if key == "memberId":
+                continue
+            if key == "memberName":
+                key, value = "memberId", member_id
+        if key == "action":
+            value = ACTION_CODES.get(value, value)
+        fields[KEY_CODES.get(key, key)] = value
+
+    out = bytearray((KIND_MAP,))
+    pack(fields, out)
+    return bytes(out)
+
+
+def encode(data):
+    """Encode a message dict as a binary payload"""
+    return pack_message(data)
+
+
+def decode(payload, members=None):
+    """
+    Decode a binary payload into a message dict.
+
+    With a members dict (member id -> name), "member" definitions are recorded
+    in it and memberId is resolved back to memberName.
+    """
+    try:
+        kind = payload[0]
+        if kind == KIND_BROADCAST:
+            _, member_id, sent_at = BROADCAST.unpack_from(payload)
+            data = {
+                "action": "message",
+                "message": bytes(payload[BROADCAST.size:]).decode('utf-8'),
+                "memberId": member_id,
+                "sentAt": sent_at,
+            }
+        elif kind == KIND_SEND:
+            data = {"action": "message", "message": bytes(payload[1:]).decode('utf-8')}
+        elif kind == KIND_SEND_REF:
+            _, ref = SEND_REF.unpack_from(payload)
+            data = {"action": "message", "message": bytes(payload[SEND_REF.size:]).decode('utf-8'), "ref": ref}
+        elif kind == KIND_MAP:
+            fields, end = unpack(payload, 1)
+            if not isinstance(fields, dict) or end != len(payload):
+                raise CodecError("payload is not a single map")
+            data = {}
+            for key, value in fields.items():
+                if isinstance(key, int):
+                    if not 0 <= key < len(KEYS):
+                        raise CodecError(f"unknown key code {key}")
+                    key = KEYS[key]
+                data[key] = value
+            action = data.get("action")
+            if isinstance(action, int):
+                if not 0 <= action < len(ACTIONS):
+                    raise CodecError(f"unknown action code {action}")
+                data["action"] = ACTIONS[action]
+        else:
+            raise CodecError(f"unknown payload kind {kind}")
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError, RecursionError) as e:
+        raise CodecError(f"malformed binary payload: {e}") from e
+
+    if "timestamp" not in data and isinstance(data.get("sentAt"), int):
+        data["timestamp"] = time.strftime("%H:%M:%S", time.localtime(data["sentAt"] // 1000))
+
+    if members is not None and "memberId" in data:
+        if data.get("action") == "member":
+            members[data["memberId"]] = data.get("memberName", "")
+        else:
+            data.setdefault("memberName", members.get(data["memberId"], f"member#{data['memberId']}"))
+    return data
+
+
+class MemberIds:
+    """
+    Interns the member names of one channel as small integers.
+
+    Ids are never reused, so a client can cache them for the whole session.
+    Each id keeps its framed "member" definition, ready to be sent to
+    connections that have not met that member yet.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.definitions = {}
+        self.size = 0  # bytes held by interned names and definitions
+        self.lock = threading.Lock()
+
+    def intern(self, member_name):
+        member_id = self.ids.get(member_name)
+        if member_id is None:
+            with self.lock:
+                member_id = self.ids.get(member_name)
+                if member_id is None:
+                    member_id = len(self.ids) + 1
+                    self.definitions[member_id] = encode_frame(pack_message({
+                        "action": "member",
+                        "memberId": member_id,
+                        "memberName": member_name
+                    }))
+                    self.ids[member_name] = member_id
+                    self.size += sys.getsizeof(member_name) + sys.getsizeof(self.definitions[member_id])
+        return member_id
+
+
+class BinarySession:
+    """Binary codec state of one connection: its channel's member ids and which it has seen"""
+
+    def __init__(self, members):
+        self.members = members
+        self.known = set()
+
+    def frame(self, member_id, framed):
+        """Prefix a framed payload with the member definition if this peer has not had it yet"""
+        if member_id is None or member_id in self.known:
+            return framed
+        self.known.add(member_id)
+        return self.members.definitions[member_id] + framed
@@ -0,0 +1,128 @@
+"""
+Optional compression of what a server sends to a client, negotiated per connection.
+
+A framed client asks for it with "compress": "deflate" or "deflate-frame" in
+its createChannel/joinChannel (or resume) request. A server that accepts
+confirms the mode in the join reply, which is itself sent uncompressed, and
+everything it sends after the reply is compressed. What the client sends is
+never compressed. Both modes use raw deflate primed with DICTIONARY, which
+holds the strings that start most frames, so even the first message
+compresses well.
+
+    deflate        One deflate stream per connection. Whatever the connection
+                   writes at once (up to a batch of messages) is compressed
+                   with the stream's context and flushed with Z_SYNC_FLUSH, so
+                   every message is matched against those before it. Best
+                   ratio, but each recipient's copy is compressed separately,
+                   and each connection keeps a context of about 64 KiB.
+    deflate-frame  Every chunk a connection queues (one message, with any
+                   binary member definitions it needs, or a history batch) is
+                   compressed on its own and sent as one frame. A broadcast is
+                   compressed once and the same bytes go to every recipient
+                   with the same wire format, like its encoding.
+
+In both modes the bytes, once inflated, are the usual frames in the
+negotiated codec. Compression happens after fan-out encoding: a
+deflate-frame message is compressed in EncodedMessage, and a deflate stream
+only as bytes leave the member's Outbox, so a slow-consumer policy dropping
+queued messages never leaves a hole in the stream.
+"""
+import zlib
+
+from protocol import MAX_FRAME_SIZE, FrameDecoder, FrameError, encode_frame
+
+STREAM = "deflate"
+FRAMES = "deflate-frame"
+COMPRESSIONS = (STREAM, FRAMES)
+
+LEVEL = 6
+# Raw deflate (no zlib header). An 8 KiB window keeps a stream's context
+# small; a frame compressed on its own needs even less, and a smaller
+# context is quicker to set up for every frame.
+WINDOW_BITS = -13
+MEM_LEVEL = 6
+FRAME_WINDOW_BITS = -11
+FRAME_MEM_LEVEL = 4
+# Most bytes compressed into one deflate-frame frame
+CHUNK_SIZE = MAX_FRAME_SIZE // 2
+
+# Deflate prefers the nearest match, so the most common strings come last
+DICTIONARY = (
+    '{"action": "history", "channelName": "", "count": '
+    '{"action": "search", "channelName": "", "results": [{"offset": '
+    '{"action": "skipped", "count": '
+    '{"action": "error", "message": "'
+    '{"action": "throttled", "ref": , "retryAfter": 0.'
+    '{"action": "ack", "ref": '
+    '{"action": "member", "memberId": , "memberName": "'
+    '", "to": ["'
+    '{"action": "message", "message": "'
+    ' the and you to that it is for in of this on with have be what just'
+    '", "memberName": "'
+    '", "timestamp": "'
+    '", "sentAt": 17'
+).encode('utf-8')
+
+
+def compressor(level=LEVEL, window_bits=WINDOW_BITS, mem_level=MEM_LEVEL):
+    return zlib.compressobj(level, zlib.DEFLATED, window_bits, mem_level, zdict=DICTIONARY)
+
+
+def decompressor():
+    # The largest window inflates streams compressed with any smaller one
+    return zlib.decompressobj(-15, zdict=DICTIONARY)
+
+
+def deflate_frames(data, level=LEVEL):
+    """
+    Compress bytes on their own into deflate-frame frames.
+
+    Usually one frame; a long run of history is cut into pieces that stay
+    under MAX_FRAME_SIZE even if they do not compress. The client joins the
+    inflated pieces back into one stream of frames.
+    """
+    frames = []
+    for start in range(0, len(data), CHUNK_SIZE):
+        context = compressor(level, FRAME_WINDOW_BITS, FRAME_MEM_LEVEL)
+        frames.append(encode_frame(context.compress(data[start:start + CHUNK_SIZE]) + context.flush()))
+    return frames[0] if len(frames) == 1 else b"".join(frames)
+
+
+class StreamCompressor:
+    """The deflate stream of one connection; its Outbox compresses every write with it"""
+
+    def __init__(self, level=LEVEL):
+        self.context = compressor(level)
+
+    def compress(self, data):
+        return self.context.compress(data) + self.context.flush(zlib.Z_SYNC_FLUSH)
+
+
+class InflatingDecoder:
+    """
+    Client-side FrameDecoder for a compressed connection.
+
+    Inflates what the server sent and splits the result into frames. pending
+    holds bytes that arrived after the join reply in the same read, which
+    were already compressed.
+    """
+
+    framed = True
+
+    def __init__(self, compression, pending=b""):
+        self.frames = FrameDecoder()
+        self.chunks = FrameDecoder() if compression == FRAMES else None
+        self.stream = decompressor() if compression == STREAM else None
+        self.pending = bytes(pending)
+
+    def feed(self, data):
+        if self.pending:
+            data, self.pending = self.pending + data, b""
+        try:
+            if self.stream is not None:
+                inflated = self.stream.decompress(data)
+            else:
+                inflated = b"".join(decompressor().decompress(chunk) for chunk in self.chunks.feed(data))
+        except zlib.error as e:
+            raise FrameError(f"corrupt compressed data: {e}")
+        return self.frames.feed(inflated)
@@ -0,0 +1,393 @@
+import heapq
+import json
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from codec import pack_message
+from compression import FRAMES, deflate_frames
+from protocol import encode_frame
+
+SLOW_CONSUMER_POLICIES = ("drop", "disconnect", "coalesce")
+DEFAULT_QUEUE_LIMIT = 1024
+
+# Non-blocking send on an otherwise blocking socket. Platforms without
+# MSG_DONTWAIT fall back to blocking writes.
+SEND_FLAGS = getattr(socket, "MSG_DONTWAIT", 0)
+
+# Most messages written to one socket in a single vectored write; also the
+# point at which a batch is written without waiting out its delay.
+BATCH_MESSAGES = 64
+
+
+def tune_socket(sock, batching=False, send_buffer=None):
+    """
+    Sets the socket options for a client connection.
+
+    A batching server coalesces writes itself, so Nagle's algorithm would
+    only hold back the tail of each batch until the peer's delayed ACK:
+    TCP_NODELAY is set. Without batching, Nagle is what merges the tiny
+    segments of a fast channel and is left on. send_buffer sets SO_SNDBUF;
+    by default the kernel sizes the buffer itself.
+    """
+    if batching:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if send_buffer:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+
+
+class EncodedMessage:
+    """
+    A message serialized once and shared by every recipient of a broadcast.
+
+    The framed form is built on first use and then reused for every framed
+    member, so a fan-out to N members costs one json.dumps and one header.
+    Likewise the binary form is encoded once, with the channel's interned
+    member id, for all members that negotiated the binary codec, and each
+    form is compressed once for the members that negotiated deflate-frame.
+    """
+
+    __slots__ = ("payload", "data", "_framed", "_binary", "_deflated")
+
+    def __init__(self, payload, data=None):
+        self.payload = payload
+        self.data = data
+        self._framed = None
+        self._binary = None
+        self._deflated = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(json.dumps(data).encode('utf-8'), data)
+
+    @property
+    def framed(self):
+        if self._framed is None:
+            self._framed = encode_frame(self.payload)
+        return self._framed
+
+    def binary(self, members):
+        """(member id, framed binary payload), with memberName interned in a MemberIds table"""
+        if self._binary is None:
+            data = self.data if self.data is not None else json.loads(self.payload.decode('utf-8'))
+            member_id = members.intern(data["memberName"]) if "memberName" in data else None
+            self._binary = (member_id, encode_frame(pack_message(data, member_id)))
+        return self._binary
+
+    def for_connection(self, connection):
+        """The bytes to queue for a connection, in the wire format it negotiated"""
+        session = connection.binary
+        if session is not None:
+            data = session.frame(*self.binary(session.members))
+        else:
+            data = self.framed if connection.framed else self.payload
+        if connection.compression == FRAMES:
+            return self.deflated(data)
+        return data
+
+    def deflated(self, data):
+        """data compressed as one frame; built once for a form that every recipient shares"""
+        if data is not self._framed and (self._binary is None or data is not self._binary[1]):
+            # Prefixed with binary member definitions for this connection alone
+            return deflate_frames(data)
+        if self._deflated is None:
+            self._deflated = {}
+        deflated = self._deflated.get(id(data))
+        if deflated is None:
+            deflated = self._deflated[id(data)] = deflate_frames(data)
+        return deflated
+
+
+class Outbox:
+    """
+    Bounded queue of encoded messages waiting to be written to one member.
+
+    When the queue is full the slow-consumer policy decides what happens:
+      * drop - the new message is discarded
+      * disconnect - push() returns False and the caller drops the member
+      * coalesce - everything still queued is replaced by a single "skipped"
+        notice, so the member resumes at the live edge of the channel
+
+    Once compress() is called, queued messages are compressed with the
+    connection's deflate stream as they leave the queue: each peek_many()
+    moves a batch into `wire`, which is written out before the next batch.
+    Once encrypt() is called, the same happens with the connection's TLS
+    stream, after any compression. The policies only ever drop messages
+    that have not left the queue yet.
+    """
+
+    def __init__(self, encode, limit=DEFAULT_QUEUE_LIMIT, policy="drop", drop_counter=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"unknown slow consumer policy: {policy}")
+        self.encode = encode
+        self.limit = limit
+        self.policy = policy
+        self.drop_counter = drop_counter
+        self.queue = deque()
+        self.offset = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.compressor = None
+        self.cipher = None
+        self.wire = b""
+
+    def __len__(self):
+        return len(self.queue) + (1 if self.wire else 0)
+
+    @property
+    def transformed(self):
+        """Whether queued bytes are compressed or encrypted on their way out"""
+        return self.compressor is not None or self.cipher is not None
+
+    def compress(self, compressor):
+        """Compress everything queued from now on; what is already queued goes out as it is"""
+        self.seal()
+        self.compressor = compressor
+
+    def encrypt(self, cipher):
+        """Encrypt everything queued from now on with a tls.TLSStream"""
+        self.seal()
+        self.cipher = cipher
+
+    def seal(self):
+        """Moves everything queued into `wire` as it would have been written so far"""
+        if self.transformed:
+            unsent = bytes(memoryview(self.wire)[self.offset:])
+            self.wire = unsent + self.transform(self.take(len(self.queue)))
+        else:
+            self.wire = b"".join(bytes(chunk) for chunk in self.peek_many(len(self.queue)))
+            self.queue.clear()
+        self.offset = 0
+
+    def push(self, data):
+        """Queue bytes for writing; returns False if the member should be disconnected"""
+        if len(self.queue) >= self.limit:
+            if self.policy == "disconnect":
+                return False
+
+            if self.policy == "drop":
+                self.dropped += 1
+                if self.drop_counter is not None:
+                    self.drop_counter.inc()
+                return True
+
+            # coalesce: keep only a message that is already partly written
+            head = self.queue.popleft() if self.offset and not self.transformed else None
+            discarded = sum(1 for item in self.queue if item is not None)
+            self.queue.clear()
+            if head is not None:
+                self.queue.append(head)
+            self.skipped += discarded
+            self.dropped += discarded
+            if self.drop_counter is not None:
+                self.drop_counter.inc(discarded)
+            self.queue.append(None)
+
+        self.queue.append(data)
+        return True
+
+    def peek(self):
+        """Return the unsent bytes of the oldest queued message, or None if empty"""
+        if not self.queue:
+            return None
+        if self.queue[0] is None:
+            # Materialize the skipped notice with the count at delivery time
+            self.queue[0] = self.encode({"action": "skipped", "count": self.skipped})
+            self.skipped = 0
+        return memoryview(self.queue[0])[self.offset:]
+
+    def peek_many(self, limit=BATCH_MESSAGES):
+        """The unsent bytes of up to `limit` queued messages, oldest first, for one vectored write"""
+        if self.transformed:
+            return self.peek_wire(limit)
+        chunks = []
+        for index, data in enumerate(self.queue):
+            if index == limit:
+                break
+            if data is None:
+                data = self.queue[index] = self.encode({"action": "skipped", "count": self.skipped})
+                self.skipped = 0
+            chunks.append(memoryview(data)[self.offset:] if index == 0 else data)
+        return chunks
+
+    def peek_wire(self, limit):
+        if not self.wire:
+            if not self.queue:
+                return []
+            self.wire = self.transform(self.take(limit))
+        return [memoryview(self.wire)[self.offset:]]
+
+    def take(self, limit):
+        """Removes up to `limit` messages from the queue and returns their bytes"""
+        batch = []
+        while self.queue and len(batch) < limit:
+            data = self.queue.popleft()
+            if data is None:
+                data = self.encode({"action": "skipped", "count": self.skipped})
+                self.skipped = 0
+            batch.append(data)
+        return b"".join(batch)
+
+    def transform(self, data):
+        if not data:
+            return data
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if self.cipher is not None:
+            data = self.cipher.encrypt(data)
+        return data
+
+    def consume(self, sent):
+        """Record that `sent` bytes were written, from the oldest message onwards"""
+        if self.transformed:
+            self.offset += sent
+            if self.offset >= len(self.wire):
+                self.wire = b""
+                self.offset = 0
+            return
+        while self.queue:
+            remaining = len(self.queue[0]) - self.offset
+            if sent < remaining:
+                self.offset += sent
+                return
+            sent -= remaining
+            self.queue.popleft()
+            self.offset = 0
+
+
+class LatencyWindow:
+    """Keeps the most recent latency samples and reports percentiles over them"""
+
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentiles(self, points=(50, 90, 99)):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {}
+        return {
+            f"p{point}": ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))]
+            for point in points
+        }
+
+
+class FanoutWriter:
+    """
+    Background thread that finishes writes the broadcasting thread could not
+    complete without blocking.
+
+    Connections hand themselves over with watch() when their socket buffer is
+    full; the writer waits for them to become writable and drains their
+    outbox, so a slow reader never stalls the thread that is broadcasting.
+
+    Batching connections also defer() their writes; the writer calls their
+    flush_deferred() once the deadline passes.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.requests = []
+        self.deadlines = []
+        self.sequence = 0
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+
+        self.thread = threading.Thread(target=self.run, name="fanout-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self, connection):
+        self.request("watch", connection)
+
+    def forget(self, connection):
+        self.request("forget", connection)
+
+    def defer(self, connection, deadline):
+        """Flush connection at deadline (a time.monotonic() value)"""
+        with self.lock:
+            self.sequence += 1
+            heapq.heappush(self.deadlines, (deadline, self.sequence, connection))
+            if self.deadlines[0][2] is not connection:
+                # The writer already wakes up in time for an earlier deadline
+                return
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def flush_due(self):
+        """Flushes the connections whose deadline has passed; returns seconds until the next one"""
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                due.append(heapq.heappop(self.deadlines)[2])
+            timeout = self.deadlines[0][0] - now if self.deadlines else None
+
+        for connection in due:
+            if connection.flush_deferred():
+                self.register(connection)
+        return timeout
+
+    def request(self, action, connection):
+        with self.lock:
+            self.requests.append((action, connection))
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def apply_requests(self):
+        with self.lock:
+            requests, self.requests = self.requests, []
+
+        for action, connection in requests:
+            if action == "watch":
+                self.register(connection)
+            else:
+                self.unregister(connection)
+
+    def register(self, connection):
+        try:
+            self.selector.register(connection.socket, selectors.EVENT_WRITE, connection)
+        except (KeyError, ValueError, OSError):
+            # Already registered, or closed before the request was applied
+            pass
+
+    def unregister(self, connection):
+        try:
+            self.selector.unregister(connection.socket)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def run(self):
+        timeout = None
+        while True:
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wake_reader:
+                    try:
+                        while self.wake_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    self.apply_requests()
+                    continue
+
+                connection = key.data
+                if not connection.flush_pending():
+                    self.unregister(connection)
+                    if connection.watched:
+                        # Another thread queued more data since the flush
+                        self.register(connection)
+
+            timeout = self.flush_due()
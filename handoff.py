@@ -0,0 +1,236 @@
+"""
+Handing a running server over to a new process, for deploys without a reconnect storm.
+
+A server started with --handoff PATH listens on a Unix-domain socket there.
+A new server started with --takeover PATH connects to it and takes over:
+
+    python server.py --mode async --handoff /run/chat/handoff.sock
+    python server.py --mode async --handoff /run/chat/handoff.sock --takeover /run/chat/handoff.sock
+
+The running server first passes its listening socket over with SCM_RIGHTS,
+so connections that arrive from then on wait in the same accept queue for
+the new server and none is refused. Then it stops accepting and drains (see
+Server.drain()):
+
+  * A member whose connection can move (the asyncio engine, no TLS and no
+    deflate stream, whose state lives in the process) is no longer read
+    from, and once everything queued for it has been written, its socket is
+    passed over together with its member name, session, codec state and any
+    partial frame it had sent. It notices nothing.
+  * Every other member is sent {"action": "shutdown", "retryAfter": seconds}
+    and disconnected once that has been written. A member with a session is
+    parked and the session passed over with the messages it misses, so it
+    resumes on the new server; the client waits a random part of retryAfter
+    first, so members do not all reconnect at once.
+
+The old server then closes its history log, sends the channels, their
+presence and binary member ids, the connections and the sessions, and
+exits. The new server opens the history, takes all of it over and starts
+accepting; it listens on PATH for its own successor in turn.
+
+Everything goes over one SOCK_STREAM connection as length-prefixed JSON
+frames, and a frame with "fd" carries one file descriptor. Linux hands a
+descriptor over with the first bytes of the sendmsg() that carried it and
+never with a later one, so descriptors, kept in arrival order, line up with
+their frames.
+"""
+import base64
+import json
+import logging
+import os
+import socket
+import threading
+from collections import deque
+
+from protocol import HEADER, RECV_SIZE, FrameDecoder, LegacyDecoder
+
+log = logging.getLogger("chat.handoff")
+
+# Frames carry whole channels, so allow far more than a client may send
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+# Most descriptors one read may bring; a frame carries at most one
+MAX_FDS = 16
+
+# Seconds a new server waits for each frame before starting with what it has
+TAKEOVER_TIMEOUT = 60.0
+
+
+class Link:
+    """One end of the connection between a server and its successor"""
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.decoder = FrameDecoder(max_frame_size=MAX_FRAME_SIZE)
+        self.frames = deque()
+        self.fds = deque()
+
+    def send(self, data, fd=None):
+        """Sends a dict, and with it a file descriptor if fd is given"""
+        if fd is not None:
+            data = dict(data, fd=True)
+        payload = json.dumps(data).encode('utf-8')
+        frame = HEADER.pack(len(payload)) + payload
+        if fd is None:
+            self.socket.sendall(frame)
+            return
+        sent = socket.send_fds(self.socket, [frame], [fd])
+        if sent < len(frame):
+            self.socket.sendall(frame[sent:])
+
+    def receive(self):
+        """The next (dict, file descriptor or None); raises EOFError once the other end has closed"""
+        while not self.frames:
+            data, fds, _, _ = socket.recv_fds(self.socket, RECV_SIZE, MAX_FDS)
+            self.fds.extend(fds)
+            if not data:
+                raise EOFError("the other server closed the handoff connection")
+            self.frames.extend(self.decoder.feed(data))
+        data = json.loads(self.frames.popleft().decode('utf-8'))
+        return data, self.fds.popleft() if data.get("fd") else None
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds.clear()
+        self.socket.close()
+
+
+class HandoffListener:
+    """
+    Waits, on its own thread, for a new server process to connect to path.
+
+    Each connection is passed to on_successor as a Link; a stale socket file
+    left at path by an earlier server is replaced.
+    """
+
+    def __init__(self, path, on_successor):
+        self.path = path
+        self.on_successor = on_successor
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(1)
+
+        thread = threading.Thread(target=self.serve, name="handoff-listener")
+        thread.daemon = True
+        thread.start()
+        log.info("Waiting for a successor on %s", path)
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                return
+            try:
+                self.on_successor(Link(connection))
+            except OSError as e:
+                log.warning("Handoff to a successor failed: %s", e)
+                connection.close()
+
+    def close(self):
+        # The path may already belong to the successor, so it is left alone
+        self.socket.close()
+
+
+class Takeover:
+    """
+    What a new server takes over from the server listening at path.
+
+    Connects and blocks until the old server has sent everything: listener
+    is its listening socket, channels, members and sessions the frames for
+    Server.take_over_channels(), take_over_members() and
+    take_over_sessions(); each entry of members is (frame, socket). If the
+    old server goes away before it is done, whatever arrived is kept.
+    Raises OSError if no server is listening at path.
+    """
+
+    def __init__(self, path, timeout=TAKEOVER_TIMEOUT):
+        self.listener = None
+        self.channels = []
+        self.members = []
+        self.sessions = []
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(timeout)
+        link = Link(sock)
+        try:
+            self.receive(link)
+        except (OSError, EOFError, ValueError) as e:
+            log.warning("Handoff from %s ended early: %s", path, e)
+        finally:
+            link.close()
+
+    def receive(self, link):
+        while True:
+            data, fd = link.receive()
+            kind = data.get("kind")
+            if kind == "listener":
+                self.listener = socket.socket(fileno=fd)
+            elif kind == "channel":
+                self.channels.append(data)
+            elif kind == "member":
+                self.members.append((data, socket.socket(fileno=fd)))
+            elif kind == "session":
+                self.sessions.append(data)
+            elif kind == "done":
+                return
+            elif fd is not None:
+                os.close(fd)
+
+
+def channel_state(channel):
+    """The frame that recreates a channel: its metadata, binary member ids and presence"""
+    ids = channel["memberIds"].ids
+    return {
+        "kind": "channel",
+        "channelName": channel["channelName"],
+        "passwordHash": channel["passwordHash"],
+        "chatOwner": channel["chatOwner"],
+        # Interned again in this order, every name gets the same id
+        "memberIds": sorted(ids, key=ids.get),
+        "presence": channel["presence"].hand_over() if channel["presence"] is not None else None,
+    }
+
+
+def member_state(channel, member_name, connection):
+    """The frame that goes with a member's socket: everything needed to keep serving it"""
+    decoder = connection.decoder
+    buffered = bytes(decoder.buffer)
+    return {
+        "kind": "member",
+        "channelName": channel["channelName"],
+        "memberName": member_name,
+        "session": connection.session.token if connection.session is not None else None,
+        "framed": decoder.framed,
+        "buffered": base64.b64encode(buffered).decode('ascii'),
+        "known": sorted(connection.binary.known) if connection.binary is not None else None,
+        "compress": connection.compression,
+    }
+
+
+def restore_decoder(state):
+    """The frame decoder of a member taken over, holding the partial frame it had sent"""
+    decoder = FrameDecoder() if state["framed"] else LegacyDecoder()
+    # A LegacyDecoder scans what it holds again on the next read
+    decoder.buffer += base64.b64decode(state["buffered"])
+    return decoder
+
+
+def session_state(session):
+    """The frame for a parked member, with the messages buffered for it"""
+    parked = session.connection
+    return {
+        "kind": "session",
+        "channelName": session.channel["channelName"],
+        "memberName": session.member_name,
+        "session": session.token,
+        "messages": [message.payload.decode('utf-8') for message in parked.messages],
+        "skipped": parked.skipped,
+    }
@@ -0,0 +1,536 @@
+"""
+Persistent, append-only message history for channels.
+
+Each channel gets a directory of segment files. A segment (<base offset>.log)
+is simply the concatenation of the length-prefixed frames that were broadcast,
+so any run of messages is one contiguous byte range that can be copied out of
+a memory map and sent to a framed client without parsing a single message.
+
+Next to every segment is a sparse index (<base offset>.idx) with one entry per
+INDEX_INTERVAL messages: the message offset, its byte position in the segment
+and its timestamp. Lookups bisect the index and then hop over at most
+INDEX_INTERVAL frame headers.
+
+Appends go straight to the file with os.write; a single flusher thread fsyncs
+dirty logs every fsync_interval seconds, so durability costs one fsync per
+interval instead of one per message.
+
+Each channel's log keeps a search index (see search.py) that every append
+updates. A log opened with messages in it, after a restart or when its
+channel wakes, indexes them in the background and is searchable meanwhile,
+the new messages first.
+"""
+import bisect
+import fcntl
+import json
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+from compression import FRAMES, deflate_frames
+from fanout import EncodedMessage
+from protocol import HEADER
+from search import SEARCH_BYTES, SearchIndex
+
+log = logging.getLogger("chat.history")
+
+INDEX_ENTRY = struct.Struct("!QQQ")  # offset, position, timestamp (ms)
+INDEX_INTERVAL = 32
+SEGMENT_BYTES = 64 * 1024 * 1024
+FSYNC_INTERVAL = 0.05
+MAX_HISTORY = 1000
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def walk_frames(buffer, position, end, limit=None):
+    """Yield (position, length) for frames in buffer[position:end]"""
+    count = 0
+    while position + HEADER.size <= end and (limit is None or count < limit):
+        (length,) = HEADER.unpack_from(buffer, position)
+        if position + HEADER.size + length > end:
+            return
+        yield position, length
+        position += HEADER.size + length
+        count += 1
+
+
+class HistoryBatch:
+    """
+    A run of stored frames, queued to a member like an EncodedMessage.
+
+    Framed clients get the bytes exactly as stored; legacy clients get the
+    bare payloads, and binary clients a transcoded copy, which are only built
+    if such a client asks. For deflate-frame clients the batch is compressed
+    as a whole.
+    """
+
+    __slots__ = ("framed", "count")
+
+    def __init__(self, framed, count):
+        self.framed = framed
+        self.count = count
+
+    def payloads(self):
+        return [
+            self.framed[position + HEADER.size:position + HEADER.size + length]
+            for position, length in walk_frames(self.framed, 0, len(self.framed))
+        ]
+
+    def for_connection(self, connection):
+        session = connection.binary
+        if session is not None:
+            data = b"".join(
+                session.frame(*EncodedMessage(payload).binary(session.members))
+                for payload in self.payloads()
+            )
+        elif connection.framed:
+            data = self.framed
+        else:
+            return b"".join(self.payloads())
+        if connection.compression == FRAMES:
+            return deflate_frames(data)
+        return data
+
+
+class Segment:
+    def __init__(self, directory, base_offset):
+        self.base_offset = base_offset
+        self.log_path = os.path.join(directory, f"{base_offset:020d}.log")
+        self.index_path = os.path.join(directory, f"{base_offset:020d}.idx")
+        self.fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.count = 0
+        # Parallel lists, one item per index entry
+        self.index_offsets = []
+        self.index_positions = []
+        self.index_timestamps = []
+        self.map = None
+        self.mapped_size = 0
+        self.closed = False
+
+    @property
+    def next_offset(self):
+        return self.base_offset + self.count
+
+    def recover(self):
+        """Load the sparse index and re-scan whatever was appended after its last entry"""
+        with open(self.index_path, "rb") as index_file:
+            data = index_file.read()
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        for offset, position, timestamp in INDEX_ENTRY.iter_unpack(data[:usable]):
+            if position >= self.size:
+                break
+            self.index_offsets.append(offset)
+            self.index_positions.append(position)
+            self.index_timestamps.append(timestamp)
+
+        # Rewrite the index if it had a torn or stale tail
+        if len(self.index_offsets) * INDEX_ENTRY.size != len(data):
+            os.ftruncate(self.index_fd, len(self.index_offsets) * INDEX_ENTRY.size)
+
+        if self.index_offsets:
+            offset, position = self.index_offsets[-1], self.index_positions[-1]
+        else:
+            offset, position = self.base_offset, 0
+
+        with open(self.log_path, "rb") as log_file:
+            log_file.seek(position)
+            tail = log_file.read()
+
+        end = 0
+        for frame_position, length in walk_frames(tail, 0, len(tail)):
+            if (offset - self.base_offset) % INDEX_INTERVAL == 0 and (
+                    not self.index_offsets or self.index_offsets[-1] < offset):
+                payload = tail[frame_position + HEADER.size:frame_position + HEADER.size + length]
+                self.add_index_entry(offset, position + frame_position, message_timestamp(payload))
+            offset += 1
+            end = frame_position + HEADER.size + length
+
+        # Drop a frame that was only partly written before a crash
+        if position + end < self.size:
+            os.ftruncate(self.fd, position + end)
+            self.size = position + end
+        self.count = offset - self.base_offset
+
+    def add_index_entry(self, offset, position, timestamp):
+        self.index_offsets.append(offset)
+        self.index_positions.append(position)
+        self.index_timestamps.append(timestamp)
+        os.write(self.index_fd, INDEX_ENTRY.pack(offset, position, timestamp))
+
+    def append(self, frame, timestamp):
+        offset = self.next_offset
+        if self.count % INDEX_INTERVAL == 0:
+            self.add_index_entry(offset, self.size, timestamp)
+
+        view = memoryview(frame)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.size += len(frame)
+        self.count += 1
+        return offset
+
+    def buffer(self, size):
+        """A read-only memory map covering at least the first `size` bytes"""
+        if size > self.mapped_size:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            self.mapped_size = len(self.map)
+        return self.map
+
+    def position_of(self, offset, size):
+        """Byte position of a message offset, hopping forward from the nearest index entry"""
+        entry = bisect.bisect_right(self.index_offsets, offset) - 1
+        current, position = self.index_offsets[entry], self.index_positions[entry]
+        if current == offset:
+            return position
+        buffer = self.buffer(size)
+        for position, length in walk_frames(buffer, position, size, offset - current + 1):
+            if current == offset:
+                return position
+            current += 1
+        return size
+
+    def sync(self):
+        # The flusher may still hold a segment that was closed since; see
+        # ChannelLog.sync_lock
+        if self.closed:
+            return
+        os.fsync(self.fd)
+        os.fsync(self.index_fd)
+
+    def close(self):
+        self.closed = True
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        os.close(self.fd)
+        os.close(self.index_fd)
+
+
+def message_timestamp(payload):
+    """The server-side send time stored in a message, in milliseconds"""
+    try:
+        return int(json.loads(payload)["sentAt"])
+    except (ValueError, KeyError, TypeError):
+        return 0
+
+
+class ChannelLog:
+    """
+    Segmented append-only log for one channel.
+
+    With search_bytes (0 disables search), its messages are indexed for
+    search. schedule_backfill(log) arranges for log.backfill() to run in
+    the background; by default it gets a thread of its own.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, search_bytes=SEARCH_BYTES, member_id_length=0,
+                 schedule_backfill=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        # Held while fsyncing, outside lock so appends go on meanwhile; close()
+        # takes it too, so it never closes descriptors that are being synced
+        self.sync_lock = threading.Lock()
+        self.unsynced = set()
+        self.segments = []
+
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        for base in bases:
+            segment = Segment(directory, base)
+            segment.recover()
+            self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(directory, 0))
+
+        self.search_index = None
+        if search_bytes:
+            self.search_index = SearchIndex(self.next_offset, search_bytes, member_id_length)
+            if self.next_offset > self.segments[0].base_offset:
+                self.search_index.complete = False
+                if schedule_backfill is None:
+                    thread = threading.Thread(target=self.backfill, name="search-backfill")
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    schedule_backfill(self)
+
+    @property
+    def next_offset(self):
+        return self.segments[-1].next_offset
+
+    def append(self, frame, timestamp=None, message=None):
+        """
+        Append one framed message and return its offset.
+
+        message is the frame's payload as a dict, if the caller has it, so
+        the search index does not have to parse it again.
+        """
+        with self.lock:
+            segment = self.segments[-1]
+            if segment.size >= self.segment_bytes and segment.count:
+                segment = Segment(self.directory, segment.next_offset)
+                self.segments.append(segment)
+            self.unsynced.add(segment)
+            offset = segment.append(frame, now_ms() if timestamp is None else timestamp)
+            if self.search_index is not None:
+                if message is None:
+                    self.search_index.add_payload(offset, frame[HEADER.size:])
+                else:
+                    self.search_index.add(offset, message)
+            return offset
+
+    def read_last(self, count):
+        """The most recent `count` messages as a HistoryBatch"""
+        with self.lock:
+            start = max(self.segments[0].base_offset, self.next_offset - max(0, count))
+            return self.read_range(start, self.next_offset)
+
+    def read_since(self, timestamp, limit=MAX_HISTORY):
+        """Up to `limit` messages sent at or after `timestamp` (ms) as a HistoryBatch"""
+        with self.lock:
+            start = self.first_offset_since(timestamp)
+            return self.read_range(start, min(self.next_offset, start + limit))
+
+    def first_offset_since(self, timestamp):
+        # Find the last index entry (across segments) that starts before the timestamp
+        for segment_number in range(len(self.segments) - 1, -1, -1):
+            segment = self.segments[segment_number]
+            entry = bisect.bisect_left(segment.index_timestamps, timestamp) - 1
+            if entry >= 0:
+                break
+        else:
+            return self.segments[0].base_offset
+
+        # Then scan that block for the first message at or after it
+        offset = segment.index_offsets[entry]
+        buffer = segment.buffer(segment.size)
+        for position, length in walk_frames(buffer, segment.index_positions[entry], segment.size, INDEX_INTERVAL):
+            payload = buffer[position + HEADER.size:position + HEADER.size + length]
+            if message_timestamp(payload) >= timestamp:
+                return offset
+            offset += 1
+        return offset
+
+    def read_range(self, start, end):
+        """Copy messages [start, end) out of the memory-mapped segments (caller holds the lock)"""
+        count = max(0, end - start)
+        chunks = []
+        bases = [segment.base_offset for segment in self.segments]
+        segment_number = max(0, bisect.bisect_right(bases, start) - 1)
+        while start < end and segment_number < len(self.segments):
+            segment = self.segments[segment_number]
+            stop = min(end, segment.next_offset)
+            if stop > start:
+                first = segment.position_of(start, segment.size)
+                last = segment.position_of(stop, segment.size) if stop < segment.next_offset else segment.size
+                chunks.append(segment.buffer(segment.size)[first:last])
+            start = max(start, stop)
+            segment_number += 1
+        return HistoryBatch(b"".join(chunks), count)
+
+    def search(self, keys, since=None, until=None, before=None, limit=20):
+        """
+        The newest messages that have every search key, newest first.
+
+        since and until (ms) bound the time they were sent, and before is an
+        offset to page back from. Returns (offset, payload) pairs and the
+        SearchIndex, whose first_offset and complete tell how far back the
+        search reached; the index is None if search is off or the log closed.
+        """
+        with self.lock:
+            index = self.search_index
+            if index is None:
+                return [], None
+            start = 0 if since is None else self.first_offset_since(since)
+            end = self.next_offset if until is None else self.first_offset_since(until)
+            if before is not None:
+                end = min(end, before)
+            offsets = index.search(keys, start, end, limit)
+            results = [(offset, self.read_range(offset, offset + 1).payloads()[0]) for offset in offsets]
+        return results, index
+
+    def backfill(self):
+        """Indexes the messages logged before the search index was created, then hands them to it"""
+        index = self.search_index
+        if index is None:
+            return
+        end = index.first_offset
+        older = SearchIndex(self.segments[0].base_offset, index.max_bytes, index.member_id_length)
+        try:
+            for segment in list(self.segments):
+                if segment.base_offset >= end or not segment.size:
+                    break
+                # A map of our own, as the segment's may be replaced under the lock
+                buffer = mmap.mmap(segment.fd, 0, access=mmap.ACCESS_READ)
+                try:
+                    offset = segment.base_offset
+                    for position, length in walk_frames(buffer, 0, len(buffer)):
+                        if offset >= end:
+                            break
+                        older.add_payload(offset, buffer[position + HEADER.size:position + HEADER.size + length])
+                        offset += 1
+                finally:
+                    buffer.close()
+        except (OSError, ValueError) as e:
+            # The log was closed under us
+            log.warning("Stopped indexing %s: %s", self.directory, e)
+            return
+        with self.lock:
+            index.prepend(older)
+
+    def sync(self):
+        with self.lock:
+            segments, self.unsynced = self.unsynced, set()
+        with self.sync_lock:
+            try:
+                for segment in segments:
+                    segment.sync()
+            except OSError:
+                # Left for the next sync
+                with self.lock:
+                    self.unsynced.update(segment for segment in segments if not segment.closed)
+                raise
+
+    def close(self):
+        with self.sync_lock, self.lock:
+            self.unsynced.clear()
+            self.search_index = None
+            for segment in self.segments:
+                segment.close()
+
+
+class MessageLog:
+    """
+    History for every channel on the server, rooted at one directory.
+
+    Each channel directory also holds meta.json with the fields needed to
+    recreate the channel after a restart. Each channel's search index may
+    hold up to search_bytes; see search.py.
+
+    A directory belongs to one server process at a time, which holds a lock
+    on it until close(). Cluster workers each store the messages the bus
+    relays to them as well as their own, so workers sharing a directory
+    would store every message twice, and each would lose track of where the
+    others' writes put the ends of its segments. Raises RuntimeError if
+    another process has the directory open.
+    """
+
+    def __init__(self, directory, fsync_interval=FSYNC_INTERVAL, segment_bytes=SEGMENT_BYTES,
+                 search_bytes=SEARCH_BYTES, member_id_length=0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.search_bytes = search_bytes
+        self.member_id_length = member_id_length
+        self.logs = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.lock_file = open(os.path.join(directory, ".lock"), "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock_file.close()
+            raise RuntimeError(f"history directory {directory} is in use by another server process")
+
+        # One thread indexes the logs opened with messages in them, in turn
+        self.backfills = queue.Queue()
+        if search_bytes:
+            indexer = threading.Thread(target=self.backfill_logs, name="search-backfill")
+            indexer.daemon = True
+            indexer.start()
+
+        if fsync_interval:
+            flusher = threading.Thread(target=self.flush_periodically, args=(fsync_interval,), name="history-flusher")
+            flusher.daemon = True
+            flusher.start()
+
+    def channel_directory(self, channel_name):
+        return os.path.join(self.directory, channel_name.encode('utf-8').hex())
+
+    def saved_channels(self):
+        """Metadata of every channel persisted by an earlier run"""
+        channels = []
+        for name in sorted(os.listdir(self.directory)):
+            meta_path = os.path.join(self.directory, name, "meta.json")
+            if os.path.exists(meta_path):
+                with open(meta_path) as meta_file:
+                    channels.append(json.load(meta_file))
+        return channels
+
+    def save_channel(self, channel_name, meta):
+        """Persist channel metadata (written atomically via rename)"""
+        directory = self.channel_directory(channel_name)
+        os.makedirs(directory, exist_ok=True)
+        temporary_path = os.path.join(directory, "meta.json.tmp")
+        with open(temporary_path, "w") as meta_file:
+            json.dump({"channelName": channel_name, **meta}, meta_file)
+            meta_file.flush()
+            os.fsync(meta_file.fileno())
+        os.replace(temporary_path, os.path.join(directory, "meta.json"))
+
+    def load_channel(self, channel_name):
+        """The saved metadata of one channel, or None"""
+        try:
+            with open(os.path.join(self.channel_directory(channel_name), "meta.json")) as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+
+    def hibernate_channel(self, channel_name, meta):
+        """Saves a channel's metadata and closes its log until it is next opened"""
+        self.save_channel(channel_name, meta)
+        with self.lock:
+            log = self.logs.pop(channel_name, None)
+        if log is not None:
+            log.sync()
+            log.close()
+
+    def channel(self, channel_name):
+        """The ChannelLog for a channel, opening (and recovering) it on first use"""
+        with self.lock:
+            log = self.logs.get(channel_name)
+            if log is None:
+                directory = self.channel_directory(channel_name)
+                os.makedirs(directory, exist_ok=True)
+                log = self.logs[channel_name] = ChannelLog(
+                    directory, self.segment_bytes, self.search_bytes, self.member_id_length, self.backfills.put
+                )
+            return log
+
+    def backfill_logs(self):
+        while True:
+            self.backfills.get().backfill()
+
+    def flush_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            self.sync()
+
+    def sync(self):
+        """Fsyncs every channel's log; a log that fails is logged and tried again next time"""
+        with self.lock:
+            logs = list(self.logs.values())
+        for channel_log in logs:
+            try:
+                channel_log.sync()
+            except OSError as e:
+                log.error("Syncing the history in %s failed: %s", channel_log.directory, e)
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            for log in self.logs.values():
+                log.close()
+            self.logs.clear()
+        self.lock_file.close()
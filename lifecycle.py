@@ -0,0 +1,133 @@
+"""
+Channel lifecycle: idle eviction, hibernation and memory accounting.
+
+A channel is idle while it has no members, parked ones included (see
+ChannelRegistry). ChannelLifecycle.evict() removes channels that have been
+idle for the TTL, which frees their member tables, codec state and latency
+window. With a store, each evicted channel's metadata is hibernated there
+first, and find() brings the channel back when someone next joins or tries
+to create it. Without one, an evicted channel is forgotten and its name is
+free again.
+
+A store has hibernate_channel(name, meta) and load_channel(name). The
+history log is one, and also closes the channel's segments on hibernation.
+ChannelStore keeps only the metadata, for servers that keep no history.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+
+log = logging.getLogger("chat.lifecycle")
+
+# Seconds a channel may go without members before it is evicted
+CHANNEL_TTL = 600.0
+
+
+class ChannelStore:
+    """Metadata of hibernated channels, one JSON file per channel"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, channel_name):
+        return os.path.join(self.directory, channel_name.encode('utf-8').hex() + ".json")
+
+    def hibernate_channel(self, channel_name, meta):
+        """Saves a channel's metadata (written atomically via rename)"""
+        path = self.path(channel_name)
+        with open(path + ".tmp", "w") as meta_file:
+            json.dump({"channelName": channel_name, **meta}, meta_file)
+        os.replace(path + ".tmp", path)
+
+    def load_channel(self, channel_name):
+        """The metadata of a hibernated channel, or None"""
+        try:
+            with open(self.path(channel_name)) as meta_file:
+                return json.load(meta_file)
+        except FileNotFoundError:
+            return None
+
+
+def channel_memory(channel):
+    """
+    Approximate bytes of memory held by one channel.
+
+    Counts the channel dict, its member table and snapshot, interned member
+    ids, presence, the latency window and the history's search index. Members'
+    connections, their outboxes and the memory-mapped history segments are
+    not counted.
+    """
+    size = sys.getsizeof(channel) + sys.getsizeof(channel["members"])
+    snapshot = channel["snapshot"]
+    if snapshot:
+        size += sys.getsizeof(snapshot)
+    member_ids = channel["memberIds"]
+    size += sys.getsizeof(member_ids.ids) + sys.getsizeof(member_ids.definitions) + member_ids.size
+    if channel["presence"] is not None:
+        size += channel["presence"].memory()
+    samples = channel["fanoutLatency"].samples
+    size += sys.getsizeof(samples) + len(samples) * sys.getsizeof(0.0)
+    history = channel["log"]
+    if history is not None and history.search_index is not None:
+        size += history.search_index.memory()
+    return size
+
+
+class ChannelLifecycle:
+    """
+    Evicts idle channels from a ChannelRegistry and wakes hibernated ones.
+
+    A ttl of 0 never evicts. evict() is meant to be called periodically.
+    """
+
+    def __init__(self, channels, ttl=CHANNEL_TTL, store=None):
+        self.channels = channels
+        self.ttl = ttl
+        self.store = store
+        self.wake_lock = threading.Lock()
+
+    def evict(self):
+        """Evicts channels idle for longer than the TTL; returns them"""
+        if not self.ttl:
+            return []
+        # Under the wake lock, so find() cannot miss a channel that has left
+        # the registry but is not in the store yet
+        with self.wake_lock:
+            evicted = self.channels.evict_idle(self.ttl)
+            for channel in evicted:
+                if self.store is not None:
+                    self.store.hibernate_channel(channel["channelName"], {
+                        "passwordHash": channel["passwordHash"],
+                        "chatOwner": channel["chatOwner"],
+                    })
+                log.info("Evicted idle channel %s", channel["channelName"])
+        return evicted
+
+    def find(self, channel_name, restore):
+        """
+        The channel with that name, waking it from the store if it is hibernated.
+
+        restore(meta) recreates a channel from its saved metadata and returns
+        it (or None if it already exists). Returns None if there is no such
+        channel.
+        """
+        channel = self.channels.get(channel_name)
+        if channel is not None or self.store is None:
+            return channel
+
+        # One waker at a time, so a hibernated channel is loaded once
+        with self.wake_lock:
+            channel = self.channels.get(channel_name)
+            if channel is None:
+                meta = self.store.load_channel(channel_name)
+                if meta is not None:
+                    channel = restore(meta)
+                    log.info("Woke hibernated channel %s", channel_name)
+        return channel
+
+    def memory(self):
+        """Approximate bytes held by all channels"""
+        return sum(channel_memory(channel) for channel in self.channels.values())
@@ -0,0 +1,96 @@
+"""
+Leveled, rate-limited, asynchronous logging for the server processes.
+
+Modules log through the standard logging module (logging.getLogger("chat.*")).
+setup_logging() attaches a single handler to the "chat" logger that:
+
+  * drops records below the configured level before any formatting,
+  * rate-limits each distinct message template, so an error repeated for
+    every member of a channel is printed a few times per interval followed
+    by a count of what was suppressed,
+  * hands records to a background thread through a bounded queue; if the
+    queue is full the record is dropped rather than making the caller wait.
+
+The thread that broadcasts a message therefore never blocks on stdout.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVELS = ("debug", "info", "warning", "error")
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Each message template may be logged this many times per interval
+RATE_LIMIT_BURST = 10
+RATE_LIMIT_INTERVAL = 1.0
+QUEUE_SIZE = 10000
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `burst` records per message template through every `interval` seconds"""
+
+    def __init__(self, burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+                if len(self.windows) > 10000:
+                    # Forget templates that have gone quiet
+                    self.windows = {k: w for k, w in self.windows.items() if now - w[0] < self.interval}
+                if suppressed:
+                    record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+                return True
+
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level="info", stream=None, burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL):
+    """Route the "chat" loggers through a rate limiter and a background writer thread"""
+    log_queue = queue.Queue(QUEUE_SIZE)
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, output)
+
+    handler = AsyncHandler(log_queue)
+    handler.addFilter(RateLimitFilter(burst, interval))
+
+    logger = logging.getLogger("chat")
+    logger.setLevel(level.upper())
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
@@ -0,0 +1,132 @@
+"""
+Bounded scrollback for the chat client.
+
+MessageStore keeps the most recent messages in a fixed-size ring, so memory
+stays flat however long a session runs. Messages that fall out of the ring
+are either forgotten or, with a spill directory, appended to a temporary file
+with a fixed-width offset index next to it, so any old message can still be
+read back with two seeks.
+
+Messages are addressed by sequence number (0 for the first message of the
+session). Wrapping to the terminal width happens lazily, when a message is
+about to be shown, and the result is cached on the record for that width;
+the UI only ever asks for the handful of messages around its viewport.
+"""
+import json
+import struct
+import textwrap
+import threading
+
+DEFAULT_CAPACITY = 10000
+
+SPILL_ENTRY = struct.Struct("!QI")  # byte offset and length of a spilled record
+
+
+class MessageRecord:
+    """One received message, kept structured until it is displayed"""
+
+    __slots__ = ("timestamp", "member_name", "text", "wrapped")
+
+    def __init__(self, timestamp, member_name, text):
+        self.timestamp = timestamp
+        self.member_name = member_name
+        self.text = text
+        self.wrapped = None
+
+    def format(self):
+        if self.member_name is None:
+            return self.text
+        return f"[{self.timestamp}] {self.member_name}: {self.text}"
+
+    def lines(self, width):
+        """The message wrapped to width columns, cached until the width changes"""
+        if self.wrapped is None or self.wrapped[0] != width:
+            lines = textwrap.wrap(self.format(), max(1, width), drop_whitespace=False) or [""]
+            self.wrapped = (width, lines)
+        return self.wrapped[1]
+
+
+class MessageStore:
+    """
+    Fixed-capacity ring of MessageRecords with optional spill-to-disk.
+
+    append() may be called from the listener thread while the UI thread
+    reads, so both go through one lock.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, spill_dir=None):
+        self.capacity = capacity
+        self.ring = [None] * capacity
+        self.count = 0
+        self.lock = threading.Lock()
+
+        self.spill = None
+        self.spill_index = None
+        self.spill_size = 0
+        if spill_dir is not None:
+            # Only needed with a spill directory, so kept off the client's start-up path
+            import tempfile
+            self.spill = tempfile.TemporaryFile(prefix="chat-scrollback-", dir=spill_dir)
+            self.spill_index = tempfile.TemporaryFile(prefix="chat-scrollback-", suffix=".idx", dir=spill_dir)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def first(self):
+        """Sequence number of the oldest message that can still be read"""
+        if self.spill is not None:
+            return 0
+        return max(0, self.count - self.capacity)
+
+    def append(self, record):
+        """Add a record and return its sequence number"""
+        with self.lock:
+            slot = self.count % self.capacity
+            evicted = self.ring[slot]
+            if evicted is not None and self.spill is not None:
+                self.spill_record(evicted)
+            self.ring[slot] = record
+            self.count += 1
+            return self.count - 1
+
+    def spill_record(self, record):
+        data = json.dumps([record.timestamp, record.member_name, record.text]).encode('utf-8')
+        # Reads move the file positions, so always write at the end
+        self.spill.seek(0, 2)
+        self.spill_index.seek(0, 2)
+        self.spill.write(data)
+        self.spill_index.write(SPILL_ENTRY.pack(self.spill_size, len(data)))
+        self.spill_size += len(data)
+
+    def get(self, seq):
+        """The record with a sequence number, or None if it is no longer available"""
+        with self.lock:
+            if seq < 0 or seq >= self.count:
+                return None
+            if seq >= self.count - self.capacity:
+                return self.ring[seq % self.capacity]
+            if self.spill is None:
+                return None
+
+            self.spill.flush()
+            self.spill_index.flush()
+            self.spill_index.seek(seq * SPILL_ENTRY.size)
+            offset, length = SPILL_ENTRY.unpack(self.spill_index.read(SPILL_ENTRY.size))
+            self.spill.seek(offset)
+            timestamp, member_name, text = json.loads(self.spill.read(length).decode('utf-8'))
+            return MessageRecord(timestamp, member_name, text)
+
+    def lines(self, seq, width):
+        """The wrapped display lines of one message"""
+        record = self.get(seq)
+        if record is None:
+            return [""]
+        return record.lines(width)
+
+    def close(self):
+        with self.lock:
+            if self.spill is not None:
+                self.spill.close()
+                self.spill_index.close()
+                self.spill = self.spill_index = None
@@ -0,0 +1,327 @@
+"""
+Server metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are plain objects that the server updates on
+its hot paths; each update is one short lock. Values that already live
+elsewhere, such as the number of channels, are read by callbacks at scrape
+time instead of being tracked twice.
+
+MetricsEndpoint serves the rendered text over HTTP on a TCP or Unix-domain
+socket:
+
+    python server.py --metrics tcp:127.0.0.1:9100
+    curl -s http://127.0.0.1:9100/metrics
+
+    python server.py --metrics unix:/tmp/chat-metrics.sock
+    curl -s --unix-socket /tmp/chat-metrics.sock http://localhost/metrics
+"""
+import bisect
+import logging
+import os
+import socket
+import threading
+
+from cluster import parse_address
+from lifecycle import channel_memory
+from profiling import SPANS
+
+log = logging.getLogger("chat.metrics")
+
+# Seconds; fan-out of one message ranges from microseconds to a few ms
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, None, self.value
+
+
+class Gauge(Counter):
+    """A value that goes up and down"""
+
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class CallbackGauge:
+    """A metric whose labelled values are produced by a callback at scrape time"""
+
+    def __init__(self, name, help_text, callback, kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        for labels, value in self.callback():
+            yield self.name, labels, value
+
+
+class Histogram:
+    """Counts observations into cumulative buckets, plus their sum and count"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            yield self.name + "_bucket", {"le": format_value(bound)}, cumulative
+        yield self.name + "_sum", None, total
+        yield self.name + "_count", None, count
+
+
+class Metrics:
+    """The set of metrics a server exposes"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.add(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.add(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help_text, buckets))
+
+    def callback(self, name, help_text, callback, kind="gauge"):
+        return self.add(CallbackGauge(name, help_text, callback, kind))
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsEndpoint:
+    """
+    Minimal HTTP server for scrapes, on its own thread.
+
+    Answers GET /metrics (and /) with the rendered metrics, one request per
+    connection, so it needs nothing beyond the socket module and works the
+    same on TCP and Unix-domain sockets. routes maps further paths to
+    callables that take the query parameters and return a (content type,
+    body) pair; each request is answered on its own thread, so a slow route
+    does not hold up scrapes.
+    """
+
+    def __init__(self, metrics, address, routes=None):
+        self.metrics = metrics
+        self.address = address
+        self.routes = routes or {}
+        family, sockaddr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(sockaddr)
+        self.socket.listen(16)
+
+        thread = threading.Thread(target=self.serve, name="metrics-endpoint")
+        thread.daemon = True
+        thread.start()
+        log.info("Metrics available at %s", address)
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.respond, args=(connection,), name="metrics-request")
+            thread.daemon = True
+            thread.start()
+
+    def respond(self, connection):
+        try:
+            connection.settimeout(5)
+            self.handle(connection)
+        except OSError as e:
+            log.debug("Metrics scrape failed: %s", e)
+        finally:
+            connection.close()
+
+    def handle(self, connection):
+        request = b""
+        while b"\r\n\r\n" not in request and len(request) < 8192:
+            data = connection.recv(4096)
+            if not data:
+                break
+            request += data
+
+        method, _, rest = request.partition(b" ")
+        path, _, query = rest.split(b" ", 1)[0].decode('latin-1').partition("?")
+        if method == b"GET" and path in ("/", "/metrics"):
+            status, content_type, body = "200 OK", CONTENT_TYPE, self.metrics.render().encode('utf-8')
+        elif method == b"GET" and path in self.routes:
+            params = dict(pair.partition("=")[::2] for pair in query.split("&") if pair)
+            content_type, body = self.routes[path](params)
+            status = "200 OK"
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", b"not found\n"
+
+        header = (
+            f"HTTP/1.0 {status}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        connection.sendall(header.encode('ascii') + body)
+
+    def close(self):
+        self.socket.close()
+
+
+class ServerMetrics(Metrics):
+    """The metrics of one chat server process"""
+
+    def __init__(self, channels, admission, sessions):
+        super().__init__()
+        self.connections = self.gauge("chat_connections", "Client connections currently open")
+        self.connections_accepted = self.counter("chat_connections_accepted_total", "Client connections accepted")
+        self.connections_rejected = self.counter(
+            "chat_connections_rejected_total", "Connections refused at the handshake or member cap"
+        )
+        self.handshake_timeouts = self.counter(
+            "chat_handshake_timeouts_total", "Connections closed for not sending a request in time"
+        )
+        self.tls_handshakes = self.counter("chat_tls_handshakes_total", "TLS handshakes completed")
+        self.tls_resumed = self.counter(
+            "chat_tls_resumed_total", "TLS handshakes that resumed an earlier session instead of a full handshake"
+        )
+        self.tls_failures = self.counter("chat_tls_failures_total", "TLS handshakes that failed")
+        self.callback("chat_handshakes_pending", "Connections waiting to create or join a channel", lambda: [
+            (None, admission.handshakes)
+        ])
+        self.callback("chat_sessions_parked", "Disconnected members whose session can still be resumed", lambda: [
+            (None, len(sessions.parked))
+        ])
+        self.sessions_resumed = self.counter("chat_sessions_resumed_total", "Members that resumed their session")
+        self.sessions_expired = self.counter(
+            "chat_sessions_expired_total", "Disconnected members removed because they did not resume in time"
+        )
+        self.callback("chat_channels", "Channels on this server", lambda: [(None, len(channels))])
+        self.callback("chat_channels_idle", "Channels without members, waiting to be evicted", lambda: [
+            (None, len(channels.idle))
+        ])
+        self.callback("chat_channel_memory_bytes", "Approximate memory held by all channels", lambda: [
+            (None, sum(channel_memory(channel) for channel in channels.values()))
+        ])
+        self.channels_evicted = self.counter("chat_channels_evicted_total", "Idle channels evicted")
+        self.channels_restored = self.counter("chat_channels_restored_total", "Hibernated channels woken by a join")
+        self.callback("chat_channel_members", "Members of each channel connected to this server", lambda: [
+            ({"channel": channel["channelName"]}, len(channel["members"])) for channel in channels.values()
+        ])
+        self.messages_received = self.counter("chat_messages_received_total", "Messages received from members")
+        self.messages_throttled = self.counter(
+            "chat_messages_throttled_total", "Messages refused because a member or channel rate limit was exceeded"
+        )
+        self.messages_direct = self.counter(
+            "chat_messages_direct_total", "Messages sent to named members instead of the whole channel"
+        )
+        self.messages_sent = self.counter("chat_messages_sent_total", "Messages queued for delivery to members")
+        self.presence_reports = self.counter(
+            "chat_presence_reports_total", "Typing, active and idle reports received from members"
+        )
+        self.presence_updates = self.counter(
+            "chat_presence_updates_total", "Coalesced presence updates queued for delivery to members"
+        )
+        self.bytes_received = self.counter("chat_bytes_received_total", "Bytes read from client connections")
+        self.bytes_sent = self.counter("chat_bytes_sent_total", "Bytes written to client connections")
+        self.socket_writes = self.counter(
+            "chat_socket_writes_total", "Writes to client sockets (one per system call or transport write)"
+        )
+        self.send_failures = self.counter(
+            "chat_send_failures_total", "Deliveries that failed or made the server disconnect a slow member"
+        )
+        self.messages_dropped = self.counter(
+            "chat_messages_dropped_total", "Messages dropped or coalesced away because a member fell behind"
+        )
+        self.search_latency = self.histogram(
+            "chat_search_latency_seconds", "Time to answer a search of a channel's history"
+        )
+        self.fanout_latency = self.histogram(
+            "chat_fanout_latency_seconds", "Time from receiving a message to queueing it for the last member"
+        )
+        self.callback("chat_span_calls_total", "Calls of each timed server code path", lambda: [
+            ({"span": name}, count) for name, (count, _, _) in SPANS.snapshot().items()
+        ], kind="counter")
+        self.callback("chat_span_seconds_total", "Time spent in each timed server code path", lambda: [
+            ({"span": name}, total) for name, (_, total, _) in SPANS.snapshot().items()
+        ], kind="counter")
+        self.callback("chat_span_max_seconds", "Longest single call of each timed server code path", lambda: [
+            ({"span": name}, longest) for name, (_, _, longest) in SPANS.snapshot().items()
+        ])
@@ -0,0 +1,196 @@
+"""
+Presence: who is in a channel and whether they are active, typing or idle.
+
+A member that joins is "active". Clients report changes with
+{"action": "presence", "state": "typing"} (or "active", or "idle"), which the
+server records but never forwards. A member stays typing until it reports
+something else, sends a message, or goes TYPING_TIMEOUT seconds without
+reporting typing again. A member that leaves is "left". A parked member (see
+sessions.py) is idle until it resumes.
+
+Every interval the server sends each channel whose presence changed one
+update with the latest state of every member that changed:
+
+    {"action": "presence", "channelName": ..., "changes": {"alice_3fa9c2d1": "typing", "bob_00c0ffee": "left"}}
+
+So a member receives at most one presence update per interval, however many
+members are typing, and a member that starts and stops typing within an
+interval, or refreshes its typing state, sends nobody anything.
+
+The join reply carries a "roster" with every member's state as of the last
+update, plus the new member itself. Updates set states, so the next one
+brings the roster up to date. The roster's JSON is built once per update and
+shared by every member that joins until the next, so a reconnect storm does
+not encode the member list once per member. A roster, and an update, lists
+at most MAX_ENTRIES members, which keeps it well under the frame size limit;
+further changes wait for the next update. Presence is per server: with
+several workers, a roster lists the members connected to the worker that
+sent it.
+"""
+import itertools
+import json
+import sys
+import threading
+import time
+
+ACTIVE = "active"
+TYPING = "typing"
+IDLE = "idle"
+LEFT = "left"
+# What a client may report
+STATES = (ACTIVE, TYPING, IDLE)
+
+# Seconds between presence updates
+PRESENCE_INTERVAL = 1.0
+
+# Seconds a member stays typing after its last report
+TYPING_TIMEOUT = 6.0
+
+# Seconds between a client's reports while its user keeps typing
+TYPING_REFRESH = 3.0
+
+# Most members in one roster or update (about 36 bytes of JSON each)
+MAX_ENTRIES = 10000
+
+
+def with_roster(response, roster=None):
+    """The JSON payload of a join or resume reply, with the roster from Presence.join() if there is one"""
+    payload = json.dumps(response)
+    if roster is not None:
+        payload = payload[:-1] + ', "roster": ' + roster + "}"
+    return payload.encode('utf-8')
+
+
+class Presence:
+    """
+    The presence of the members of one channel.
+
+    states holds what every member is doing now, and sent what the last
+    update told the channel. A change adds the member to changed and, if it
+    is the first since the last update, queues this Presence in the set
+    pending, shared by all channels, for the server to flush().
+    """
+
+    def __init__(self, channel_name, pending):
+        self.channel_name = channel_name
+        self.pending = pending
+        self.states = {}
+        self.sent = {}
+        self.typing = {}  # member -> when its typing expires (time.monotonic())
+        self.changed = set()
+        self.roster = None  # JSON of sent, until the next update changes it
+        self.queued = False
+        self.lock = threading.Lock()
+
+    def join(self, member_name):
+        """Marks a member active; returns the roster for its join reply, as JSON"""
+        with self.lock:
+            self.set(member_name, ACTIVE)
+            if member_name in self.sent:
+                # Resuming: its entry must not appear twice
+                roster = dict(itertools.islice(self.sent.items(), MAX_ENTRIES))
+                roster[member_name] = ACTIVE
+                return json.dumps(roster)
+            if self.roster is None:
+                self.roster = json.dumps(dict(itertools.islice(self.sent.items(), MAX_ENTRIES)))
+            roster = self.roster
+        entry = json.dumps({member_name: ACTIVE})
+        if roster == "{}":
+            return entry
+        return roster[:-1] + ", " + entry[1:]
+
+    def leave(self, member_name):
+        with self.lock:
+            self.typing.pop(member_name, None)
+            if self.states.pop(member_name, None) is not None:
+                self.touch(member_name)
+
+    def report(self, member_name, state):
+        """Records a state a member reported; ignored for members that are not here"""
+        with self.lock:
+            if member_name not in self.states:
+                return
+            if state == TYPING:
+                self.typing[member_name] = time.monotonic() + TYPING_TIMEOUT
+            else:
+                self.typing.pop(member_name, None)
+            self.set(member_name, state)
+
+    def stop_typing(self, member_name):
+        """Called for every message a member sends, so the common case takes no lock"""
+        if member_name in self.typing:
+            self.report(member_name, ACTIVE)
+
+    def set(self, member_name, state):
+        if self.states.get(member_name) != state:
+            self.states[member_name] = state
+            self.touch(member_name)
+
+    def touch(self, member_name):
+        self.changed.add(member_name)
+        if not self.queued:
+            self.queued = True
+            self.pending.add(self)
+
+    def flush(self):
+        """
+        The changes since the last update, as member -> state, after expiring typing.
+
+        Members that changed and changed back are left out. While anyone is
+        typing, or changes are left over beyond MAX_ENTRIES, this Presence
+        stays queued.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for member_name, expires in list(self.typing.items()):
+                if expires <= now:
+                    del self.typing[member_name]
+                    self.set(member_name, ACTIVE)
+
+            changes = {}
+            while self.changed and len(changes) < MAX_ENTRIES:
+                member_name = self.changed.pop()
+                state = self.states.get(member_name, LEFT)
+                if self.sent.get(member_name, LEFT) != state:
+                    changes[member_name] = state
+                    if state == LEFT:
+                        del self.sent[member_name]
+                    else:
+                        self.sent[member_name] = state
+            if changes:
+                self.roster = None
+            self.queued = bool(self.typing or self.changed)
+            if self.queued:
+                self.pending.add(self)
+            return changes
+
+    def hand_over(self):
+        """The state a successor server needs to carry on, for handoff.channel_state()"""
+        with self.lock:
+            return {"states": dict(self.states), "sent": dict(self.sent), "typing": list(self.typing)}
+
+    def take_over(self, state):
+        """
+        Carries on from the state of the same channel's Presence in the previous server.
+
+        Members whose state changed since that server's last update are in
+        the next update here; those who left it are sent as having left.
+        """
+        with self.lock:
+            self.states.update(state["states"])
+            self.sent.update(state["sent"])
+            expires = time.monotonic() + TYPING_TIMEOUT
+            for member_name in state["typing"]:
+                if self.states.get(member_name) == TYPING:
+                    self.typing[member_name] = expires
+            for member_name in set(self.states) | set(self.sent):
+                if self.states.get(member_name, LEFT) != self.sent.get(member_name, LEFT):
+                    self.touch(member_name)
+            self.roster = None
+
+    def memory(self):
+        """Approximate bytes held, for lifecycle.channel_memory()"""
+        size = sum(sys.getsizeof(table) for table in (self.states, self.sent, self.typing, self.changed))
+        if self.roster is not None:
+            size += sys.getsizeof(self.roster)
+        return size
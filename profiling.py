@@ -0,0 +1,222 @@
+"""
+Hot-path timing spans and an on-demand sampling profiler for the server.
+
+Spans are always on. The server brackets each hot path (handshake, join,
+member id generation, payload decoding, broadcast, socket writes) with two
+perf_counter() calls and records the difference in SPANS, the process-wide
+Spans table. The calls, total time and worst case per span are exposed as
+metrics and in the periodic stats log, which is usually enough to tell where
+the time goes.
+
+When it is not, SamplingProfiler samples every thread's Python stack with
+sys._current_frames() and counts identical stacks. Its output is the
+"folded" format read by flamegraph.pl, speedscope and inferno: one line per
+stack, frames from the thread's name down to the leaf separated by ";",
+followed by the number of samples. The sampling interval stretches
+automatically so that sampling never takes more than max_overhead of the
+time, however many threads there are.
+
+    kill -USR1 <server pid>     # start sampling
+    kill -USR1 <server pid>     # stop and write chat-profile-<pid>-<time>-<n>.folded
+    curl -s 'http://127.0.0.1:9100/profile?seconds=10' > server.folded
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+log = logging.getLogger("chat.profiling")
+
+SAMPLE_INTERVAL = 0.005
+MAX_OVERHEAD = 0.02
+MAX_DEPTH = 128
+
+
+class Span:
+    """Call count, total and worst-case duration of one code path"""
+
+    __slots__ = ("count", "total", "max", "lock")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+
+class Spans:
+    """Named spans, created on first use"""
+
+    def __init__(self):
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        span = self.spans.get(name)
+        if span is None:
+            with self.lock:
+                span = self.spans.setdefault(name, Span())
+        return span
+
+    def record(self, name, seconds):
+        self.get(name).record(seconds)
+
+    def snapshot(self):
+        """{name: (count, total seconds, max seconds)} at this instant"""
+        snapshot = {}
+        for name, span in list(self.spans.items()):
+            with span.lock:
+                snapshot[name] = (span.count, span.total, span.max)
+        return snapshot
+
+
+SPANS = Spans()
+
+
+FRAME_LABELS = {}
+
+
+def frame_label(code):
+    """'function (file:line)' for a code object, cached"""
+    label = FRAME_LABELS.get(code)
+    if label is None:
+        label = FRAME_LABELS[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every other thread until stopped.
+
+    Thread names become the root frame, so the server's client threads,
+    which all share a name, merge into one tree per role.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, max_overhead=MAX_OVERHEAD):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.stacks = Counter()
+        self.samples = 0
+        self.sampling_time = 0.0
+        self.started = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, on_stop=None):
+        """Start sampling; on_stop(profiler) is called from the sampling thread once stopped"""
+        self.stopped.clear()
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, args=(on_stop,), name="sampling-profiler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self, on_stop):
+        own = threading.get_ident()
+        names = {}
+        interval = self.interval
+        while not self.stopped.wait(interval):
+            sample_started = time.perf_counter()
+            self.sample(own, names)
+            cost = time.perf_counter() - sample_started
+            self.sampling_time += cost
+            # Sample less often when there are many stacks to walk
+            interval = max(self.interval, cost / self.max_overhead)
+
+        if on_stop is not None:
+            on_stop(self)
+
+    def sample(self, own, names):
+        frames = sys._current_frames()
+        if any(ident not in names for ident in frames):
+            names.clear()
+            names.update((thread.ident, thread.name) for thread in threading.enumerate())
+
+        for ident, frame in frames.items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def folded(self):
+        """The collected stacks in the folded format, heaviest first"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - (self.started or time.perf_counter()), 1e-9)
+        return (
+            f"{self.samples} samples in {elapsed:.1f}s, "
+            f"{self.sampling_time / elapsed:.2%} of the time spent sampling"
+        )
+
+    def profile(self, seconds):
+        """Sample for a fixed time and return the folded stacks (blocks the caller)"""
+        self.start()
+        time.sleep(seconds)
+        self.stop()
+        self.thread.join()
+        return self.folded()
+
+
+class ProfilerToggle:
+    """
+    Starts and stops a SamplingProfiler on each call, e.g. from a signal handler.
+
+    Stopping writes the folded stacks to a file in directory; the file is
+    written by the sampling thread, so the caller never does I/O. Signal
+    handlers only ever run on the main thread, one at a time, so there is
+    no lock (which a handler could deadlock on).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profiler = None
+        self.dumps = 0
+
+    def __call__(self, *args):
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.stop()
+            self.profiler = None
+        else:
+            self.profiler = SamplingProfiler()
+            self.profiler.start(on_stop=self.dump)
+            log.info("Sampling profiler started")
+
+    def dump(self, profiler):
+        self.dumps += 1
+        path = os.path.join(
+            self.directory,
+            f"chat-profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{self.dumps}.folded"
+        )
+        with open(path, "w") as output:
+            output.write(profiler.folded())
+        log.info("Sampling profiler stopped (%s); stacks written to %s", profiler.summary(), path)
+
+
+def profile_route(query):
+    """Metrics endpoint route: GET /profile?seconds=N samples for N seconds (at most 60)"""
+    try:
+        seconds = min(max(float(query.get("seconds", "10")), 0.1), 60.0)
+    except ValueError:
+        seconds = 10.0
+    return "text/plain; charset=utf-8", SamplingProfiler().profile(seconds).encode('utf-8')
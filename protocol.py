@@ -0,0 +1,169 @@
+import json
+import re
+import struct
+
+# Every frame is a 4-byte big-endian payload length followed by the payload.
+HEADER = struct.Struct("!I")
+
+# Keeping frames under 16 MiB means the first byte of a framed stream is always
+# 0x00, which can never start a bare JSON document sent by an old client.
+MAX_FRAME_SIZE = 1024 * 1024
+
+RECV_SIZE = 65536
+
+# What LegacyDecoder looks for, outside and inside strings
+SPECIAL = re.compile(rb'[{}\[\]"]')
+STRING_SPECIAL = re.compile(rb'["\\]')
+NOT_SPACE = re.compile(rb'\S')
+OPENING = b"{["
+QUOTE = ord('"')
+BACKSLASH = ord('\\')
+
+
+class FrameError(ValueError):
+    """Raised when a peer sends a frame that violates the wire protocol"""
+
+
+def encode_frame(payload):
+    """Prefix a payload with its length"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_message(data):
+    """Serialize a message dict and frame it"""
+    return encode_frame(json.dumps(data).encode('utf-8'))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for length-prefixed frames.
+
+    Bytes are appended to a single buffer and consumed from a read offset, so
+    each byte is looked at once no matter how TCP splits or coalesces frames.
+    """
+
+    framed = True
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data, limit=None):
+        """
+        Add received bytes and return the payloads of every frame now complete.
+
+        With a limit, at most that many are returned and the rest stay buffered.
+        """
+        buffer = self.buffer
+        buffer += data
+        payloads = []
+        offset = 0
+        available = len(buffer)
+
+        while available - offset >= HEADER.size and len(payloads) != limit:
+            (length,) = HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+
+            end = offset + HEADER.size + length
+            if end > available:
+                break
+            payloads.append(bytes(buffer[offset + HEADER.size:end]))
+            offset = end
+
+        if offset:
+            del buffer[:offset]
+        return payloads
+
+
+class LegacyDecoder:
+    """
+    Decoder for clients that predate framing and send bare JSON documents.
+
+    Splits documents that arrive coalesced in one read and buffers a document
+    that arrives split across reads. A document ends at the bracket that
+    closes its first one, outside strings; the bytes of a multibyte UTF-8
+    character never look like a bracket or a quote, so a character split
+    across reads stays whole. The scan carries on where the last read left
+    off, so each byte is looked at once however a large document is split.
+    """
+
+    framed = False
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.scanned = 0  # bytes of buffer already scanned
+        self.depth = 0
+        self.in_string = False
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        payloads = []
+        start = 0
+        position = self.scanned
+
+        while True:
+            if self.depth == 0:
+                # Between documents: skip whitespace to the start of the next
+                match = NOT_SPACE.search(buffer, start)
+                if match is None:
+                    start = position = len(buffer)
+                    break
+                start = position = match.start()
+                if buffer[start] not in OPENING:
+                    # Not a document at all; hand it on for the caller to report
+                    payloads.append(legacy_payload(buffer[start:]))
+                    start = position = len(buffer)
+                    break
+
+            match = (STRING_SPECIAL if self.in_string else SPECIAL).search(buffer, position)
+            if match is None:
+                position = len(buffer)
+                break
+            position = match.start()
+            byte = buffer[position]
+            if self.in_string:
+                if byte == BACKSLASH:
+                    if position + 1 == len(buffer):
+                        # The escaped character is still in flight
+                        break
+                    position += 2
+                    continue
+                self.in_string = False
+            elif byte == QUOTE:
+                self.in_string = True
+            elif byte in OPENING:
+                self.depth += 1
+            else:
+                self.depth -= 1
+            position += 1
+            if self.depth == 0:
+                # Complete, though not necessarily valid; the caller reports that
+                payloads.append(legacy_payload(buffer[start:position]))
+                start = position
+
+        if self.depth and len(buffer) - start > self.max_frame_size:
+            payloads.append(legacy_payload(buffer[start:]))
+            start = position = len(buffer)
+            self.depth = 0
+            self.in_string = False
+        if start:
+            del buffer[:start]
+        self.scanned = position - start
+        return payloads
+
+
+def legacy_payload(document):
+    """A document from a legacy client as UTF-8, with any invalid bytes replaced as before"""
+    return bytes(document).decode('utf-8', errors='replace').encode('utf-8')
+
+
+def negotiate(first_chunk):
+    """Pick a decoder for a new connection from the first bytes it sent"""
+    if first_chunk.lstrip()[:1] == b"{":
+        return LegacyDecoder()
+    return FrameDecoder()
@@ -0,0 +1,245 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from profiling import SPANS
+from tools import IdPool
+
+DEFAULT_SHARDS = 16
+
+
+class ChannelRegistry:
+    """
+    Thread-safe map of channel name to channel.
+
+    Channels are spread over lock-striped shards, so creating a channel only
+    serializes against channels that hash to the same shard. Each channel dict
+    carries its own lock guarding its "members" dict, plus a cached tuple
+    snapshot of the members that broadcasts iterate without taking the lock.
+    Joins and leaves only invalidate the snapshot, and the next broadcast
+    rebuilds it once.
+
+    Channel ids come from an itertools.count, whose next() is atomic. Member
+    names are the requested name plus "_" and a random id from an IdPool,
+    which never hands out an id that is in use, so names are unique without
+    probing the channel. The pool is shared by every channel, so names are
+    unique across the server too, and member_index maps each one to its
+    (channel, connection) for delivery to named members.
+
+    A channel without members is idle. Idle channels are kept in the order
+    they went idle, so evict_idle() only ever looks at the front of that
+    queue. An evicted channel is marked "evicted", and add_member() refuses
+    it, so a join that looked the channel up just before can retry.
+    """
+
+    def __init__(self, shards=DEFAULT_SHARDS):
+        self.shards = [(threading.Lock(), {}) for _ in range(shards)]
+        self.channel_ids = itertools.count(1)
+        self.member_ids = IdPool(8)
+        self.member_index = {}
+        self.idle = OrderedDict()
+        self.idle_lock = threading.Lock()
+
+    def shard(self, channel_name):
+        return self.shards[hash(channel_name) % len(self.shards)]
+
+    def __contains__(self, channel_name):
+        return channel_name in self.shard(channel_name)[1]
+
+    def __getitem__(self, channel_name):
+        return self.shard(channel_name)[1][channel_name]
+
+    def __len__(self):
+        return sum(len(channels) for _, channels in self.shards)
+
+    def get(self, channel_name, default=None):
+        return self.shard(channel_name)[1].get(channel_name, default)
+
+    def values(self):
+        """A point-in-time list of every channel"""
+        channels = []
+        for _, shard_channels in self.shards:
+            channels.extend(list(shard_channels.values()))
+        return channels
+
+    def create(self, channel_name, **fields):
+        """
+        Atomically creates a channel if the name is free.
+
+        Returns the new channel dict, or None if the channel already exists.
+        """
+        lock, channels = self.shard(channel_name)
+        with lock:
+            if channel_name in channels:
+                return None
+
+            channel = {
+                "channelId": next(self.channel_ids),
+                "channelName": channel_name,
+                "members": {},
+                "lock": threading.Lock(),
+                "snapshot": (),
+                "idleSince": None,
+                "evicted": False,
+                **fields,
+            }
+            channels[channel_name] = channel
+            # Idle until someone joins
+            self.mark_idle(channel)
+            return channel
+
+    def remove(self, channel_name):
+        lock, channels = self.shard(channel_name)
+        with lock:
+            channel = channels.pop(channel_name, None)
+        if channel is not None:
+            with self.idle_lock:
+                if self.idle.get(channel_name) is channel:
+                    del self.idle[channel_name]
+        return channel
+
+    def add_member(self, channel, base_name, connection, on_join=None):
+        """
+        Adds a connection to a channel under a unique member name and returns the name.
+
+        on_join(member_name) runs under the channel lock before the member is
+        visible to broadcasts, which lets the caller queue the join reply
+        ahead of any channel message. Returns None if the channel has been
+        evicted.
+        """
+        started = time.perf_counter()
+        member_id = self.member_ids.allocate()
+        member_name = f"{base_name}_{member_id}"
+        SPANS.record("member_id", time.perf_counter() - started)
+
+        with channel["lock"]:
+            if channel["evicted"]:
+                self.member_ids.release(member_id)
+                return None
+            if on_join is not None:
+                try:
+                    on_join(member_name)
+                except Exception:
+                    self.member_ids.release(member_id)
+                    raise
+
+            if not channel["members"]:
+                self.mark_busy(channel)
+            channel["members"][member_name] = connection
+            channel["snapshot"] = None
+            self.member_index[member_name] = (channel, connection)
+            return member_name
+
+    def adopt_member(self, channel, member_name, connection):
+        """
+        Adds a member under the name it already has, taken over from another server process.
+
+        Returns False if the name's id is in use here or the channel has
+        been evicted.
+        """
+        member_id = member_name[-self.member_ids.length:]
+        if not self.member_ids.reserve(member_id):
+            return False
+        with channel["lock"]:
+            if channel["evicted"]:
+                self.member_ids.release(member_id)
+                return False
+            if not channel["members"]:
+                self.mark_busy(channel)
+            channel["members"][member_name] = connection
+            channel["snapshot"] = None
+            self.member_index[member_name] = (channel, connection)
+            return True
+
+    def remove_member(self, channel, member_name, connection=None):
+        """
+        Removes a member, optionally only if it is still bound to the given connection.
+
+        Returns True if the member was removed.
+        """
+        with channel["lock"]:
+            current = channel["members"].get(member_name)
+            if current is None or (connection is not None and current is not connection):
+                return False
+
+            del channel["members"][member_name]
+            channel["snapshot"] = None
+            del self.member_index[member_name]
+            if not channel["members"]:
+                self.mark_idle(channel)
+        self.member_ids.release(member_name[-self.member_ids.length:])
+        return True
+
+    def replace_member(self, channel, member_name, replace):
+        """
+        Binds an existing member to another connection, keeping its name and id.
+
+        replace(current) runs under the channel lock with the member's current
+        connection and returns the connection to bind instead, or None to
+        leave the member as it is. Returns the new connection, or None if the
+        member was not replaced (or is not in the channel at all).
+        """
+        with channel["lock"]:
+            current = channel["members"].get(member_name)
+            if current is None:
+                return None
+            connection = replace(current)
+            if connection is None:
+                return None
+
+            channel["members"][member_name] = connection
+            channel["snapshot"] = None
+            self.member_index[member_name] = (channel, connection)
+            return connection
+
+    def locate(self, member_name):
+        """The (channel, connection) of a member of any channel, or None"""
+        return self.member_index.get(member_name)
+
+    def mark_idle(self, channel):
+        with self.idle_lock:
+            channel["idleSince"] = time.monotonic()
+            self.idle[channel["channelName"]] = channel
+            self.idle.move_to_end(channel["channelName"])
+
+    def mark_busy(self, channel):
+        with self.idle_lock:
+            channel["idleSince"] = None
+            if self.idle.get(channel["channelName"]) is channel:
+                del self.idle[channel["channelName"]]
+
+    def evict_idle(self, ttl):
+        """Removes and returns the channels that have had no members for at least ttl seconds"""
+        now = time.monotonic()
+        evicted = []
+        while True:
+            with self.idle_lock:
+                if not self.idle:
+                    break
+                channel_name, channel = next(iter(self.idle.items()))
+                if channel["idleSince"] + ttl > now:
+                    break
+                del self.idle[channel_name]
+
+            lock, channels = self.shard(channel_name)
+            with lock, channel["lock"]:
+                # Someone may have joined, or joined and left, since
+                idle_since = channel["idleSince"]
+                if channel["members"] or idle_since is None or idle_since + ttl > now:
+                    continue
+                if channels.get(channel_name) is channel:
+                    del channels[channel_name]
+                channel["evicted"] = True
+            evicted.append(channel)
+        return evicted
+
+    def members(self, channel):
+        """A tuple of (member_name, connection) pairs that is safe to iterate without locking"""
+        snapshot = channel["snapshot"]
+        if snapshot is None:
+            with channel["lock"]:
+                snapshot = channel["snapshot"]
+                if snapshot is None:
+                    snapshot = channel["snapshot"] = tuple(channel["members"].items())
+        return snapshot
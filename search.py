@@ -0,0 +1,202 @@
+"""
+Full-text search over channel history.
+
+A SearchIndex is an inverted index over the messages of one ChannelLog. It
+maps each lowercased word of a message, and "@" plus its sender's member
+name, to the log offsets of the messages that contain it. Offsets grow with
+time, so a time range is just an offset range, which the log's own timestamp
+index finds.
+
+New messages go into an open block. Every BLOCK_MESSAGES messages the block
+is closed, and the newest closed blocks are merged while they cover the same
+number of messages (up to MAX_BLOCK_MESSAGES), so a key is looked up in a
+handful of blocks however long the channel is. Posting lists are arrays of
+offsets in ascending order and are intersected by bisection, newest first,
+stopping as soon as a page is full. Once the index holds more than max_bytes
+(approximately), its oldest blocks are dropped and searches only reach back
+to first_offset.
+"""
+import bisect
+import json
+import re
+from array import array
+
+WORD = re.compile(r"\w+")
+MAX_WORD_LENGTH = 32
+
+BLOCK_MESSAGES = 1024
+MAX_BLOCK_MESSAGES = 65536
+
+# Rough cost of a key in a block besides its postings: the string, an empty
+# array and a dict slot
+KEY_BYTES = 180
+POSTING_BYTES = 8
+
+SEARCH_BYTES = 32 * 1024 * 1024
+MAX_RESULTS = 100
+
+
+def search_keys(query, member=None):
+    """The index keys a message must have to match a query string and, optionally, a sender"""
+    keys = {word for word in WORD.findall(query.lower()) if len(word) <= MAX_WORD_LENGTH}
+    if member:
+        keys.add("@" + member.lower())
+    return keys
+
+
+class Block:
+    """Posting lists for the messages with offsets in [start, end)"""
+
+    __slots__ = ("start", "end", "postings", "size")
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.postings = {}
+        self.size = 0
+
+    def add(self, offset, keys):
+        for key in keys:
+            postings = self.postings.get(key)
+            if postings is None:
+                postings = self.postings[key] = array("Q")
+                self.size += KEY_BYTES + len(key)
+            postings.append(offset)
+        self.size += POSTING_BYTES * len(keys)
+        self.end = offset + 1
+
+    def merge(self, newer):
+        """Appends the postings of the block that follows this one"""
+        for key, postings in newer.postings.items():
+            mine = self.postings.get(key)
+            if mine is None:
+                self.postings[key] = postings
+            else:
+                mine.extend(postings)
+                self.size -= KEY_BYTES + len(key)
+        self.size += newer.size
+        self.end = newer.end
+
+    def find(self, keys, start, end, limit, found):
+        """Appends to found, newest first, the offsets in [start, end) that have every key"""
+        lists = []
+        for key in keys:
+            postings = self.postings.get(key)
+            if postings is None:
+                return
+            lists.append(postings)
+        lists.sort(key=len)
+        shortest, others = lists[0], lists[1:]
+
+        low = bisect.bisect_left(shortest, start)
+        index = bisect.bisect_left(shortest, end)
+        while index > low and len(found) < limit:
+            index -= 1
+            offset = shortest[index]
+            for postings in others:
+                position = bisect.bisect_left(postings, offset)
+                if position == len(postings) or postings[position] != offset:
+                    break
+            else:
+                found.append(offset)
+
+
+class SearchIndex:
+    """
+    Inverted index over one channel's messages from offset `start` on.
+
+    Member names end in "_" and an id of member_id_length characters, and
+    each message is filed under both its sender's full name and the name
+    the sender asked for. Not thread-safe: ChannelLog calls it under its lock.
+    """
+
+    def __init__(self, start=0, max_bytes=SEARCH_BYTES, member_id_length=0):
+        self.blocks = []
+        self.active = Block(start)
+        self.max_bytes = max_bytes
+        self.member_id_length = member_id_length
+        # Bytes held by the closed blocks
+        self.size = 0
+        # False while older messages are still being added (see prepend)
+        self.complete = True
+
+    @property
+    def first_offset(self):
+        return self.blocks[0].start if self.blocks else self.active.start
+
+    @property
+    def next_offset(self):
+        return self.active.end
+
+    def memory(self):
+        """Approximate bytes held by the index"""
+        return self.size + self.active.size
+
+    def add_payload(self, offset, payload):
+        """Indexes one stored message from its JSON payload"""
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            message = None
+        self.add(offset, message)
+
+    def add(self, offset, message):
+        """Indexes one stored message dict; anything but a chat message only advances the offset"""
+        keys = ()
+        if isinstance(message, dict) and isinstance(message.get("message"), str):
+            keys = search_keys(message["message"])
+            member = message.get("memberName")
+            if isinstance(member, str):
+                keys.add("@" + member.lower())
+                if self.member_id_length and len(member) > self.member_id_length + 1:
+                    keys.add("@" + member[:-self.member_id_length - 1].lower())
+
+        self.active.add(offset, keys)
+        if self.active.end - self.active.start >= BLOCK_MESSAGES:
+            self.close_block()
+
+    def close_block(self):
+        block = self.active
+        self.blocks.append(block)
+        self.size += block.size
+        self.active = Block(block.end)
+
+        # Merge the newest blocks while they are the same length
+        while len(self.blocks) > 1:
+            newer, older = self.blocks[-1], self.blocks[-2]
+            length = older.end - older.start
+            if newer.end - newer.start != length or length * 2 > MAX_BLOCK_MESSAGES:
+                break
+            self.size -= older.size + newer.size
+            older.merge(newer)
+            self.size += older.size
+            self.blocks.pop()
+        self.evict()
+
+    def evict(self):
+        while self.blocks and self.memory() > self.max_bytes:
+            self.size -= self.blocks.pop(0).size
+
+    def prepend(self, older):
+        """Puts an index of the messages just before this one's first in front of it"""
+        blocks = older.blocks
+        if older.active.end > older.active.start:
+            blocks = blocks + [older.active]
+        self.blocks[:0] = blocks
+        self.size += sum(block.size for block in blocks)
+        self.complete = older.complete
+        self.evict()
+
+    def search(self, keys, start=0, end=None, limit=20):
+        """Offsets in [start, end) of the newest messages that have every key, newest first"""
+        if end is None:
+            end = self.next_offset
+        found = []
+        if not keys:
+            return found
+        for block in (self.active, *reversed(self.blocks)):
+            if len(found) >= limit or block.end <= start:
+                break
+            if block.start < end:
+                block.find(keys, start, end, limit, found)
+        return found
@@ -1,110 +1,770 @@
+import argparse
+import asyncio
+import concurrent.futures
 import socket
+import ssl
 import threading
 import json
-from tools import generate_secure_user_id
+import logging
+import selectors
+import signal
+import tempfile
+import time
+from admission import RETRY_AFTER, Admission, TokenBucket
+from cluster import CHANNEL_CREATED, DIRECT, MESSAGE, SocketBroker
+from codec import BINARY, BinarySession, MemberIds, decode as decode_binary
+from compression import COMPRESSIONS, STREAM, StreamCompressor
+from fanout import (
+    BATCH_MESSAGES, DEFAULT_QUEUE_LIMIT, SEND_FLAGS, SLOW_CONSUMER_POLICIES, EncodedMessage,
+    FanoutWriter, LatencyWindow, Outbox, tune_socket
+)
+from handoff import HandoffListener, Takeover, channel_state, member_state, restore_decoder, session_state
+from history import FSYNC_INTERVAL, MAX_HISTORY, MessageLog, now_ms
+from lifecycle import CHANNEL_TTL, ChannelLifecycle, ChannelStore
+from logs import LOG_LEVELS, setup_logging
+from metrics import MetricsEndpoint, ServerMetrics
+from presence import IDLE, PRESENCE_INTERVAL, STATES, Presence, with_roster
+from profiling import SPANS, ProfilerToggle, profile_route
+from protocol import FrameError, RECV_SIZE, encode_frame, negotiate
+from registry import ChannelRegistry
+from search import MAX_RESULTS, SEARCH_BYTES, search_keys
+from sessions import SESSION_GRACE, ParkedMember, SessionTable
+from tls import HANDSHAKE_WORKERS, TLSStream, server_context
+from tools import PasswordCache, hash_password
 from datetime import datetime
 
+log = logging.getLogger("chat.server")
+
+# Seconds a new connection has to send its create/join request
+HANDSHAKE_TIMEOUT = 10.0
+
+# Longest pause between rounds of expiring sessions and evicting channels
+HOUSEKEEPING_INTERVAL = 1.0
+
+# Most members one direct message may name
+MAX_RECIPIENTS = 64
+
+# Seconds a draining server waits for members' queued messages to be written
+DRAIN_TIMEOUT = 10.0
+
+# Seconds between rounds of draining
+DRAIN_POLL = 0.05
+
+# Members told the server is shutting down reconnect at a random point
+# within this many seconds
+RECONNECT_SPREAD = 5.0
+
+# Asyncio transports pause the protocol once this much data is buffered;
+# further messages wait in the member's bounded outbox.
+WRITE_BUFFER_HIGH = 64 * 1024
+
+
+def stored_password(meta):
+    """
+    The password hash in saved or replicated channel metadata.
+
+    Metadata written before passwords were hashed has the plain "password",
+    which is hashed on the way in.
+    """
+    if "passwordHash" in meta:
+        return meta["passwordHash"]
+    return hash_password(meta["password"]) if meta.get("password") else None
+
+
+def history_query(request):
+    """
+    The (since, last, limit) a history request asks for; since is None for the last messages.
+
+    Raises ValueError if the request is not an object or a field is not an integer.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("history options must be an object")
+    try:
+        limit = max(0, min(int(request.get("limit", MAX_HISTORY)), MAX_HISTORY))
+        since = int(request["since"]) if request.get("since") is not None else None
+        last = min(int(request.get("last", limit)), limit)
+    except (TypeError, ValueError):
+        raise ValueError("invalid history request")
+    return since, last, limit
+
+
+class ClientConnection:
+    """
+    A blocking client socket together with the wire format it negotiated.
+
+    Payloads handed to send() are JSON documents; they are length-prefixed for
+    framed clients and written as-is for legacy clients. Once a framed client
+    has negotiated the binary codec, binary holds its BinarySession and
+    everything queued for it or received from it is binary; compression is
+    the mode it negotiated for what it is sent, if any, and tls its
+    TLSStream once start_tls() has run the handshake. Broadcasts go
+    through enqueue(), which never blocks: whatever the socket cannot take
+    right away waits in a bounded outbox that the FanoutWriter thread drains.
+
+    With a batch_delay (seconds), a message queued less than batch_delay
+    after the previous write waits until batch_delay has passed, or until
+    BATCH_MESSAGES are queued, and goes out with the others in one vectored
+    write. An idle member's first message is still written at once.
+    """
+
+    def __init__(self, client_socket, addr, writer, metrics, queue_limit=DEFAULT_QUEUE_LIMIT, policy="drop",
+                 batch_delay=0, bucket=None):
+        self.socket = client_socket
+        self.addr = addr
+        self.decoder = None
+        self.binary = None
+        self.compression = None
+        self.tls = None
+        # Plaintext that arrived together with the end of the TLS handshake
+        self.buffered = b""
+        self.writer = writer
+        self.metrics = metrics
+        self.outbox = Outbox(self.encode, queue_limit, policy, metrics.messages_dropped)
+        self.lock = threading.Lock()
+        self.watched = False
+        self.closed = False
+        self.batch_delay = batch_delay
+        self.deferred = False
+        self.last_write = 0.0
+        self.bucket = bucket
+        self.resume_at = 0.0
+        self.refused_ref = None
+        self.refused_until = 0.0
+        self.session = None
+        self.deadline = None  # time.monotonic() by which every read must be done, while handshaking
+        metrics.connections.inc()
+        metrics.connections_accepted.inc()
+
+    @property
+    def framed(self):
+        return self.decoder is not None and self.decoder.framed
+
+    def receive(self):
+        """
+        Blocks until at least one complete message has arrived.
+
+        Returns a list of payloads, or None once the peer has disconnected.
+        """
+        pause = self.resume_at - time.monotonic()
+        if pause > 0:
+            # Throttled: leave the peer's data in the socket buffers for now
+            time.sleep(pause)
+        while True:
+            data = self.read()
+            if data is None:
+                return None
+            if not data:
+                continue
+
+            if self.decoder is None:
+                self.decoder = negotiate(data)
+
+            payloads = self.decoder.feed(data)
+            if payloads:
+                return payloads
+
+    def read(self):
+        """The next bytes from the peer, decrypted; b"" while a TLS record is incomplete, None at EOF"""
+        if self.buffered:
+            data, self.buffered = self.buffered, b""
+            return data
+        data = self.recv()
+        if not data:
+            return None
+        self.metrics.bytes_received.inc(len(data))
+        if self.tls is not None:
+            return self.tls.decrypt(data)
+        return data
+
+    def recv(self):
+        """One read from the socket, which times out at deadline if there is one"""
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("deadline passed")
+            self.socket.settimeout(remaining)
+        return self.socket.recv(RECV_SIZE)
+
+    def start_tls(self, context):
+        """
+        Runs the server side of a TLS handshake on the socket, blocking.
+
+        Everything read or written after it is encrypted. Raises ssl.SSLError
+        if the handshake fails.
+        """
+        self.tls = TLSStream(context, server_side=True)
+        data = b""
+        while True:
+            reply = self.tls.handshake(data)
+            if reply:
+                self.socket.sendall(reply)
+                self.metrics.bytes_sent.inc(len(reply))
+            if self.tls.established:
+                break
+            data = self.recv()
+            if not data:
+                raise ConnectionError("peer closed the connection during the TLS handshake")
+            self.metrics.bytes_received.inc(len(data))
+        self.outbox.encrypt(self.tls)
+        # A client may send its request right behind its last handshake message
+        self.buffered = self.tls.decrypt(b"") or b""
+
+    def encode(self, data):
+        return EncodedMessage.from_dict(data).for_connection(self)
+
+    def decode(self, payload):
+        if self.binary is not None:
+            return decode_binary(payload)
+        return json.loads(payload.decode('utf-8'))
+
+    def pause_reading(self, seconds):
+        """Stop reading from the peer for a while (takes effect at the next receive())"""
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    def send(self, payload):
+        """Blocking send, used for handshake replies before the member joins a channel"""
+        if self.framed:
+            payload = encode_frame(payload)
+        if self.tls is not None:
+            # Nothing is queued yet, so this cannot overtake queued records
+            payload = self.tls.encrypt(payload)
+        self.socket.sendall(payload)
+        self.metrics.socket_writes.inc()
+        self.metrics.bytes_sent.inc(len(payload))
+
+    def compress(self, compression):
+        """Compresses everything queued from now on (see compression.py)"""
+        with self.lock:
+            if compression == STREAM:
+                self.outbox.compress(StreamCompressor())
+            self.compression = compression
+
+    def enqueue(self, message):
+        """
+        Queues an EncodedMessage without blocking.
+
+        Returns False if the slow-consumer policy says to disconnect the member.
+        """
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("connection is closed")
+            if not self.outbox.push(message.for_connection(self)):
+                return False
+
+            if self.watched:
+                return True
+            if self.batch_delay and len(self.outbox) < BATCH_MESSAGES:
+                if self.deferred:
+                    return True
+                deadline = self.last_write + self.batch_delay
+                if deadline > time.monotonic():
+                    self.deferred = True
+                    self.writer.defer(self, deadline)
+                    return True
+
+            self.write_available()
+            if len(self.outbox):
+                self.watched = True
+                self.writer.watch(self)
+        return True
+
+    def write_available(self):
+        """Writes queued bytes until the socket would block (caller holds the lock)"""
+        started = time.perf_counter()
+        self.last_write = time.monotonic()
+        try:
+            while True:
+                chunks = self.outbox.peek_many()
+                if not chunks:
+                    return
+                try:
+                    if len(chunks) > 1 and hasattr(self.socket, "sendmsg"):
+                        sent = self.socket.sendmsg(chunks, (), SEND_FLAGS)
+                    else:
+                        sent = self.socket.send(chunks[0], SEND_FLAGS)
+                except BlockingIOError:
+                    return
+                self.outbox.consume(sent)
+                self.metrics.socket_writes.inc()
+                self.metrics.bytes_sent.inc(sent)
+        finally:
+            SPANS.record("socket_write", time.perf_counter() - started)
+
+    def flush_deferred(self):
+        """
+        Called by the FanoutWriter once a batch's delay is over.
+
+        Returns True if data remains and the writer should watch the socket.
+        """
+        with self.lock:
+            self.deferred = False
+            if self.closed or self.watched:
+                return False
+            try:
+                self.write_available()
+            except OSError as e:
+                log.warning("Failed to write to %s: %s", self.addr, e)
+                self.abort()
+                return False
+            if len(self.outbox):
+                self.watched = True
+                return True
+            return False
+
+    def flush_pending(self):
+        """
+        Called by the FanoutWriter when the socket is writable.
+
+        Returns True while queued data remains.
+        """
+        with self.lock:
+            if not self.closed:
+                try:
+                    self.write_available()
+                except OSError as e:
+                    log.warning("Failed to write to %s: %s", self.addr, e)
+                    self.abort()
+                else:
+                    if len(self.outbox):
+                        return True
+            self.watched = False
+            return False
+
+    def flushed(self):
+        """Whether everything queued has been handed to the socket"""
+        return not len(self.outbox)
+
+    def abort(self):
+        """Drops the connection; the thread reading from it cleans up the member"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.metrics.connections.dec()
+            self.closed = True
+            if self.watched:
+                self.writer.forget(self)
+        self.socket.close()
+
 
 class Server:
     """
     A simple multithreaded TCP server that handles each client in a separate thread.
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, send_queue_limit=DEFAULT_QUEUE_LIMIT,
+                 slow_consumer_policy="drop", stats_interval=60, reuse_port=False, bus=None,
+                 history_dir=None, fsync_interval=FSYNC_INTERVAL, metrics_address=None, profile_dir=None,
+                 batch_delay=0, send_buffer=None, max_connections=None, max_handshakes=None,
+                 handshake_timeout=HANDSHAKE_TIMEOUT, member_rate=None, member_burst=None,
+                 channel_rate=None, channel_burst=None, session_grace=SESSION_GRACE,
+                 channel_ttl=CHANNEL_TTL, hibernate_dir=None, search_bytes=SEARCH_BYTES,
+                 compressions=COMPRESSIONS, tls=None, presence_interval=PRESENCE_INTERVAL,
+                 drain_timeout=DRAIN_TIMEOUT, handoff_path=None, takeover=None):
         """
         Initializes the server, binds it to the given host and port,
-        and starts listening for incoming connections.
+        and starts listening for incoming connections. serve_forever()
+        then accepts them until stop().
+
+        Each member gets an outbound queue of up to send_queue_limit messages;
+        slow_consumer_policy (drop, disconnect or coalesce) decides what
+        happens when it fills up. Every stats_interval seconds the server
+        prints per-channel fan-out latency percentiles (0 disables this).
+
+        To run as one of several workers, pass reuse_port=True so the port
+        can be shared through SO_REUSEPORT, and a cluster.Broker as bus so
+        channels and messages are replicated to the other workers.
+
+        With history_dir set, channels and their messages are persisted
+        there (fsynced every fsync_interval seconds) and restored on start,
+        and members can search them; each channel's search index may use up
+        to search_bytes of memory (see search.py).
+
+        Metrics are always collected; with metrics_address (unix:PATH or
+        tcp:HOST:PORT) they are served there in the Prometheus text format,
+        and GET /profile?seconds=N on the same address returns N seconds of
+        sampled stacks. SIGUSR1 starts and stops the sampling profiler, which
+        writes its stacks to profile_dir (the temp directory by default).
+
+        batch_delay (seconds, 0 disables) lets writes to a busy member wait
+        that long so they can be coalesced; see ClientConnection. send_buffer
+        sets SO_SNDBUF on client sockets.
+
+        Admission control (see admission.py): at most max_handshakes
+        connections may be waiting for their create/join request, each for
+        at most handshake_timeout seconds, and at most max_connections may
+        be channel members. Each member may send member_rate messages per
+        second, and all members of a channel together channel_rate, in
+        bursts of up to member_burst and channel_burst. None means no limit.
+
+        A member that joined with "resumable": true and loses its connection
+        stays in its channel for session_grace seconds, during which it can
+        resume with its session token (see sessions.py); 0 disables sessions.
+
+        A channel that has had no members for channel_ttl seconds is evicted
+        (0 keeps channels forever). Its metadata is hibernated in the history
+        directory, or in hibernate_dir when there is no history, and it is
+        woken by the next join; without either it is forgotten. See
+        lifecycle.py. With a bus, channels are never evicted: a worker cannot
+        tell whether members on other workers still use a channel, and one
+        it no longer knew of could be created again with another password.
+
+        compressions are the modes a framed client may ask for to have what
+        it is sent compressed (see compression.py); empty turns compression
+        off.
+
+        With tls, an ssl.SSLContext from tls.server_context(), every
+        connection must start with a TLS handshake, which runs off the
+        accept loop (see tls.py).
+
+        Joins, leaves and the typing and idle states members report are
+        coalesced into one presence update per channel every
+        presence_interval seconds, and the join reply lists the members and
+        their states (see presence.py); 0 turns presence off.
+
+        Once stopped, the server drains: it stops accepting, tells members
+        it is shutting down and closes their connections once what is queued
+        for them has been written, waiting at most drain_timeout seconds.
+        With handoff_path, a new server process can connect there to take
+        over the listening socket, the channels, the sessions and, where
+        possible, the members' connections; a server created with takeover,
+        a handoff.Takeover, is that new process (see handoff.py).
         """
 
-        self.channels = {}
-        self.channels_id = 1
+        self.channels = ChannelRegistry()
+        self.passwords = PasswordCache()
+        self.admission = Admission(max_connections, max_handshakes)
+        self.sessions = SessionTable(session_grace)
+        self.handshake_timeout = handshake_timeout
+        self.member_rate = member_rate
+        self.member_burst = member_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.metrics = ServerMetrics(self.channels, self.admission, self.sessions)
+        if metrics_address:
+            MetricsEndpoint(self.metrics, metrics_address, {"/profile": profile_route})
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, ProfilerToggle(profile_dir or tempfile.gettempdir()))
+        self.send_queue_limit = send_queue_limit
+        self.slow_consumer_policy = slow_consumer_policy
+        self.batch_delay = batch_delay
+        self.send_buffer = send_buffer
+        self.compressions = compressions
+        self.tls = tls
+        self.tls_pool = None
+        self.password_pool = None
+        self.presence_interval = presence_interval
+        # Presence of the channels with changes for the next update
+        self.presence_pending = set()
+        self.bus = bus
+        self.drain_timeout = drain_timeout
+        self.draining = False
+        self.handoff_path = handoff_path
+        self.handoff = None
+        # The handoff.Link to the server taking over, once one has asked
+        self.successor = None
+        self.drain_deadline = None
+        self.takeover = takeover
+
+        self.history = None
+        if history_dir:
+            self.history = MessageLog(
+                history_dir, fsync_interval, search_bytes=search_bytes, member_id_length=self.channels.member_ids.length
+            )
+            for meta in self.history.saved_channels():
+                # Rewrite metadata that still holds a plain password
+                self.add_channel(
+                    meta["channelName"], stored_password(meta), meta["chatOwner"], persist="passwordHash" not in meta
+                )
+            log.info("Restored %d channels from %s", len(self.channels), history_dir)
 
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((host, port))
-        self.server_socket.listen()
-        print(f"Server listening on {host}:{port}")
+        store = self.history
+        if store is None and hibernate_dir:
+            store = ChannelStore(hibernate_dir)
+        if bus is not None and channel_ttl:
+            log.info("Idle channels are not evicted on a cluster worker")
+            channel_ttl = 0
+        self.lifecycle = ChannelLifecycle(self.channels, channel_ttl, store)
+        if takeover is not None:
+            self.take_over_channels(takeover)
 
-        # Accept connections in a loop
-        while True:
-            try:
-                client_socket, addr = self.server_socket.accept()
-                print(f"Accepted connection from {addr}")
+        if stats_interval:
+            stats_thread = threading.Thread(target=self.report_stats, args=(stats_interval,), name="stats-reporter")
+            stats_thread.daemon = True
+            stats_thread.start()
+
+        if session_grace or channel_ttl:
+            housekeeping_thread = threading.Thread(target=self.housekeeping, name="housekeeping")
+            housekeeping_thread.daemon = True
+            housekeeping_thread.start()
+
+        if takeover is not None and takeover.listener is not None:
+            # Connections may already be waiting in its accept queue
+            self.server_socket = takeover.listener
+            log.info("Server took over listening on %s:%s", *self.server_socket.getsockname()[:2])
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.server_socket.bind((host, port))
+            self.server_socket.listen(socket.SOMAXCONN)
+            log.info("Server listening on %s:%s", host, port)
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_writer.setblocking(False)
+
+    def serve_forever(self):
+        """
+        Accepts connections in a loop, handing each one to its own thread.
+
+        Returns once stop() has been called and the server has drained.
+        """
+        self.writer = FanoutWriter()
+        if self.takeover is not None:
+            self.take_over_members(self.takeover)
+            self.take_over_sessions(self.takeover)
+        if self.bus is not None:
+            self.bus.start(self.handle_bus_event)
+        if self.presence_interval:
+            presence_thread = threading.Thread(target=self.presence_updates, name="presence")
+            presence_thread.daemon = True
+            presence_thread.start()
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *_: self.stop())
+        if self.handoff_path:
+            self.handoff = HandoffListener(self.handoff_path, self.handle_successor)
+
+        # The socket may be shared with another process, which can take a
+        # connection between select() and accept()
+        self.server_socket.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.server_socket, selectors.EVENT_READ)
+        selector.register(self.wake_reader, selectors.EVENT_READ)
+        while not self.draining:
+            selector.select()
+            while not self.draining:
+                try:
+                    client_socket, addr = self.server_socket.accept()
+                except BlockingIOError:
+                    break
+                except Exception as e:
+                    log.error("Error accepting connection: %s", e)
+                    self.stop()
+                    break
+                if not self.admission.begin_handshake():
+                    log.warning("Too many pending handshakes; refusing %s", addr)
+                    self.metrics.connections_rejected.inc()
+                    client_socket.close()
+                    continue
+                log.info("Accepted connection from %s", addr)
+                tune_socket(client_socket, self.batch_delay > 0, self.send_buffer)
 
                 # Handle each client in a separate thread
+                # Client threads share a name, so profiles merge them
                 client_thread = threading.Thread(
                     target=self.handle_client,
-                    args=(client_socket, addr)
+                    args=(client_socket, addr),
+                    name="client"
                 )
                 client_thread.daemon = True
                 client_thread.start()
-
-            except Exception as e:
-                print(f"Error accepting connection: {e}")
-                break
+        selector.close()
+        self.server_socket.close()
+        self.drain()
 
     def handle_client(self, client_socket, addr):
         """
         Handles the initial client connection and authentication
         """
+        connection = ClientConnection(
+            client_socket, addr, self.writer, self.metrics, self.send_queue_limit, self.slow_consumer_policy,
+            self.batch_delay, self.member_bucket()
+        )
         try:
+            # The TLS handshake and the request share the handshake timeout,
+            # however slowly the client trickles its bytes in
+            connection.deadline = time.monotonic() + self.handshake_timeout
+            if self.tls is not None:
+                connection.start_tls(self.tls)
+                self.tls_established(connection.tls)
+
             # Wait for initial request (create/join channel)
-            request = client_socket.recv(1024)
-            if not request:
-                print(f"Client {addr} disconnected during handshake.")
-                client_socket.close()
+            payloads = connection.receive()
+            if not payloads:
+                log.info("Client %s disconnected during handshake.", addr)
+                connection.close()
                 return
 
-            json_data = json.loads(request.decode('utf-8'))
-            print(f"Received from {addr}: {json_data}")
+            started = time.perf_counter()
+            json_data = json.loads(payloads[0].decode('utf-8'))
+            joined = self.handle_request(connection, addr, json_data)
+            SPANS.record("handshake", time.perf_counter() - started)
 
-            if json_data["action"] == "createChannel":
-                self.handle_create_channel(client_socket, addr, json_data)
+        except socket.timeout:
+            log.info("Client %s sent no request within %ss", addr, self.handshake_timeout)
+            self.metrics.handshake_timeouts.inc()
+            connection.close()
+            return
+        except ssl.SSLError as e:
+            log.warning("TLS handshake with %s failed: %s", addr, e)
+            self.metrics.tls_failures.inc()
+            connection.close()
+            return
+        except json.JSONDecodeError as e:
+            log.warning("JSON decode error from %s: %s", addr, e)
+            connection.close()
+            return
+        except Exception as e:
+            log.warning("Error handling client %s: %s", addr, e)
+            connection.close()
+            return
+        finally:
+            self.admission.finish_handshake()
 
-            elif json_data["action"] == "joinChannel":
-                self.handle_join_channel(client_socket, addr, json_data)
+        if joined:
+            connection.deadline = None
+            client_socket.settimeout(None)
+            channel, member_name = joined
+            # Anything pipelined behind the handshake is already a channel message
+            self.handle_messages(connection, addr, channel, member_name, payloads[1:])
 
-            else:
-                # Unknown action
+    def tls_established(self, stream):
+        self.metrics.tls_handshakes.inc()
+        if stream.resumed:
+            self.metrics.tls_resumed.inc()
+
+    def handle_request(self, connection, addr, json_data, password_hash=None):
+        """
+        Dispatches a handshake request (create/join channel, or resume a session).
+
+        Returns a (channel, member_name) tuple once the connection has joined
+        a channel, or None if the handshake was rejected. password_hash is
+        the result of password_work() if the request has been through it.
+        """
+        log.debug("Received from %s: %s", addr, json_data)
+
+        if self.draining:
+            # Whoever takes over, or this server once restarted, will have room
+            response = json.dumps({
+                "success": False,
+                "action": json_data["action"],
+                "message": "server is shutting down",
+                "retryAfter": RECONNECT_SPREAD
+            })
+            connection.send(response.encode('utf-8'))
+            connection.close()
+            return None
+
+        if json_data.get("history"):
+            # Checked before anything is queued, so a bad replay request
+            # cannot follow a join reply and then cut the member off
+            try:
+                history_query(json_data["history"])
+            except ValueError as e:
                 response = json.dumps({
                     "success": False,
-                    "action": "error",
-                    "message": "Unknown action"
+                    "action": json_data["action"],
+                    "message": str(e)
                 })
-                client_socket.send(response.encode('utf-8'))
-                client_socket.close()
+                connection.send(response.encode('utf-8'))
+                connection.close()
+                return None
 
-        except json.JSONDecodeError as e:
-            print(f"JSON decode error from {addr}: {e}")
-            client_socket.close()
-        except Exception as e:
-            print(f"Error handling client {addr}: {e}")
-            client_socket.close()
+        if json_data["action"] in ("createChannel", "joinChannel"):
+            if not self.admission.join():
+                log.warning("Server is full; refusing %s", addr)
+                self.metrics.connections_rejected.inc()
+                response = json.dumps({
+                    "success": False,
+                    "action": json_data["action"],
+                    "message": "server is full",
+                    "retryAfter": RETRY_AFTER
+                })
+                connection.send(response.encode('utf-8'))
+                connection.close()
+                return None
+
+            if json_data["action"] == "createChannel":
+                joined = self.handle_create_channel(connection, addr, json_data, password_hash)
+            else:
+                joined = self.handle_join_channel(connection, addr, json_data)
+            if not joined:
+                self.admission.leave()
+            return joined
 
-    def handle_create_channel(self, client_socket, addr, json_data):
-        """Handle channel creation"""
+        elif json_data["action"] == "resume":
+            return self.handle_resume(connection, addr, json_data)
+
+        else:
+            # Unknown action
+            response = json.dumps({
+                "success": False,
+                "action": "error",
+                "message": "Unknown action"
+            })
+            connection.send(response.encode('utf-8'))
+            connection.close()
+            return None
+
+    def add_channel(self, channel_name, password_hash, chat_owner, persist=False):
+        """
+        Creates a channel in the registry, attaching its history log if enabled.
+
+        password_hash comes from tools.hash_password(), or is None for a
+        channel without a password. Returns the channel, or None if it
+        already exists. With persist=True a new channel's metadata is saved so
+        it survives a restart.
+        """
+        channel = self.channels.create(
+            channel_name,
+            passwordHash=password_hash,
+            chatOwner=chat_owner,
+            rateLimit=TokenBucket(self.channel_rate, self.channel_burst) if self.channel_rate else None,
+            fanoutLatency=LatencyWindow(),
+            memberIds=MemberIds(),
+            presence=Presence(channel_name, self.presence_pending) if self.presence_interval else None,
+            log=self.history.channel(channel_name) if self.history is not None else None,
+        )
+        if channel is not None and persist and self.history is not None:
+            self.history.save_channel(channel_name, {"passwordHash": password_hash, "chatOwner": chat_owner})
+        return channel
+
+    def handle_create_channel(self, client_socket, addr, json_data, password_hash=None):
+        """Handle channel creation; password_hash, if given, is the hash of the channel password"""
         try:
             if json_data.get("channelName") and json_data.get("memberName"):
-                if json_data["channelName"] not in self.channels:
-                    # Create the channel
-                    self.channels[json_data["channelName"]] = {
-                        "channelId": self.channels_id,
-                        "channelName": json_data["channelName"],
-                        "password": json_data.get("channelPassword", ""),
-                        "members": {},
-                        "chatOwner": json_data["memberName"],
-                    }
-
+                # Create the channel (atomically, so two creators cannot race),
+                # without hashing a password for a name that is obviously taken
+                channel = None
+                if self.find_channel(json_data["channelName"]) is None:
+                    password = json_data.get("channelPassword", "")
+                    channel = self.add_channel(
+                        json_data["channelName"],
+                        (password_hash or hash_password(password)) if password else None,
+                        json_data["memberName"],
+                        persist=True,
+                    )
+                if channel is not None:
                     response = json.dumps({
                         "success": True,
                         "action": "createChannel",
                         "message": "channel created successfully"
                     })
                     client_socket.send(response.encode('utf-8'))
-                    self.channels_id += 1
+
+                    if self.bus is not None:
+                        self.bus.publish(CHANNEL_CREATED, channel["channelName"], json.dumps({
+                            "passwordHash": channel["passwordHash"],
+                            "chatOwner": channel["chatOwner"],
+                        }).encode('utf-8'))
 
                     # After creating, automatically join the channel
-                    self.join_channel_logic(client_socket, addr, json_data)
+                    return self.join_channel_logic(client_socket, addr, json_data)
 
                 else:
                     response = json.dumps({
@@ -124,16 +784,15 @@ class Server:
                 client_socket.close()
 
         except Exception as e:
-            print(f"Error creating channel for {addr}: {e}")
+            log.warning("Error creating channel for %s: %s", addr, e)
             client_socket.close()
 
     def handle_join_channel(self, client_socket, addr, json_data):
         """Handle joining a channel"""
         try:
-            if json_data["channelName"] in self.channels:
-                channel = self.channels[json_data["channelName"]]
-
-                if channel["password"] != json_data.get("channelPassword", ""):
+            channel = self.find_channel(json_data["channelName"])
+            if channel is not None:
+                if not self.check_password(channel, json_data.get("channelPassword", "")):
                     response = json.dumps({
                         "success": False,
                         "action": "joinChannel",
@@ -155,7 +814,7 @@ class Server:
                     return
 
                 # Join the channel
-                self.join_channel_logic(client_socket, addr, json_data)
+                return self.join_channel_logic(client_socket, addr, json_data)
 
             else:
                 response = json.dumps({
@@ -168,106 +827,1468 @@ class Server:
                 client_socket.close()
 
         except Exception as e:
-            print(f"Error joining channel for {addr}: {e}")
+            log.warning("Error joining channel for %s: %s", addr, e)
             client_socket.close()
 
+    def find_channel(self, channel_name):
+        """The channel with that name, woken from hibernation if need be, or None"""
+        return self.lifecycle.find(channel_name, self.restore_channel)
+
+    def restore_channel(self, meta):
+        channel = self.add_channel(meta["channelName"], stored_password(meta), meta["chatOwner"])
+        if channel is not None:
+            self.metrics.channels_restored.inc()
+        return channel
+
+    def password_work(self, json_data):
+        """
+        The PBKDF2 run a create or join request needs, as a function, or None if it needs none.
+
+        The asyncio engine calls it off the event loop and passes its result
+        to handle_request() as password_hash: the hash of a new channel's
+        password, or None for a join, whose outcome it leaves in the
+        password cache.
+        """
+        password = json_data.get("channelPassword")
+        if not password or not isinstance(password, str) or not json_data.get("channelName"):
+            return None
+        if json_data.get("action") == "createChannel":
+            if self.find_channel(json_data["channelName"]) is not None:
+                return None
+            return lambda: hash_password(password)
+        if json_data.get("action") == "joinChannel":
+            channel = self.find_channel(json_data["channelName"])
+            if channel is None or channel["passwordHash"] is None:
+                return None
+            stored = channel["passwordHash"]
+            if self.passwords.known(password, stored):
+                return None
+
+            def check():
+                self.passwords.check(password, stored)
+            return check
+        return None
+
+    def check_password(self, channel, password):
+        """Whether a presented password opens the channel (cached; see tools.PasswordCache)"""
+        if channel["passwordHash"] is None:
+            return not password
+        return self.passwords.check(password, channel["passwordHash"])
+
+    def compression_for(self, connection, request):
+        """The compression mode a create/join/resume request asked for, if this server allows it"""
+        compression = request.get("compress")
+        if compression in self.compressions and connection.framed:
+            return compression
+        return None
+
     def join_channel_logic(self, client_socket, addr, json_data):
         """Common logic for joining a channel (used by both create and join)"""
+        started = time.perf_counter()
         try:
-            channel = self.channels[json_data["channelName"]]
+            # Only framed clients can switch to the binary codec or compress
+            binary = json_data.get("codec") == BINARY and client_socket.framed
+            compression = self.compression_for(client_socket, json_data)
 
-            # Generate unique member name
-            base_name = json_data["memberName"]
-            member_name = f"{base_name}_{generate_secure_user_id(8)}"
+            def send_join_response(member_name):
+                # Queued before the member can receive broadcasts, so the
+                # reply is always the first thing they read
+                response = {
+                    "action": "joinChannel",
+                    "channelName": json_data["channelName"],
+                    "channelId": channel["channelId"],
+                    "memberName": member_name,
+                    "message": "channel joined successfully",
+                    "success": True
+                }
+                if binary:
+                    response["codec"] = BINARY
+                if compression:
+                    response["compress"] = compression
+                if json_data.get("resumable") and self.sessions.grace:
+                    client_socket.session = self.sessions.create(channel, member_name, client_socket)
+                    response["session"] = client_socket.session.token
+                roster = channel["presence"].join(member_name) if channel["presence"] is not None else None
+                client_socket.enqueue(EncodedMessage(with_roster(response, roster)))
 
-            # Ensure uniqueness
-            count = 0
-            original_member_name = member_name
-            while member_name in channel["members"]:
-                count += 1
-                member_name = f"{original_member_name}_{count}"
+                # The reply itself is JSON; everything after it is binary
+                if binary:
+                    client_socket.binary = BinarySession(channel["memberIds"])
+                if compression:
+                    client_socket.compress(compression)
 
-            # Add member to channel
-            channel["members"][member_name] = client_socket
+                # Replay requested history ahead of live messages too
+                if json_data.get("history"):
+                    self.send_history(client_socket, channel, json_data["history"])
 
-            # Send success response
-            response = json.dumps({
-                "action": "joinChannel",
-                "channelName": json_data["channelName"],
-                "channelId": channel["channelId"],
-                "memberName": member_name,
-                "message": "channel joined successfully",
-                "success": True
-            })
-            client_socket.send(response.encode('utf-8'))
+            # Add member to channel under a unique name, looking the channel
+            # up again if it was evicted in the meantime
+            member_name = None
+            while member_name is None:
+                channel = self.find_channel(json_data["channelName"])
+                if channel is None:
+                    raise KeyError(f"channel {json_data['channelName']} no longer exists")
+                member_name = self.channels.add_member(
+                    channel, json_data["memberName"], client_socket, send_join_response
+                )
 
-            print(f"Member {member_name} joined channel {channel['channelName']}")
-            print(f"Active members in {channel['channelName']}: {len(channel['members'])}")
+            log.info("Member %s joined channel %s", member_name, channel['channelName'])
+            log.debug("Active members in %s: %d", channel['channelName'], len(channel['members']))
 
-            # Now handle ongoing messages for this client
-            self.handle_messages(client_socket, addr, channel, member_name)
+            SPANS.record("join", time.perf_counter() - started)
+            return channel, member_name
 
         except Exception as e:
-            print(f"Error in join_channel_logic for {addr}: {e}")
+            log.warning("Error in join_channel_logic for %s: %s", addr, e)
             client_socket.close()
 
-    def handle_messages(self, client_socket, addr, channel, member_name):
+    def handle_messages(self, connection, addr, channel, member_name, pending=()):
         """
         Handles ongoing messages from a client that has joined a channel
         """
-        print(f"Starting message handling for {member_name} in {channel['channelName']}")
+        log.debug("Starting message handling for %s in %s", member_name, channel['channelName'])
 
         try:
+            payloads = list(pending)
             while True:
-                message = client_socket.recv(1024)
-                if not message:
-                    print(f"Client {addr} ({member_name}) disconnected.")
+                for payload in payloads:
+                    self.handle_message(connection, channel, member_name, payload)
+
+                payloads = connection.receive()
+                if payloads is None:
+                    log.info("Client %s (%s) disconnected.", addr, member_name)
                     break
 
-                try:
-                    json_data = json.loads(message.decode('utf-8'))
-                    json_data["memberName"] = member_name
-                    json_data["timestamp"] = datetime.now().strftime("%H:%M:%S")
-
-                    print(f"Broadcasting message from {member_name}: {json_data}")
-
-                    # Broadcast to all members in the channel
-                    disconnected_members = []
-                    for name, connection in channel["members"].items():
-                        try:
-                            connection.send(json.dumps(json_data).encode('utf-8'))
-                        except Exception as e:
-                            print(f"Failed to send message to {name}: {e}")
-                            disconnected_members.append(name)
-
-                    # Remove disconnected members
-                    for name in disconnected_members:
-                        if name in channel["members"]:
-                            del channel["members"][name]
-                            print(f"Removed disconnected member: {name}")
-
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error from {member_name}: {e}")
+        except FrameError as e:
+            log.warning("Protocol error from %s (%s): %s", addr, member_name, e)
+        except (socket.error, ConnectionResetError) as e:
+            log.warning("Connection error with %s (%s): %s", addr, member_name, e)
+        finally:
+            self.disconnect_member(channel, member_name, connection)
+            connection.close()
+            log.debug("Connection with %s (%s) closed.", addr, member_name)
+
+    def handle_message(self, connection, channel, member_name, payload):
+        """Decodes one payload from a channel member and broadcasts it"""
+        received_at = time.perf_counter()
+        self.metrics.messages_received.inc()
+        try:
+            json_data = connection.decode(payload)
+        except ValueError as e:
+            log.warning("Decode error from %s: %s", member_name, e)
+            return
+        SPANS.record("decode", time.perf_counter() - received_at)
+
+        if json_data.get("action") == "leave":
+            # Leaving for good: nothing to resume, so the member goes at once
+            if connection.session is not None:
+                self.sessions.discard(connection.session)
+                connection.session = None
+            connection.abort()
+            return
+
+        if json_data.get("action") == "presence":
+            # Never forwarded, only folded into the next presence update, so
+            # not worth a rate limit
+            if channel["presence"] is not None and json_data.get("state") in STATES:
+                channel["presence"].report(member_name, json_data["state"])
+                self.metrics.presence_reports.inc()
+            return
+
+        # A client that pipelines messages tags each with a ref to be acknowledged
+        ref = json_data.pop("ref", None)
+        already_throttled = connection.refused_until > time.monotonic()
+        wait = self.throttle(connection, channel, json_data, ref)
+        if wait:
+            self.metrics.messages_throttled.inc()
+            # Messages without a ref get one notice per pause, not one each
+            if ref is not None or not already_throttled:
+                reply = {"action": "throttled", "retryAfter": round(wait, 3)}
+                if ref is not None:
+                    reply["ref"] = ref
+                connection.enqueue(EncodedMessage.from_dict(reply))
+            connection.pause_reading(wait)
+            return
+
+        if json_data.get("action") == "history":
+            try:
+                self.send_history(connection, channel, json_data)
+            except ValueError:
+                connection.enqueue(EncodedMessage.from_dict({"action": "error", "message": "invalid history request"}))
+            return
+        if json_data.get("action") == "search":
+            self.send_search(connection, channel, json_data)
+            return
+
+        missing = None
+        if "to" in json_data:
+            missing = self.send_direct(channel, member_name, json_data, received_at)
+        else:
+            self.broadcast(channel, member_name, json_data, received_at)
+        if channel["presence"] is not None:
+            channel["presence"].stop_typing(member_name)
+        if ref is not None:
+            ack = {"action": "ack", "ref": ref, "sentAt": json_data["sentAt"]}
+            if missing:
+                ack["missing"] = missing
+            connection.enqueue(EncodedMessage.from_dict(ack))
+        elif missing:
+            connection.enqueue(EncodedMessage.from_dict({
+                "action": "error",
+                "message": f"no such member: {', '.join(missing)}",
+                "missing": missing
+            }))
+
+    def member_bucket(self):
+        """A new member's rate limit, or None if members are not limited"""
+        if self.member_rate:
+            return TokenBucket(self.member_rate, self.member_burst)
+        return None
+
+    def throttle(self, connection, channel, json_data, ref=None):
+        """
+        Charges a request to the sender's and, for chat messages, the channel's rate limit.
+
+        Returns 0 if it may go ahead, otherwise the seconds the sender should wait.
+        Once a message with a ref is refused, later refs are refused too until
+        the sender resends it, so pipelined messages cannot overtake it.
+        """
+        if connection.refused_ref is not None and ref is not None:
+            if ref > connection.refused_ref:
+                return max(connection.refused_until - time.monotonic(), 0.001)
+            connection.refused_ref = None
+
+        wait = 0
+        if connection.bucket is not None:
+            wait = connection.bucket.take()
+        if not wait and channel["rateLimit"] is not None and json_data.get("action") not in ("history", "search"):
+            wait = channel["rateLimit"].take()
+        if wait:
+            connection.refused_until = time.monotonic() + wait
+            if ref is not None:
+                connection.refused_ref = ref
+        return wait
+
+    def send_history(self, connection, channel, request):
+        """
+        Queues stored messages for one member.
+
+        The request selects either the "last" N messages or those sent
+        "since" a time in epoch milliseconds (up to "limit"). A
+        {"action": "history", "count": N} header precedes the messages, which
+        are replayed exactly as they were broadcast. Raises ValueError for a
+        malformed request (see history_query()).
+        """
+        log = channel["log"]
+        if log is None:
+            connection.enqueue(EncodedMessage.from_dict({
+                "action": "history",
+                "channelName": channel["channelName"],
+                "count": 0,
+                "enabled": False
+            }))
+            return
+
+        since, last, limit = history_query(request)
+        if since is not None:
+            batch = log.read_since(since, limit)
+        else:
+            batch = log.read_last(last)
+
+        connection.enqueue(EncodedMessage.from_dict({
+            "action": "history",
+            "channelName": channel["channelName"],
+            "count": batch.count
+        }))
+        if batch.count:
+            connection.enqueue(batch)
+
+    def send_search(self, connection, channel, request):
+        """
+        Answers a search of the channel's history with one page of results.
+
+        The request has a "query", whose words must all be in a message,
+        and/or a "member", the sender's full member name or the name they
+        asked for. "since" and "until" (epoch milliseconds) bound the time
+        sent, "limit" is the page size (up to MAX_RESULTS) and "before" the
+        "next" of a previous reply, to get the page after it. Results come
+        newest first, each the stored message plus its "offset" in the log.
+        """
+        reply = {"action": "search", "channelName": channel["channelName"], "results": [], "count": 0}
+        log = channel["log"]
+        if log is None:
+            reply["enabled"] = False
+            connection.enqueue(EncodedMessage.from_dict(reply))
+            return
+
+        try:
+            member = request.get("member")
+            keys = search_keys(str(request.get("query") or ""), member if isinstance(member, str) else None)
+            limit = max(1, min(int(request.get("limit", 20)), MAX_RESULTS))
+            since, until, before = (
+                None if request.get(field) is None else int(request[field]) for field in ("since", "until", "before")
+            )
+        except (TypeError, ValueError):
+            connection.enqueue(EncodedMessage.from_dict({"action": "error", "message": "invalid search request"}))
+            return
+
+        started = time.perf_counter()
+        # One more than a page, to tell whether there is another
+        results, index = log.search(keys, since, until, before, limit + 1)
+        self.metrics.search_latency.observe(time.perf_counter() - started)
+        if index is None:
+            reply["enabled"] = False
+            connection.enqueue(EncodedMessage.from_dict(reply))
+            return
+
+        page = results[:limit]
+        reply["results"] = [dict(json.loads(payload), offset=offset) for offset, payload in page]
+        reply["count"] = len(page)
+        reply["indexedFrom"] = index.first_offset
+        reply["complete"] = index.complete
+        if len(results) > limit:
+            reply["next"] = page[-1][0]
+        connection.enqueue(EncodedMessage.from_dict(reply))
+
+    def broadcast(self, channel, member_name, json_data, received_at=None):
+        """
+        Stamps a message with its sender and queues it for every member of the channel.
+
+        The message is serialized once and the same bytes are shared by every
+        recipient. Fan-out latency, from receipt to the last member's queue, is
+        recorded per channel.
+        """
+        if received_at is None:
+            received_at = time.perf_counter()
+
+        json_data["memberName"] = member_name
+        json_data["timestamp"] = datetime.now().strftime("%H:%M:%S")
+        json_data["sentAt"] = now_ms()
+
+        log.debug("Broadcasting message from %s: %s", member_name, json_data)
+
+        started = time.perf_counter()
+        message = EncodedMessage.from_dict(json_data)
+        if channel["log"] is not None:
+            channel["log"].append(message.framed, json_data["sentAt"], json_data)
+        self.fan_out(channel, message, received_at)
+
+        if self.bus is not None:
+            self.bus.publish(MESSAGE, channel["channelName"], message.payload)
+        SPANS.record("broadcast", time.perf_counter() - started)
+
+    def send_direct(self, channel, member_name, json_data, received_at=None):
+        """
+        Delivers a message to the members named in its "to", and a copy to the sender.
+
+        "to" is a member name or a list of up to MAX_RECIPIENTS. Each is found
+        through the registry's member index, in any channel on this server,
+        so the cost depends on the recipients and not on the size of their
+        channels. The message is serialized once and encoded once per
+        recipient channel; it is not stored in the history log. Names not
+        found here are published on the bus for the other workers. Returns
+        the names that could not be found (always none with a bus, which
+        cannot tell).
+        """
+        if received_at is None:
+            received_at = time.perf_counter()
+        recipients = json_data["to"]
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        if not isinstance(recipients, list):
+            recipients = []
+        recipients = list(dict.fromkeys(name for name in recipients if isinstance(name, str)))[:MAX_RECIPIENTS]
+
+        json_data["to"] = recipients
+        json_data["memberName"] = member_name
+        json_data["timestamp"] = datetime.now().strftime("%H:%M:%S")
+        json_data["sentAt"] = now_ms()
+        payload = json.dumps(json_data).encode('utf-8')
+
+        missing = self.deliver_direct(payload, json_data, [member_name, *recipients])
+        self.metrics.messages_direct.inc()
+        self.metrics.fanout_latency.observe(time.perf_counter() - received_at)
+        if missing and self.bus is not None:
+            self.bus.publish(DIRECT, channel["channelName"], payload)
+            return []
+        return missing
+
+    def deliver_direct(self, payload, json_data, names):
+        """Queues a direct message once for each named local member; returns the names not found"""
+        missing = []
+        by_channel = {}
+        # The sender may also be among the recipients
+        for name in dict.fromkeys(names):
+            found = self.channels.locate(name)
+            if found is None:
+                missing.append(name)
+                continue
+            channel, connection = found
+            # The binary form interns the sender in the recipient's channel
+            entry = by_channel.get(channel["channelId"])
+            if entry is None:
+                entry = by_channel[channel["channelId"]] = (channel, EncodedMessage(payload, json_data), [])
+            entry[2].append((name, connection))
+
+        for channel, message, members in by_channel.values():
+            self.deliver(channel, members, message)
+        return missing
+
+    def fan_out(self, channel, message, received_at):
+        """Queues an EncodedMessage for every local member of the channel"""
+        members = self.channels.members(channel)
+        self.deliver(channel, members, message)
+
+        latency = time.perf_counter() - received_at
+        channel["fanoutLatency"].record(latency)
+        self.metrics.fanout_latency.observe(latency)
+
+    def deliver(self, channel, members, message, counter=None):
+        """
+        Queues an EncodedMessage for some (name, connection) members of a channel, dropping any that fail.
+
+        Deliveries are counted in counter, messages_sent by default.
+        """
+        disconnected_members = []
+        for name, connection in members:
+            try:
+                if not connection.enqueue(message):
+                    log.warning("Disconnecting slow member %s", name)
+                    connection.abort()
+                    disconnected_members.append((name, connection))
+            except Exception as e:
+                log.warning("Failed to send message to %s: %s", name, e)
+                disconnected_members.append((name, connection))
+
+        (counter or self.metrics.messages_sent).inc(len(members) - len(disconnected_members))
+        if disconnected_members:
+            self.metrics.send_failures.inc(len(disconnected_members))
+
+        # Remove disconnected members, parking those that can resume with the
+        # message they missed
+        for name, connection in disconnected_members:
+            if getattr(connection, "session", None) is not None:
+                parked = self.park_member(channel, name, connection)
+                if parked is not None:
+                    parked.enqueue(message)
+            elif self.channels.remove_member(channel, name, connection):
+                if channel["presence"] is not None:
+                    channel["presence"].leave(name)
+                log.info("Removed disconnected member: %s", name)
+
+    def handle_bus_event(self, kind, channel_name, payload):
+        """Applies a channel event published by another worker"""
+        if self.draining:
+            # Members are no longer written to, beyond what is already queued
+            return
+        if kind == MESSAGE:
+            channel = self.channels.get(channel_name)
+            if channel is not None:
+                message = EncodedMessage(payload)
+                if channel["log"] is not None:
+                    channel["log"].append(message.framed)
+                self.fan_out(channel, message, time.perf_counter())
+
+        elif kind == DIRECT:
+            # Recipients that are not connected here are someone else's
+            data = json.loads(payload.decode('utf-8'))
+            self.deliver_direct(payload, data, data.get("to", []))
+
+        elif kind == CHANNEL_CREATED:
+            fields = json.loads(payload.decode('utf-8'))
+            if self.add_channel(channel_name, stored_password(fields), fields["chatOwner"], persist=True) is not None:
+                log.info("Replicated channel %s from the bus", channel_name)
+
+    def fanout_report(self):
+        """Per-channel fan-out latency percentiles in milliseconds"""
+        report = {}
+        for channel in self.channels.values():
+            latency = channel["fanoutLatency"]
+            if latency.count:
+                report[channel["channelName"]] = {
+                    name: round(seconds * 1000, 3)
+                    for name, seconds in latency.percentiles().items()
+                }
+                report[channel["channelName"]]["messages"] = latency.count
+        return report
+
+    def report_stats(self, interval):
+        """Periodically logs throughput, and fan-out latency for every channel that has seen traffic"""
+        counters = (
+            self.metrics.messages_received, self.metrics.messages_sent,
+            self.metrics.bytes_received, self.metrics.bytes_sent,
+        )
+        previous = [counter.value for counter in counters]
+        while True:
+            time.sleep(interval)
+            current = [counter.value for counter in counters]
+            rates = [(now - before) / interval for now, before in zip(current, previous)]
+            previous = current
+            log.info(
+                "Throughput per second: %.0f messages in, %.0f out, %.0f bytes in, %.0f out; %d connections",
+                *rates, self.metrics.connections.value
+            )
+            log.info(
+                "Channels: %d (%d idle), about %.1f MB", len(self.channels), len(self.channels.idle),
+                self.lifecycle.memory() / 1e6
+            )
+            for channel_name, stats in self.fanout_report().items():
+                summary = " ".join(f"{name}={value}" for name, value in stats.items())
+                log.info("Fan-out latency (ms) in %s: %s", channel_name, summary)
+
+            spans = SPANS.snapshot()
+            if spans:
+                summary = " ".join(
+                    f"{name}={total / count * 1e6:.1f}/{longest * 1e6:.0f}"
+                    for name, (count, total, longest) in sorted(spans.items()) if count
+                )
+                log.info("Spans (mean/max us): %s", summary)
+
+    def remove_member(self, channel, member_name, connection=None):
+        """Clean up: remove member from channel"""
+        if self.channels.remove_member(channel, member_name, connection):
+            if channel["presence"] is not None:
+                channel["presence"].leave(member_name)
+            log.info("Removed %s from channel %s", member_name, channel['channelName'])
+
+    def disconnect_member(self, channel, member_name, connection):
+        """
+        Cleans up after a member's connection has closed.
+
+        A member with a session is parked until it resumes or the session
+        expires; any other member is removed from the channel and leaves.
+        """
+        session = connection.session
+        if session is not None:
+            if self.park_member(channel, member_name, connection) is not None:
+                return
+            if session.connection is not connection:
+                # Parked already, or resumed on a new connection that now owns the member
+                return
+            self.sessions.discard(session)
+
+        self.remove_member(channel, member_name, connection)
+        self.admission.leave()
+
+    def park_member(self, channel, member_name, connection):
+        """Puts a ParkedMember in place of a member's connection; returns it, or None if not bound to it"""
+        session = connection.session
+
+        def park(current):
+            if current is not connection:
+                return None
+            parked = ParkedMember(self.send_queue_limit)
+            self.sessions.park(session, parked)
+            return parked
+
+        parked = self.channels.replace_member(channel, member_name, park)
+        if parked is not None:
+            if channel["presence"] is not None:
+                channel["presence"].report(member_name, IDLE)
+            log.info("Parked %s in channel %s for %ss", member_name, channel['channelName'], self.sessions.grace)
+        return parked
+
+    def handle_resume(self, connection, addr, json_data):
+        """
+        Rebinds a parked member, or one whose old connection is half-open, to this connection.
+
+        The reply and the messages the member missed are queued under the
+        channel lock, ahead of anything broadcast afterwards: the requested
+        "history" if the channel keeps one, otherwise what was buffered while
+        it was parked, whose number the reply gives as "count". Returns
+        (channel, member_name) like a join, or None if the session is gone.
+        """
+        session = self.sessions.get(json_data.get("session"))
+        binary = json_data.get("codec") == BINARY and connection.framed
+        compression = self.compression_for(connection, json_data)
+        previous = []
+
+        def rebind(current):
+            if not self.sessions.claim(session, connection):
+                return None
+            previous.append(current)
+            channel = session.channel
+            response = {
+                "action": "resume",
+                "channelName": channel["channelName"],
+                "channelId": channel["channelId"],
+                "memberName": session.member_name,
+                "session": session.token,
+                "message": "session resumed",
+                "success": True
+            }
+            if binary:
+                response["codec"] = BINARY
+            if compression:
+                response["compress"] = compression
+            replay_log = json_data.get("history") and channel["log"] is not None
+            missed = () if replay_log else getattr(current, "messages", ())
+            if not replay_log:
+                # The buffered messages follow the reply directly
+                response["count"] = len(missed)
+                if getattr(current, "skipped", 0):
+                    response["skipped"] = current.skipped
+            roster = channel["presence"].join(session.member_name) if channel["presence"] is not None else None
+            connection.enqueue(EncodedMessage(with_roster(response, roster)))
+            if binary:
+                connection.binary = BinarySession(channel["memberIds"])
+            if compression:
+                connection.compress(compression)
+
+            if replay_log:
+                self.send_history(connection, channel, json_data["history"])
+            for message in missed:
+                connection.enqueue(message)
+            return connection
+
+        if session is None or self.channels.replace_member(session.channel, session.member_name, rebind) is None:
+            response = json.dumps({
+                "success": False,
+                "action": "resume",
+                "message": "session expired"
+            })
+            connection.send(response.encode('utf-8'))
+            connection.close()
+            return None
+
+        connection.session = session
+        # A half-open connection still bound to the member is dropped; its
+        # cleanup sees the session has moved on and leaves the member alone
+        previous[0].abort()
+        self.metrics.sessions_resumed.inc()
+        log.info("Member %s resumed in channel %s from %s", session.member_name, session.channel['channelName'], addr)
+        return session.channel, session.member_name
+
+    def housekeeping(self):
+        """Expires sessions and evicts idle channels, in a background thread"""
+        interval = min(value for value in (self.sessions.grace, self.lifecycle.ttl, HOUSEKEEPING_INTERVAL) if value)
+        while True:
+            time.sleep(interval)
+            if self.draining:
+                # Sessions and channels are handed over or dropped as they are
+                continue
+            try:
+                self.reap_sessions()
+                self.metrics.channels_evicted.inc(len(self.lifecycle.evict()))
+            except Exception as e:
+                log.error("Housekeeping failed: %s", e)
+
+    def reap_sessions(self):
+        """Removes parked members whose grace period ran out"""
+        for session in self.sessions.expired():
+            self.remove_member(session.channel, session.member_name, session.connection)
+            self.admission.leave()
+            self.metrics.sessions_expired.inc()
+            log.info("Session of %s in %s expired", session.member_name, session.channel['channelName'])
+
+    def presence_updates(self):
+        """Flushes presence every presence_interval seconds, in a background thread"""
+        while True:
+            time.sleep(self.presence_interval)
+            try:
+                self.flush_presence()
+            except Exception as e:
+                log.error("Presence update failed: %s", e)
+
+    def flush_presence(self):
+        """
+        Broadcasts one presence update to each channel whose presence changed since the last.
+
+        Parked members are skipped; they get a roster when they resume.
+        Nothing is sent while draining.
+        """
+        if self.draining:
+            return
+        pending = self.presence_pending
+        for _ in range(len(pending)):
+            try:
+                presence = pending.pop()
+            except KeyError:
+                break
+            channel = self.channels.get(presence.channel_name)
+            if channel is None or channel["presence"] is not presence:
+                continue
+            # A member joining meanwhile gets a roster that is either already
+            # up to date or that this update brings up to date
+            with channel["lock"]:
+                changes = presence.flush()
+            if not changes:
+                continue
+            members = [
+                (name, connection) for name, connection in self.channels.members(channel)
+                if not isinstance(connection, ParkedMember)
+            ]
+            self.deliver(channel, members, EncodedMessage.from_dict({
+                "action": "presence",
+                "channelName": channel["channelName"],
+                "changes": changes
+            }), self.metrics.presence_updates)
+
+    def stop(self, successor=None):
+        """
+        Makes the server stop accepting and drain, then return from serve_forever().
+
+        With successor, a handoff.Link, the server hands over to the new
+        process at its other end. Safe to call from any thread and from
+        signal handlers; called again while draining, it stops waiting for
+        members' queued messages to be written.
+        """
+        if self.draining:
+            self.drain_timeout = 0
+            self.drain_deadline = 0
+            if successor is not None:
+                successor.close()
+            return
+        self.draining = True
+        self.successor = successor
+        self.wake()
+
+    def wake(self):
+        """Interrupts the accept loop"""
+        try:
+            self.wake_writer.send(b"\0")
+        except OSError:
+            pass
+
+    def handle_successor(self, link):
+        """Called on the handoff thread when a new server process connects to take over"""
+        if self.draining:
+            link.close()
+            return
+        # From here on, new connections wait in the accept queue for the successor
+        link.send({"kind": "listener"}, self.server_socket.fileno())
+        log.info("A new server process is taking over")
+        self.stop(link)
+
+    def drain(self):
+        """
+        Disconnects or hands over every member, then closes the history log.
+
+        Runs once the accept loop has stopped, in rounds of drain_pass()
+        until every member is gone or drain_timeout has passed.
+        """
+        log.info("Draining %d channels", len(self.channels))
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        notice = EncodedMessage.from_dict({"action": "shutdown", "retryAfter": RECONNECT_SPREAD})
+        notified = set()
+        while True:
+            overdue = time.monotonic() >= self.drain_deadline
+            moving = self.drain_pass(notified, notice, overdue)
+            # Connections dropped once overdue get a second to clean up
+            if moving is not None or time.monotonic() >= self.drain_deadline + 1:
+                break
+            time.sleep(DRAIN_POLL)
+        self.finish_drain(moving or [])
+
+    def drain_pass(self, notified, notice, overdue=False):
+        """
+        One round of draining; returns the members to hand over once nobody else is left.
+
+        A member the successor can take over is no longer read from, and is
+        ready once everything queued for it has been written. Every other
+        member is sent the shutdown notice, once, and disconnected when it
+        has been written; one with a session is parked. Returns a list of
+        (channel, member name, connection), or None while members remain.
+        Once overdue, everyone still here is disconnected.
+        """
+        moving = []
+        done = True
+        for channel in self.channels.values():
+            for member_name, connection in self.channels.members(channel):
+                if isinstance(connection, ParkedMember):
+                    continue
+                if not overdue and self.successor is not None and self.can_hand_over(connection):
+                    connection.hold()
+                    moving.append((channel, member_name, connection))
+                    done = done and connection.flushed()
                     continue
+                done = False
+                if connection not in notified:
+                    notified.add(connection)
+                    try:
+                        connection.enqueue(notice)
+                    except Exception as e:
+                        log.debug("Could not tell %s about the shutdown: %s", member_name, e)
+                elif overdue or connection.flushed():
+                    connection.abort()
+        return moving if done else None
 
-        except (socket.error, ConnectionResetError) as e:
-            print(f"Connection error with {addr} ({member_name}): {e}")
+    def can_hand_over(self, connection):
+        """
+        Whether a successor could carry on serving a member's connection.
+
+        Never with this engine: a client thread blocked in recv() would take
+        whatever the member sends next.
+        """
+        return False
+
+    def finish_drain(self, moving):
+        """Closes the history log, then hands over to the successor if there is one"""
+        if self.history is not None:
+            self.history.close()
+        if self.handoff is not None:
+            self.handoff.close()
+        if self.successor is None:
+            return
+        try:
+            self.hand_over(self.successor, moving)
+        except OSError as e:
+            log.error("Handing over to the new server process failed: %s", e)
         finally:
-            # Clean up: remove member from channel
-            if member_name in channel["members"]:
-                del channel["members"][member_name]
-                print(f"Removed {member_name} from channel {channel['channelName']}")
+            self.successor.close()
+            for _, _, connection in moving:
+                connection.release()
 
-            client_socket.close()
-            print(f"Connection with {addr} ({member_name}) closed.")
+    def hand_over(self, successor, moving):
+        """Sends the channels, the connections in moving and the parked sessions to the successor"""
+        channels = self.channels.values()
+        for channel in channels:
+            successor.send(channel_state(channel))
+        for channel, member_name, connection in moving:
+            successor.send(member_state(channel, member_name, connection), connection.fileno())
+        with self.sessions.lock:
+            parked = list(self.sessions.parked.values())
+        for session in parked:
+            successor.send(session_state(session))
+        successor.send({"kind": "done"})
+        log.info("Handed over %d channels, %d connections and %d sessions", len(channels), len(moving), len(parked))
+
+    def take_over_channels(self, takeover):
+        """Recreates the channels of the server taken over, with their binary member ids and presence"""
+        for state in takeover.channels:
+            channel = self.find_channel(state["channelName"])
+            if channel is None:
+                channel = self.add_channel(
+                    state["channelName"], state["passwordHash"], state["chatOwner"], persist=True
+                )
+            # Interned in the same order, so members' cached ids stay valid
+            member_ids = MemberIds()
+            for member_name in state["memberIds"]:
+                member_ids.intern(member_name)
+            channel["memberIds"] = member_ids
+            if channel["presence"] is not None and state["presence"] is not None:
+                channel["presence"].take_over(state["presence"])
+
+    def take_over_member(self, connection, state):
+        """
+        Binds a connection handed over by the previous server to its member.
+
+        Restores the codec, compression, session and partial frame it had
+        there. Returns (channel, member_name), or None if the member cannot
+        be taken over.
+        """
+        channel = self.channels.get(state["channelName"])
+        member_name = state["memberName"]
+        if channel is None:
+            return None
+        connection.decoder = restore_decoder(state)
+        if state["known"] is not None:
+            connection.binary = BinarySession(channel["memberIds"])
+            connection.binary.known.update(state["known"])
+        if state["compress"]:
+            connection.compress(state["compress"])
+        if not self.channels.adopt_member(channel, member_name, connection):
+            if channel["presence"] is not None:
+                channel["presence"].leave(member_name)
+            return None
+        if state["session"] is not None and self.sessions.grace:
+            connection.session = self.sessions.restore(state["session"], channel, member_name, connection)
+        self.admission.adopt()
+        return channel, member_name
+
+    def take_over_members(self, takeover):
+        """Serves the connections handed over by the previous server, each on its own thread"""
+        for state, client_socket in takeover.members:
+            try:
+                addr = client_socket.getpeername()
+            except OSError:
+                # Gone while being handed over
+                client_socket.close()
+                continue
+            client_socket.setblocking(True)
+            tune_socket(client_socket, self.batch_delay > 0, self.send_buffer)
+            connection = ClientConnection(
+                client_socket, addr, self.writer, self.metrics, self.send_queue_limit, self.slow_consumer_policy,
+                self.batch_delay, self.member_bucket()
+            )
+            joined = self.take_over_member(connection, state)
+            if joined is None:
+                connection.close()
+                continue
+            client_thread = threading.Thread(
+                target=self.handle_messages, args=(connection, addr, *joined), name="client"
+            )
+            client_thread.daemon = True
+            client_thread.start()
+
+    def take_over_sessions(self, takeover):
+        """Parks the members whose sessions the previous server handed over, with the messages they missed"""
+        for state in takeover.sessions:
+            channel = self.channels.get(state["channelName"])
+            if channel is None:
+                continue
+            parked = ParkedMember(self.send_queue_limit)
+            for payload in state["messages"]:
+                parked.enqueue(EncodedMessage(payload.encode('utf-8')))
+            parked.skipped += state["skipped"]
+            if not self.sessions.grace or not self.channels.adopt_member(channel, state["memberName"], parked):
+                if channel["presence"] is not None:
+                    channel["presence"].leave(state["memberName"])
+                continue
+            session = self.sessions.restore(state["session"], channel, state["memberName"], parked)
+            self.sessions.park(session, parked)
+            self.admission.adopt()
+        log.info("Took over %d connections and %d sessions", len(takeover.members), len(takeover.sessions))
+        self.takeover = None
+
+
+class ChannelProtocol(asyncio.Protocol):
+    """
+    Per-connection protocol used by AsyncServer.
+
+    Exposes the same send/close surface as ClientConnection so the Server
+    handshake and broadcast logic can drive it unchanged. On a TLS server,
+    each step of the TLS handshake runs on the server's handshake pool, and
+    the connection is not read from until the step is done. Likewise a
+    create or join request that needs PBKDF2 (see Server.password_work())
+    has it run on the server's password pool, and whatever the client sent
+    behind the request waits until the request has been handled. A
+    connection handed over by the previous server process comes with
+    adopted, its handoff.member_state(), and skips the handshake.
+    """
+
+    def __init__(self, server, adopted=None):
+        self.server = server
+        self.adopted = adopted
+        self.transport = None
+        self.addr = None
+        self.decoder = None
+        self.binary = None
+        self.compression = None
+        self.tls = None
+        self.channel = None
+        self.member_name = None
+        self.metrics = server.metrics
+        self.outbox = Outbox(
+            self.encode, server.send_queue_limit, server.slow_consumer_policy, server.metrics.messages_dropped
+        )
+        self.paused = False
+        self.batch_delay = server.batch_delay
+        self.flush_handle = None
+        self.last_write = 0.0
+        self.bucket = server.member_bucket()
+        self.refused_ref = None
+        self.refused_until = 0.0
+        self.session = None
+        self.admitted = False
+        self.handshaking = False
+        self.handshake_timer = None
+        self.resume_handle = None
+        self.deferred = None  # payloads received while a password is checked
+
+    @property
+    def framed(self):
+        return self.decoder is not None and self.decoder.framed
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.adopted is not None:
+            self.take_over()
+            return
+        if not self.server.admission.begin_handshake():
+            log.warning("Too many pending handshakes; refusing %s", transport.get_extra_info("peername"))
+            self.server.metrics.connections_rejected.inc()
+            transport.abort()
+            return
+        self.admitted = self.handshaking = True
+        self.handshake_timer = asyncio.get_running_loop().call_later(
+            self.server.handshake_timeout, self.handshake_expired
+        )
+        self.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        # asyncio already sets TCP_NODELAY on its transports
+        tune_socket(transport.get_extra_info("socket"), send_buffer=self.server.send_buffer)
+        self.addr = transport.get_extra_info("peername")
+        self.metrics.connections.inc()
+        self.metrics.connections_accepted.inc()
+        log.info("Accepted connection from %s", self.addr)
+        if self.server.tls is not None:
+            self.tls = TLSStream(self.server.tls, server_side=True)
+
+    def take_over(self):
+        """Carries on serving a member handed over by the previous server process"""
+        self.admitted = True
+        self.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        self.addr = self.transport.get_extra_info("peername")
+        self.metrics.connections.inc()
+        self.metrics.connections_accepted.inc()
+        joined = self.server.take_over_member(self, self.adopted)
+        self.adopted = None
+        if joined is None:
+            self.close()
+            return
+        self.channel, self.member_name = joined
+
+    def data_received(self, data):
+        self.metrics.bytes_received.inc(len(data))
+        if self.tls is not None:
+            if not self.tls.established:
+                self.continue_tls(data)
+                return
+            try:
+                data = self.tls.decrypt(data)
+            except ssl.SSLError as e:
+                log.warning("TLS error from %s: %s", self.addr, e)
+                self.close()
+                return
+            if data is None:
+                self.close()
+                return
+            if data:
+                self.handle_data(data)
+            return
+        self.handle_data(data)
+
+    def continue_tls(self, data):
+        """Runs the next step of the TLS handshake on the handshake pool"""
+        self.transport.pause_reading()
+        step = asyncio.get_running_loop().run_in_executor(self.server.tls_pool, self.tls.handshake, data)
+        step.add_done_callback(self.tls_step_done)
+
+    def tls_step_done(self, step):
+        if self.transport.is_closing():
+            return
+        try:
+            reply = step.result()
+        except ssl.SSLError as e:
+            log.warning("TLS handshake with %s failed: %s", self.addr, e)
+            self.metrics.tls_failures.inc()
+            self.transport.abort()
+            return
+        if reply:
+            self.transport.write(reply)
+            self.metrics.bytes_sent.inc(len(reply))
+        self.transport.resume_reading()
+        if self.tls.established:
+            self.server.tls_established(self.tls)
+            self.outbox.encrypt(self.tls)
+            # A client may send its request right behind its last handshake message
+            data = self.tls.decrypt(b"")
+            if data:
+                self.handle_data(data)
+
+    def handle_data(self, data):
+        if self.decoder is None:
+            self.decoder = negotiate(data)
+
+        try:
+            payloads = self.decoder.feed(data)
+        except FrameError as e:
+            log.warning("Protocol error from %s: %s", self.addr, e)
+            self.close()
+            return
+
+        self.handle_payloads(payloads)
+
+    def handle_payloads(self, payloads):
+        for index, payload in enumerate(payloads):
+            if self.transport.is_closing():
+                return
+            if self.deferred is not None:
+                self.deferred.extend(payloads[index:])
+                return
+
+            if self.channel is not None:
+                self.server.handle_message(self, self.channel, self.member_name, payload)
+            else:
+                self.handle_handshake(payload)
+
+    def handle_handshake(self, payload):
+        started = time.perf_counter()
+        try:
+            json_data = json.loads(payload.decode('utf-8'))
+            work = self.server.password_work(json_data) if isinstance(json_data, dict) else None
+        except json.JSONDecodeError as e:
+            log.warning("JSON decode error from %s: %s", self.addr, e)
+            self.end_handshake()
+            self.close()
+            return
+        except Exception as e:
+            log.warning("Error handling client %s: %s", self.addr, e)
+            self.end_handshake()
+            self.close()
+            return
+        if work is None:
+            self.finish_handshake(json_data, None, started)
+            return
+
+        # PBKDF2 takes tens of milliseconds, too long to hold up the loop;
+        # the handshake slot and timeout still apply meanwhile
+        self.deferred = []
+        self.transport.pause_reading()
+        step = asyncio.get_running_loop().run_in_executor(self.server.password_pool, work)
+        step.add_done_callback(lambda step: self.password_done(step, json_data, started))
+
+    def password_done(self, step, json_data, started):
+        if self.transport.is_closing():
+            return
+        try:
+            password_hash = step.result()
+        except Exception as e:
+            log.warning("Error checking the password of %s: %s", self.addr, e)
+            self.end_handshake()
+            self.close()
+            return
+        self.transport.resume_reading()
+        self.finish_handshake(json_data, password_hash, started)
+        payloads, self.deferred = self.deferred, None
+        self.handle_payloads(payloads)
+
+    def finish_handshake(self, json_data, password_hash, started):
+        self.end_handshake()
+        try:
+            joined = self.server.handle_request(self, self.addr, json_data, password_hash)
+        except Exception as e:
+            log.warning("Error handling client %s: %s", self.addr, e)
+            self.close()
+            return
+
+        SPANS.record("handshake", time.perf_counter() - started)
+        if joined:
+            self.channel, self.member_name = joined
+
+    def handshake_expired(self):
+        self.handshake_timer = None
+        log.info("Client %s sent no request within %ss", self.addr, self.server.handshake_timeout)
+        self.metrics.handshake_timeouts.inc()
+        self.close()
+
+    def end_handshake(self):
+        if self.handshake_timer is not None:
+            self.handshake_timer.cancel()
+            self.handshake_timer = None
+        if self.handshaking:
+            self.handshaking = False
+            self.server.admission.finish_handshake()
+
+    def connection_lost(self, exc):
+        if not self.admitted:
+            return
+        self.metrics.connections.dec()
+        self.end_handshake()
+        for handle in (self.flush_handle, self.resume_handle):
+            if handle is not None:
+                handle.cancel()
+        if self.channel is not None:
+            self.server.disconnect_member(self.channel, self.member_name, self)
+            log.debug("Connection with %s (%s) closed.", self.addr, self.member_name)
+
+    def pause_reading(self, seconds):
+        """Stop reading from the peer for a while, leaving its data in the socket buffers"""
+        if self.resume_handle is None and not self.transport.is_closing():
+            self.transport.pause_reading()
+            self.resume_handle = asyncio.get_running_loop().call_later(seconds, self.resume_reading)
+
+    def resume_reading(self):
+        self.resume_handle = None
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.write_available()
+
+    def encode(self, data):
+        return EncodedMessage.from_dict(data).for_connection(self)
+
+    def decode(self, payload):
+        if self.binary is not None:
+            return decode_binary(payload)
+        return json.loads(payload.decode('utf-8'))
+
+    def send(self, payload):
+        if self.transport.is_closing():
+            raise ConnectionError("transport is closing")
+        if self.framed:
+            payload = encode_frame(payload)
+        if self.tls is not None:
+            payload = self.tls.encrypt(payload)
+        self.transport.write(payload)
+        self.metrics.socket_writes.inc()
+        self.metrics.bytes_sent.inc(len(payload))
+
+    def compress(self, compression):
+        """Compresses everything queued from now on (see compression.py)"""
+        if compression == STREAM:
+            self.outbox.compress(StreamCompressor())
+        self.compression = compression
+
+    def enqueue(self, message):
+        """Queues an EncodedMessage; returns False if the member should be disconnected"""
+        if self.transport.is_closing():
+            raise ConnectionError("transport is closing")
+        if not self.outbox.push(message.for_connection(self)):
+            return False
+
+        if self.batch_delay and len(self.outbox) < BATCH_MESSAGES:
+            if self.flush_handle is not None:
+                return True
+            loop = asyncio.get_running_loop()
+            deadline = self.last_write + self.batch_delay
+            if deadline > loop.time():
+                self.flush_handle = loop.call_at(deadline, self.flush_deferred)
+                return True
+
+        self.write_available()
+        return True
+
+    def flush_deferred(self):
+        self.flush_handle = None
+        if not self.transport.is_closing():
+            self.write_available()
+
+    def write_available(self):
+        """Moves queued messages into the transport until it asks us to pause"""
+        started = time.perf_counter()
+        self.last_write = asyncio.get_running_loop().time()
+        while not self.paused:
+            chunks = self.outbox.peek_many()
+            if not chunks:
+                break
+            size = sum(len(chunk) for chunk in chunks)
+            self.transport.writelines(chunks)
+            self.outbox.consume(size)
+            self.metrics.socket_writes.inc()
+            self.metrics.bytes_sent.inc(size)
+        SPANS.record("socket_write", time.perf_counter() - started)
+
+    def hold(self):
+        """Stops reading from the peer for good, ahead of a handoff"""
+        if self.resume_handle is not None:
+            self.resume_handle.cancel()
+            self.resume_handle = None
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def flushed(self):
+        """Whether everything queued has been handed to the socket"""
+        return not len(self.outbox) and not self.transport.get_write_buffer_size()
+
+    def fileno(self):
+        return self.transport.get_extra_info("socket").fileno()
+
+    def release(self):
+        """Closes this process's descriptor of a socket handed over to another, leaving the connection open"""
+        self.channel = None
+        self.transport.abort()
+
+    def abort(self):
+        self.transport.abort()
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncServer(Server):
+    """
+    A single-threaded asyncio server that multiplexes every client on one event loop.
+
+    Speaks the same create/join/message protocol as Server, but each connection
+    costs a protocol object instead of a thread and its stack.
+    """
+
+    def serve_forever(self):
+        """Run the event loop until stopped and drained"""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        loop = self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if self.tls is not None:
+            self.tls_pool = concurrent.futures.ThreadPoolExecutor(HANDSHAKE_WORKERS, "tls-handshake")
+        self.password_pool = concurrent.futures.ThreadPoolExecutor(HANDSHAKE_WORKERS, "password")
+        if self.takeover is not None:
+            await self.take_over_members(self.takeover)
+            self.take_over_sessions(self.takeover)
+        if self.bus is not None:
+            # Bus events arrive on the broker's thread; apply them on the loop
+            self.bus.start(lambda *event: loop.call_soon_threadsafe(self.handle_bus_event, *event))
+
+        if self.presence_interval:
+            # Referenced here so the loop does not lose it while serving
+            presence_task = loop.create_task(self.presence_updates())
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, self.stop)
+        if self.handoff_path:
+            self.handoff = HandoffListener(self.handoff_path, self.handle_successor)
+
+        server = await loop.create_server(
+            lambda: ChannelProtocol(self),
+            sock=self.server_socket,
+            backlog=socket.SOMAXCONN
+        )
+        await self.stopped.wait()
+        server.close()
+        await self.drain()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def can_hand_over(self, connection):
+        """Whether a member's connection keeps all its state in objects a successor can rebuild"""
+        return connection.tls is None and connection.compression != STREAM
+
+    async def drain(self):
+        """Like Server.drain(), on the event loop"""
+        log.info("Draining %d channels", len(self.channels))
+        self.drain_deadline = time.monotonic() + self.drain_timeout
+        notice = EncodedMessage.from_dict({"action": "shutdown", "retryAfter": RECONNECT_SPREAD})
+        notified = set()
+        while True:
+            overdue = time.monotonic() >= self.drain_deadline
+            moving = self.drain_pass(notified, notice, overdue)
+            # Connections dropped once overdue get a second to clean up
+            if moving is not None or time.monotonic() >= self.drain_deadline + 1:
+                break
+            await asyncio.sleep(DRAIN_POLL)
+        self.finish_drain(moving or [])
+
+    async def take_over_members(self, takeover):
+        """Serves the connections handed over by the previous server on the event loop"""
+        loop = asyncio.get_running_loop()
+        for state, client_socket in takeover.members:
+            try:
+                await loop.connect_accepted_socket(lambda: ChannelProtocol(self, state), client_socket)
+            except OSError as e:
+                log.warning("Could not take over %s: %s", state["memberName"], e)
+                client_socket.close()
+
+    async def presence_updates(self):
+        """Flushes presence every presence_interval seconds, on the event loop"""
+        while True:
+            await asyncio.sleep(self.presence_interval)
+            try:
+                self.flush_presence()
+            except Exception as e:
+                log.error("Presence update failed: %s", e)
+
+
+SERVER_MODES = {
+    "threaded": Server,
+    "async": AsyncServer,
+}
 
 
 # To run the server:
 if __name__ == "__main__":
-    HOST, PORT = "0.0.0.0", 12345
+    parser = argparse.ArgumentParser(description="Console chat server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--mode", choices=sorted(SERVER_MODES), default="threaded",
+                        help="threaded: one thread per client, async: single asyncio event loop")
+    parser.add_argument("--send-queue", type=int, default=DEFAULT_QUEUE_LIMIT,
+                        help="maximum number of messages queued for one member")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default="drop",
+                        help="what to do when a member's send queue is full")
+    parser.add_argument("--stats-interval", type=float, default=60,
+                        help="seconds between fan-out latency reports (0 disables)")
+    parser.add_argument("--batch-delay", type=float, default=0, metavar="MS",
+                        help="let writes to a busy member wait up to MS milliseconds to be coalesced (0 disables)")
+    parser.add_argument("--send-buffer", type=int, metavar="BYTES",
+                        help="SO_SNDBUF for client sockets (default: chosen by the kernel)")
+    parser.add_argument("--max-connections", type=int,
+                        help="most channel members this server accepts (default: unlimited)")
+    parser.add_argument("--max-handshakes", type=int,
+                        help="most connections that may be waiting to create or join a channel (default: unlimited)")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_TIMEOUT,
+                        help="seconds a new connection has to send its create/join request")
+    parser.add_argument("--member-rate", type=float,
+                        help="messages per second each member may send (default: unlimited)")
+    parser.add_argument("--member-burst", type=int, help="burst allowed above --member-rate")
+    parser.add_argument("--channel-rate", type=float,
+                        help="messages per second all members of a channel may send together (default: unlimited)")
+    parser.add_argument("--channel-burst", type=int, help="burst allowed above --channel-rate")
+    parser.add_argument("--session-grace", type=float, default=SESSION_GRACE,
+                        help="seconds a disconnected member can resume its session (0 disables sessions)")
+    parser.add_argument("--channel-ttl", type=float, default=CHANNEL_TTL,
+                        help="seconds a channel may go without members before it is evicted "
+                             "(0 keeps channels; ignored with --bus)")
+    parser.add_argument("--hibernate-dir",
+                        help="keep evicted channels here so the next join wakes them (default: the history directory)")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="share the port with other worker processes (SO_REUSEPORT)")
+    parser.add_argument("--bus", help="pub/sub bus hub to join, unix:PATH or tcp:HOST:PORT (see cluster.py)")
+    parser.add_argument("--history-dir",
+                        help="persist channels and their message history in this directory")
+    parser.add_argument("--search-mb", type=float, default=SEARCH_BYTES / 1024 / 1024,
+                        help="memory each channel's search index may use, in MB; older messages drop out of search")
+    parser.add_argument("--compression", nargs="*", choices=COMPRESSIONS, default=COMPRESSIONS, metavar="MODE",
+                        help="compression modes clients may ask for: deflate, deflate-frame (none: off)")
+    parser.add_argument("--tls-cert", metavar="FILE",
+                        help="serve TLS only, with this PEM certificate chain (and the key, unless --tls-key)")
+    parser.add_argument("--tls-key", metavar="FILE", help="PEM private key for --tls-cert")
+    parser.add_argument("--presence-interval", type=float, default=PRESENCE_INTERVAL,
+                        help="seconds between coalesced presence updates to each channel (0 turns presence off)")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                        help="seconds to wait for members' queued messages to be written when shutting down")
+    parser.add_argument("--handoff", metavar="PATH",
+                        help="Unix socket where a new server process can connect to take over (see handoff.py)")
+    parser.add_argument("--takeover", metavar="PATH",
+                        help="take over the listening socket, channels and members of the server at PATH")
+    parser.add_argument("--fsync-interval", type=float, default=FSYNC_INTERVAL,
+                        help="seconds between batched fsyncs of the history log")
+    parser.add_argument("--metrics", metavar="ADDRESS",
+                        help="serve Prometheus-style metrics over HTTP on unix:PATH or tcp:HOST:PORT")
+    parser.add_argument("--profile-dir",
+                        help="where SIGUSR1 profiles are written (default: the temp directory)")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="info")
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+
     try:
-        server = Server(HOST, PORT)
+        takeover = None
+        if args.takeover:
+            try:
+                takeover = Takeover(args.takeover)
+            except OSError as e:
+                log.warning("No server to take over at %s (%s); starting afresh", args.takeover, e)
+        server = SERVER_MODES[args.mode](
+            args.host, args.port,
+            send_queue_limit=args.send_queue,
+            slow_consumer_policy=args.slow_consumer,
+            stats_interval=args.stats_interval,
+            reuse_port=args.reuse_port,
+            bus=SocketBroker(args.bus) if args.bus else None,
+            history_dir=args.history_dir,
+            fsync_interval=args.fsync_interval,
+            metrics_address=args.metrics,
+            profile_dir=args.profile_dir,
+            batch_delay=args.batch_delay / 1000,
+            send_buffer=args.send_buffer,
+            max_connections=args.max_connections,
+            max_handshakes=args.max_handshakes,
+            handshake_timeout=args.handshake_timeout,
+            member_rate=args.member_rate,
+            member_burst=args.member_burst,
+            channel_rate=args.channel_rate,
+            channel_burst=args.channel_burst,
+            session_grace=args.session_grace,
+            channel_ttl=args.channel_ttl,
+            hibernate_dir=args.hibernate_dir,
+            search_bytes=int(args.search_mb * 1024 * 1024),
+            compressions=tuple(args.compression),
+            tls=server_context(args.tls_cert, args.tls_key) if args.tls_cert else None,
+            presence_interval=args.presence_interval,
+            drain_timeout=args.drain_timeout,
+            handoff_path=args.handoff,
+            takeover=takeover,
+        )
+        server.serve_forever()
+        log.info("Server stopped.")
     except KeyboardInterrupt:
-        print("\nServer is shutting down.")
+        log.info("Server is shutting down.")
     except Exception as e:
-        print(f"An error occurred: {e}")
\ No newline at end of file
+        log.error("An error occurred: %s", e)
\ No newline at end of file
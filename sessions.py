@@ -0,0 +1,136 @@
+"""
+Resumable member sessions.
+
+A client that asks for it with "resumable": true in its join request gets a
+"session" token in the join reply. If its connection drops, the member is
+not removed from the channel: a ParkedMember takes the connection's place
+for a grace period, holding the member's name and buffering what is
+broadcast meanwhile. A {"action": "resume", "session": token} request on a
+new connection swaps that connection in, O(1) under the channel lock, and
+replays the buffered messages; the member keeps its name and never leaves
+the member table. Sessions that are not resumed in time are evicted in
+expiry order.
+"""
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+SESSION_GRACE = 30.0
+TOKEN_BYTES = 16
+
+
+class Session:
+    """One resumable member: where it is, and the connection currently serving it"""
+
+    __slots__ = ("token", "channel", "member_name", "connection", "expires")
+
+    def __init__(self, token, channel, member_name, connection):
+        self.token = token
+        self.channel = channel
+        self.member_name = member_name
+        self.connection = connection
+        self.expires = None
+
+
+class ParkedMember:
+    """
+    Stands in for a disconnected member until it resumes or its session expires.
+
+    Broadcasts are kept, up to limit messages, as EncodedMessages, so they
+    can be encoded for whatever wire format the resuming connection
+    negotiates. Once full, the oldest are dropped and counted in skipped.
+    """
+
+    def __init__(self, limit):
+        self.messages = deque(maxlen=limit)
+        self.skipped = 0
+
+    def enqueue(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.skipped += 1
+        self.messages.append(message)
+        return True
+
+    def abort(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SessionTable:
+    """
+    Sessions by token, plus the parked ones in the order they expire.
+
+    Every session has the same grace period, so parking order is expiry
+    order and eviction only ever looks at the front of an OrderedDict.
+
+    A session's connection changes only while its channel's lock is held
+    (see ChannelRegistry.replace_member), so it always matches the member's
+    entry in the channel; this table's own lock just guards its dicts.
+    """
+
+    def __init__(self, grace=SESSION_GRACE):
+        self.grace = grace
+        self.sessions = {}
+        self.parked = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, channel, member_name, connection):
+        token = secrets.token_urlsafe(TOKEN_BYTES)
+        session = Session(token, channel, member_name, connection)
+        with self.lock:
+            self.sessions[token] = session
+        return session
+
+    def restore(self, token, channel, member_name, connection):
+        """A session taken over, token and all, from the server this one replaced (see handoff.py)"""
+        session = Session(token, channel, member_name, connection)
+        with self.lock:
+            self.sessions[token] = session
+        return session
+
+    def park(self, session, parked):
+        """Hands the session to a ParkedMember until it is claimed or expires"""
+        with self.lock:
+            session.connection = parked
+            session.expires = time.monotonic() + self.grace
+            self.parked[session.token] = session
+            self.parked.move_to_end(session.token)
+
+    def get(self, token):
+        return self.sessions.get(token) if isinstance(token, str) else None
+
+    def claim(self, session, connection):
+        """Moves a session to a new connection; returns False if it has expired meanwhile"""
+        with self.lock:
+            if self.sessions.get(session.token) is not session:
+                return False
+            self.parked.pop(session.token, None)
+            session.expires = None
+            session.connection = connection
+            return True
+
+    def discard(self, session):
+        with self.lock:
+            if self.sessions.get(session.token) is session:
+                del self.sessions[session.token]
+            self.parked.pop(session.token, None)
+
+    def expired(self):
+        """Removes and returns the parked sessions whose grace period is over"""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            while self.parked:
+                token, session = next(iter(self.parked.items()))
+                if session.expires > now:
+                    break
+                del self.parked[token]
+                del self.sessions[token]
+                expired.append(session)
+        return expired
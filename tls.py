@@ -0,0 +1,128 @@
+"""
+Optional TLS for the connections between clients and the server.
+
+The server and the client run TLS themselves over memory buffers
+(ssl.MemoryBIO) instead of wrapping their sockets, so encrypted bytes take
+the same paths as plain ones. What a server sends is encrypted as it leaves
+the member's Outbox, after any stream compression, and goes out with the
+usual non-blocking writes. What it receives is decrypted before it is split
+into frames.
+
+The handshake never runs on the thread that accepts connections. The
+threaded server runs it on the client's own thread. The asyncio server runs
+each step of it on a small pool of threads (HANDSHAKE_WORKERS) while it
+stops reading from that connection, so a storm of handshakes does not stall
+the event loop. OpenSSL releases the GIL while it works, so the pool's
+threads run in parallel.
+
+After every handshake the server issues a session ticket. A client that
+reconnects presents the last one and skips the certificate exchange and the
+signature, the expensive part of a handshake. Ticket keys live in the server
+process: after a restart, or on another cluster worker, the next handshake
+is a full one again.
+
+A server with TLS accepts only TLS connections.
+"""
+import ssl
+import threading
+
+# Handshake steps the asyncio server runs at once, off the event loop
+HANDSHAKE_WORKERS = 4
+
+# Plaintext taken from the TLS buffers per read
+READ_SIZE = 65536
+
+
+def server_context(certfile, keyfile=None):
+    """A server's TLS settings, with its certificate chain and private key"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # A client keeps only the session of its last connection, so one ticket
+    # per handshake is enough (OpenSSL sends two by default)
+    context.num_tickets = 1
+    return context
+
+
+def client_context(cafile=None):
+    """A client's TLS settings; the server's certificate is checked against cafile, or the system's CAs"""
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+class TLSStream:
+    """
+    The TLS state of one connection.
+
+    Bytes from the peer go into handshake() until established, and into
+    decrypt() after that; plaintext to send goes through encrypt(). Each
+    returns bytes for the caller to deliver, and a lock serializes them, so
+    one thread can decrypt while another encrypts. Records OpenSSL writes on
+    its own while decrypting, such as the answer to a key update, go out
+    with the next encrypt(). A client passes the session of its last
+    connection to resume it.
+    """
+
+    def __init__(self, context, server_side=False, server_hostname=None, session=None):
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = context.wrap_bio(self.incoming, self.outgoing, server_side, server_hostname, session)
+        self.lock = threading.Lock()
+        self.established = False
+        self.closed = False
+
+    @property
+    def session(self):
+        """What a client passes to its next connection to resume this one"""
+        return self.tls.session
+
+    @property
+    def resumed(self):
+        return self.tls.session_reused
+
+    def handshake(self, data=b""):
+        """
+        Feeds bytes from the peer to the handshake; returns those to send back.
+
+        Raises ssl.SSLError if the handshake failed.
+        """
+        with self.lock:
+            self.incoming.write(data)
+            try:
+                self.tls.do_handshake()
+                self.established = True
+            except ssl.SSLWantReadError:
+                pass
+            return self.outgoing.read()
+
+    def decrypt(self, data):
+        """
+        The plaintext in bytes from the peer, b"" while a record is incomplete.
+
+        Returns None once the peer has closed TLS and nothing is left to read.
+        """
+        plaintext = []
+        with self.lock:
+            self.incoming.write(data)
+            try:
+                while True:
+                    chunk = self.tls.read(READ_SIZE)
+                    if not chunk:
+                        self.closed = True
+                        break
+                    plaintext.append(chunk)
+            except ssl.SSLWantReadError:
+                pass
+            except ssl.SSLZeroReturnError:
+                self.closed = True
+        data = b"".join(plaintext)
+        if self.closed and not data:
+            return None
+        return data
+
+    def encrypt(self, data):
+        """The records to send for plaintext bytes"""
+        with self.lock:
+            self.tls.write(data)
+            return self.outgoing.read()
@@ -1,4 +1,17 @@
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import os
 import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+# PBKDF2-HMAC-SHA256 work factor for channel passwords (about 30 ms per hash)
+PASSWORD_ITERATIONS = 100000
+SALT_BYTES = 16
+
 
 def generate_secure_user_id(num_bytes=16):
     """
@@ -15,3 +28,202 @@ def generate_secure_user_id(num_bytes=16):
         str: A URL-safe unique identifier string (e.g., 'pLgVn7yXqZ...').
     """
     return secrets.token_urlsafe(num_bytes)
+
+
+def generate_secure_user_ids(count, num_bytes=16):
+    """
+    Generates many IDs like generate_secure_user_id() from one read of the OS random source.
+
+    Args:
+        count (int): How many IDs to generate.
+        num_bytes (int): The number of random bytes in each ID.
+
+    Returns:
+        list: URL-safe identifier strings, all of the same length.
+    """
+    random = os.urandom(count * num_bytes)
+    return [
+        base64.urlsafe_b64encode(random[offset:offset + num_bytes]).rstrip(b"=").decode('ascii')
+        for offset in range(0, len(random), num_bytes)
+    ]
+
+
+class IdPool:
+    """
+    Hands out secure, unique IDs from a pool that a background thread keeps filled.
+
+    Taking an ID is a deque pop and a dict insert; the random bytes were read
+    and encoded ahead of time, in batches. IDs in use are kept in a dict whose
+    setdefault() is atomic, so an ID is never handed out twice until it is
+    released, without a lock. All IDs have the same length, `length`
+    characters.
+
+    Args:
+        num_bytes (int): The number of random bytes in each ID.
+        size (int): How many IDs to keep ready.
+    """
+
+    def __init__(self, num_bytes=8, size=4096):
+        self.num_bytes = num_bytes
+        self.size = size
+        self.length = len(generate_secure_user_id(num_bytes))
+        self.low_water = size // 4
+        self.ready = deque(generate_secure_user_ids(size, num_bytes))
+        self.in_use = {}
+        self.low = threading.Event()
+
+        thread = threading.Thread(target=self.refill, name="id-pool")
+        thread.daemon = True
+        thread.start()
+
+    def allocate(self):
+        """Returns an ID that is not in use, and marks it as in use"""
+        while True:
+            try:
+                member_id = self.ready.popleft()
+            except IndexError:
+                # Drained faster than the refill thread could keep up
+                member_id = generate_secure_user_id(self.num_bytes)
+            if len(self.ready) < self.low_water:
+                self.low.set()
+
+            # Each generated ID is a distinct string object, so identity
+            # tells us whether this call inserted it
+            if self.in_use.setdefault(member_id, member_id) is member_id:
+                return member_id
+
+    def reserve(self, member_id):
+        """Marks an ID handed out by another process as in use; returns False if it already is"""
+        return self.in_use.setdefault(member_id, member_id) is member_id
+
+    def release(self, member_id):
+        self.in_use.pop(member_id, None)
+
+    def refill(self):
+        while True:
+            self.low.wait()
+            self.low.clear()
+            missing = self.size - len(self.ready)
+            if missing > 0:
+                self.ready.extend(generate_secure_user_ids(missing, self.num_bytes))
+
+
+def hash_password(password, iterations=PASSWORD_ITERATIONS):
+    """
+    Derives a salted hash of a channel password for storage.
+
+    Args:
+        password (str): The password as the channel creator typed it.
+        iterations (int): The PBKDF2 work factor.
+
+    Returns:
+        str: "pbkdf2_sha256$<iterations>$<salt>$<hash>", salt and hash in base64.
+    """
+    salt = os.urandom(SALT_BYTES)
+    derived = hashlib.pbkdf2_hmac("sha256", password.encode('utf-8'), salt, iterations)
+    return "$".join((
+        "pbkdf2_sha256", str(iterations),
+        base64.b64encode(salt).decode('ascii'), base64.b64encode(derived).decode('ascii'),
+    ))
+
+
+def verify_password(password, stored):
+    """
+    Checks a password against a hash from hash_password(), in constant time.
+
+    Args:
+        password (str): The password a client presented.
+        stored (str): The stored hash.
+
+    Returns:
+        bool: Whether the password matches.
+    """
+    try:
+        scheme, iterations, salt, expected = stored.split("$")
+        if scheme != "pbkdf2_sha256":
+            return False
+        derived = hashlib.pbkdf2_hmac(
+            "sha256", password.encode('utf-8'), base64.b64decode(salt), int(iterations)
+        )
+        return hmac.compare_digest(derived, base64.b64decode(expected))
+    except (ValueError, TypeError):
+        return False
+
+
+class PasswordCache:
+    """
+    Remembers which passwords recently verified against which stored hashes.
+
+    A reconnect storm brings thousands of members presenting the same channel
+    password; only the first pays for PBKDF2, the rest for one HMAC and a
+    dict lookup. Entries are keyed by the stored hash and an HMAC of the
+    password under a key that lives only in this process's memory, so the
+    cache never holds a password. Failed attempts are remembered for
+    failure_ttl seconds, so a client retrying a wrong password does not
+    cost a PBKDF2 run each time. Concurrent checks of the same pair share
+    one PBKDF2 run, so a storm of threads does not all miss at once.
+
+    Args:
+        size (int): How many verified, and how many failed, (hash, password) pairs to remember.
+        failure_ttl (float): Seconds a failed pair is remembered.
+    """
+
+    def __init__(self, size=4096, failure_ttl=10.0):
+        self.size = size
+        self.failure_ttl = failure_ttl
+        self.key = os.urandom(32)
+        self.verified = OrderedDict()
+        self.failed = OrderedDict()  # entry -> when it is forgotten (time.monotonic())
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def entry(self, password, stored):
+        return stored, hmac.new(self.key, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def cached(self, entry):
+        """True or False if the cache knows the answer for entry, else None; call with the lock held"""
+        if entry in self.verified:
+            self.verified.move_to_end(entry)
+            return True
+        expires = self.failed.get(entry)
+        if expires is not None:
+            if expires > time.monotonic():
+                return False
+            del self.failed[entry]
+        return None
+
+    def known(self, password, stored):
+        """Whether check() would answer without running PBKDF2"""
+        entry = self.entry(password, stored)
+        with self.lock:
+            return self.cached(entry) is not None
+
+    def check(self, password, stored):
+        """Like verify_password(password, stored), but answered from the cache when possible"""
+        entry = self.entry(password, stored)
+        with self.lock:
+            verified = self.cached(entry)
+            if verified is not None:
+                return verified
+            result = self.pending.get(entry)
+            if result is not None:
+                owner = False
+            else:
+                result = self.pending[entry] = concurrent.futures.Future()
+                owner = True
+
+        if not owner:
+            return result.result()
+
+        verified = False
+        try:
+            verified = verify_password(password, stored)
+        finally:
+            with self.lock:
+                del self.pending[entry]
+                remembered = self.verified if verified else self.failed
+                remembered[entry] = True if verified else time.monotonic() + self.failure_ttl
+                if len(remembered) > self.size:
+                    remembered.popitem(last=False)
+            result.set_result(verified)
+        return verified